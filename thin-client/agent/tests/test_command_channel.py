@@ -0,0 +1,166 @@
+"""Command channel tests against a stand-in long-poll server on loopback"""
+
+import gzip
+import json
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import vdi_agent  # noqa: E402
+
+
+class StandInServer:
+    """Answers /commands/poll from a queue of (status, body) responses and records what the agent sends"""
+
+    def __init__(self):
+        self.responses = []
+        self.requests = []
+        self.posts = []
+        outer = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlsplit(self.path)
+                outer.requests.append((url.path, parse_qs(url.query)))
+                status, body = outer.responses.pop(0) if outer.responses else (204, None)
+                payload = json.dumps(body).encode() if body is not None else b""
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.headers.get("Content-Encoding") == "gzip":
+                    body = gzip.decompress(body)
+                outer.posts.append((self.path, json.loads(body)))
+                self.send_response(200)
+                self.send_header("Content-Length", "2")
+                self.end_headers()
+                self.wfile.write(b"{}")
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class CommandChannelTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer()
+        self.tmp = tempfile.TemporaryDirectory()
+        config_path = os.path.join(self.tmp.name, "agent-config.json")
+        with open(config_path, "w") as f:
+            json.dump({
+                "server_url": self.server.url,
+                "enable_remote_commands": True,
+                "state_dir": os.path.join(self.tmp.name, "state"),
+                "spool_dir": os.path.join(self.tmp.name, "spool"),
+                "log_cursor_file": os.path.join(self.tmp.name, "log-cursors.json"),
+                "logging": {"log_file": os.path.join(self.tmp.name, "log", "agent.log")}
+            }, f)
+        self.agent = vdi_agent.VDIClientAgent(config_path)
+        self.transport = self.agent.transport
+        self.received = []
+        self.channel = vdi_agent.CommandChannel(
+            self.transport, "device-1", self.received.append,
+            {"command_channel_wait": 1, "command_channel_unsupported_retry": 3600}
+        )
+
+    def tearDown(self):
+        self.channel.stop()
+        self.transport.close()
+        self.server.close()
+        self.tmp.cleanup()
+
+    def test_script_runs_and_result_is_delivered(self):
+        marker = os.path.join(self.tmp.name, "ran")
+        command = {"id": "cmd-1", "type": "execute_script",
+                   "data": {"script": f"echo channel > {marker}; echo done"}}
+        self.server.responses = [
+            (200, {"commands": [command], "cursor": "c1"}),
+            (204, None)
+        ]
+        # Without a running event loop the agent executes dispatched commands inline
+        self.channel.on_command = self.agent.dispatch_command
+
+        self.assertEqual(self.channel.poll(), 0)
+        self.assertTrue(self.channel.connected)
+        self.assertEqual(self.channel.cursor, "c1")
+        with open(marker) as f:
+            self.assertEqual(f.read().strip(), "channel")
+        results = [body for path, body in self.server.posts
+                   if path == f"/api/devices/{self.agent.device_id}/command-result"]
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]["command_id"], "cmd-1")
+        self.assertTrue(results[0]["result"]["success"])
+        self.assertIn("done", results[0]["result"]["stdout"])
+
+        # An empty hold keeps the channel connected and the cursor is sent back
+        self.assertEqual(self.channel.poll(), 0)
+        self.assertTrue(self.channel.connected)
+        path, first = self.server.requests[0]
+        _, second = self.server.requests[1]
+        self.assertEqual(path, "/api/devices/device-1/commands/poll")
+        self.assertEqual(first["wait"], ["1"])
+        self.assertNotIn("cursor", first)
+        self.assertEqual(second["cursor"], ["c1"])
+
+    def test_unsupported_server_falls_back_to_heartbeats(self):
+        for status in vdi_agent.CommandChannel.UNSUPPORTED_STATUSES:
+            self.channel.connected = True
+            self.server.responses = [(status, {"detail": "not found"})]
+            self.assertEqual(self.channel.poll(), 3600)
+            self.assertFalse(self.channel.connected)
+            self.assertEqual(self.channel.failures, 0)
+        self.assertEqual(self.received, [])
+
+    def test_errors_back_off_and_keep_cursor(self):
+        self.channel.cursor = "c7"
+        self.channel.connected = True
+        self.server.responses = [(500, None), (500, None)]
+
+        first = self.channel.poll()
+        second = self.channel.poll()
+        self.assertFalse(self.channel.connected)
+        self.assertEqual(self.channel.failures, 2)
+        self.assertTrue(0.5 <= first <= 1)
+        self.assertTrue(1 <= second <= 2)
+        self.assertEqual(self.channel.cursor, "c7")
+
+        self.server.responses = [(200, {"commands": []})]
+        self.assertEqual(self.channel.poll(), 0)
+        self.assertTrue(self.channel.connected)
+        self.assertEqual(self.channel.failures, 0)
+        self.assertEqual(self.channel.cursor, "c7")
+
+    def test_thread_delivers_until_stopped(self):
+        command = {"id": "cmd-2", "type": "execute_script", "data": {"script": "true"}}
+        self.server.responses = [(200, {"commands": [command], "cursor": "c2"})]
+        delivered = threading.Event()
+        self.channel.on_command = lambda c: (self.received.append(c), delivered.set())
+
+        self.channel.start()
+        self.assertTrue(delivered.wait(5))
+        self.channel.stop()
+        self.channel.join(5)
+        self.assertFalse(self.channel.is_alive())
+        self.assertEqual(self.received, [command])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,159 @@
+"""Loopback tests for the LAN peer cache: two agents on one host share image chunks"""
+
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import vdi_agent  # noqa: E402
+
+
+def free_udp_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(predicate, timeout: float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.05)
+    return predicate()
+
+
+class PeerCacheLoopbackTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.discovery_port = free_udp_port()
+        self.transport = vdi_agent.AgentTransport("http://127.0.0.1:9", {})
+        self.caches = []
+        
+        image = Path(self.tmp.name) / "image.img"
+        image.write_bytes(os.urandom(512 * 1024))
+        self.image = image
+        self.index = vdi_agent.ContentChunker().build_index(str(image))
+    
+    def tearDown(self):
+        for cache in self.caches:
+            cache.stop()
+        self.transport.close()
+        self.tmp.cleanup()
+    
+    def make_cache(self, device_id: str, **config) -> vdi_agent.PeerCache:
+        cache = vdi_agent.PeerCache(device_id, self.transport, dict({
+            "peer_cache_bind": "127.0.0.1",
+            "peer_cache_port": 0,
+            "peer_cache_discovery_port": self.discovery_port,
+            "peer_cache_broadcast": "127.255.255.255",
+            "peer_cache_beacon_interval": 0.2
+        }, **config))
+        cache.start()
+        self.caches.append(cache)
+        return cache
+    
+    def send_beacon(self, payload: bytes):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            sock.sendto(payload, ("127.255.255.255", self.discovery_port))
+    
+    def test_chunks_are_shared_between_discovered_peers(self):
+        seeder = self.make_cache("seeder")
+        leecher = self.make_cache("leecher")
+        seeder.register_image(self.index, self.image)
+        
+        sha256 = self.index["sha256"]
+        if not wait_for(lambda: leecher.peers_for(sha256)):
+            self.skipTest("UDP broadcast is not delivered on this host")
+        self.assertEqual(leecher.peers_for(sha256), [f"127.0.0.1:{seeder.port}"])
+        
+        offset, length, digest = self.index["chunks"][1]
+        chunk = leecher.fetch_chunk(digest, length, sha256)
+        self.assertEqual(chunk, self.image.read_bytes()[offset:offset + length])
+        self.assertIsNone(leecher.fetch_chunk("0" * 64, length, sha256))
+    
+    def test_changed_file_is_not_served(self):
+        seeder = self.make_cache("seeder")
+        seeder.register_image(self.index, self.image)
+        leecher = self.make_cache("leecher", peer_cache_peers=[f"127.0.0.1:{seeder.port}"])
+        
+        _, length, digest = self.index["chunks"][0]
+        self.image.write_bytes(os.urandom(512 * 1024))
+        self.assertIsNone(leecher.fetch_chunk(digest, length, self.index["sha256"]))
+        self.assertNotIn(digest, seeder.chunks)
+    
+    def test_busy_seeder_does_not_serve(self):
+        seeder = self.make_cache("seeder")
+        seeder.register_image(self.index, self.image)
+        leecher = self.make_cache("leecher", peer_cache_peers=[f"127.0.0.1:{seeder.port}"])
+        
+        busy = [True]
+        seeder.busy = lambda: busy[0]
+        _, length, digest = self.index["chunks"][0]
+        self.assertIsNone(leecher.fetch_chunk(digest, length, self.index["sha256"]))
+        busy[0] = False
+        self.assertIsNotNone(leecher.fetch_chunk(digest, length, self.index["sha256"]))
+    
+    def test_oversized_peer_response_is_not_read(self):
+        sent = []
+        finished = threading.Event()
+        
+        class EndlessHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.end_headers()
+                try:
+                    for _ in range(4096):
+                        self.wfile.write(b"x" * 65536)
+                        sent.append(65536)
+                except OSError:
+                    pass
+                finally:
+                    finished.set()
+            
+            def log_message(self, *args):
+                pass
+        
+        hostile = ThreadingHTTPServer(("127.0.0.1", 0), EndlessHandler)
+        threading.Thread(target=hostile.serve_forever, daemon=True).start()
+        self.addCleanup(hostile.server_close)
+        self.addCleanup(hostile.shutdown)
+        leecher = self.make_cache("leecher", peer_cache_peers=[f"127.0.0.1:{hostile.server_address[1]}"])
+        
+        _, length, digest = self.index["chunks"][0]
+        self.assertIsNone(leecher.fetch_chunk(digest, length, self.index["sha256"]))
+        # The body would be 256 MiB; the leecher hangs up soon after one chunk's worth
+        self.assertTrue(finished.wait(10))
+        self.assertLess(sum(sent), 64 * 1024 * 1024)
+    
+    def test_malformed_beacons_do_not_stop_discovery(self):
+        listener = self.make_cache("listener")
+        payloads = [b"not json", b"[1, 2]", b"42", b'{"device_id": "x"}',
+                    b'{"device_id": "x", "port": "nope"}', b'{"device_id": "x", "port": 70000}',
+                    json.dumps({"device_id": "other", "port": 4242, "images": ["abc"]}).encode()]
+        
+        def deliver():
+            # The listener binds asynchronously, so keep sending until it has caught up
+            for payload in payloads:
+                self.send_beacon(payload)
+            return listener.peers_for("abc")
+        
+        delivered = wait_for(deliver)
+        discovery = [thread for thread in threading.enumerate() if thread.name == "peer-cache-discovery"]
+        self.assertTrue(discovery and all(thread.is_alive() for thread in discovery))
+        if not delivered:
+            self.skipTest("UDP broadcast is not delivered on this host")
+        self.assertEqual(listener.peers_for("abc"), ["127.0.0.1:4242"])
+
+
+if __name__ == "__main__":
+    unittest.main()
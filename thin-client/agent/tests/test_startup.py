@@ -0,0 +1,72 @@
+"""Startup checks: agent construction stays self-contained and import stays free of heavy modules.
+
+The wall-clock budgets depend on the machine, so they only run when VDI_AGENT_BENCHMARK=1.
+"""
+
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import vdi_agent  # noqa: E402
+
+
+class StartupTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write_config(self, **overrides) -> str:
+        # Every path the agent writes during construction points into the temporary directory
+        config = dict({
+            "server_url": "http://127.0.0.1:9",
+            "state_dir": os.path.join(self.tmp.name, "state"),
+            "spool_dir": os.path.join(self.tmp.name, "spool"),
+            "download_dir": os.path.join(self.tmp.name, "downloads"),
+            "image_index_cache": os.path.join(self.tmp.name, "image-index.json"),
+            "log_cursor_file": os.path.join(self.tmp.name, "log-cursors.json"),
+            "logging": {"log_file": os.path.join(self.tmp.name, "log", "agent.log")}
+        }, **overrides)
+        path = os.path.join(self.tmp.name, "agent-config.json")
+        with open(path, "w") as f:
+            json.dump(config, f)
+        return path
+
+    def benchmark(self, config_path: str, runs: int) -> tuple:
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            within_budget = vdi_agent.benchmark_startup(config_path, runs=runs)
+        return within_budget, output.getvalue()
+
+    def test_state_stays_in_configured_directories(self):
+        agent = vdi_agent.VDIClientAgent(self.write_config())
+        try:
+            with open(os.path.join(self.tmp.name, "state", "device-id")) as f:
+                self.assertEqual(f.read().strip(), agent.device_id)
+            self.assertTrue(os.path.isdir(os.path.join(self.tmp.name, "log")))
+        finally:
+            agent.transport.close()
+
+    def test_no_heavy_modules_at_import(self):
+        _, report = self.benchmark(self.write_config(), runs=1)
+        self.assertIn("heavy modules at import: none", report)
+
+    def test_budget_overrun_fails(self):
+        within_budget, report = self.benchmark(self.write_config(startup_init_budget_ms=0), runs=1)
+        self.assertFalse(within_budget, report)
+
+    @unittest.skipUnless(os.environ.get("VDI_AGENT_BENCHMARK") == "1", "timing benchmark, set VDI_AGENT_BENCHMARK=1")
+    def test_startup_within_budget(self):
+        within_budget, report = self.benchmark(self.write_config(), runs=5)
+        self.assertTrue(within_budget, f"Agent startup regressed:\n{report}")
+
+
+if __name__ == "__main__":
+    unittest.main()
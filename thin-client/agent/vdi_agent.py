@@ -6,32 +6,3563 @@ Runs on each thin client for remote management and monitoring
 
 import os
 import sys
+import gzip
 import json
+import hashlib
 import time
 import uuid
-import psutil
-import requests
+import random
+import codecs
+import signal
+import socket
+import asyncio
+import errno
+import struct
+import selectors
+import shutil
+import contextlib
+import gc
+import importlib
+import importlib.util
 import subprocess
 import threading
 import logging
-from datetime import datetime
+import tracemalloc
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from pathlib import Path
 from typing import Dict, List, Optional, Any
+from urllib.parse import urlsplit, urlunsplit
+
+
+class LazyModule:
+    """Module proxy that defers the import until the first attribute access"""
+    
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+    
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+# Heavy third-party modules stay out of the startup path until they are needed
+psutil = LazyModule('psutil')
+requests = LazyModule('requests')
+zstandard = LazyModule('zstandard') if importlib.util.find_spec('zstandard') else None
+http_server = LazyModule('http.server')
+
+# Modules that must not be loaded by a plain import of the agent
+HEAVY_MODULES = ('psutil', 'requests', 'urllib3', 'zstandard')
+
+# Smaller buffers applied by low_memory_mode unless the config sets them explicitly
+LOW_MEMORY_DEFAULTS = {
+    "cpu_sample_buffer": 60,
+    "command_workers": 1,
+    "command_dedupe_size": 64,
+    "command_output_max_bytes": 16384,
+    "command_output_chunk_bytes": 8192,
+    "http_pool_size": 1,
+    "log_ship_max_bytes": 65536,
+    "log_ship_max_records": 500,
+    "log_batch_bytes": 16384,
+    "spool_batch_records": 10,
+    "rdp_event_buffer": 64,
+    "memory_budget_mb": 48
+}
+
+
+def setup_logging():
+    """Log to /var/log/vdi/agent.log and stdout"""
+    # Ensure log directory exists before configuring logging
+    Path('/var/log/vdi').mkdir(parents=True, exist_ok=True)
+    
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler('/var/log/vdi/agent.log'),
+            logging.StreamHandler(sys.stdout)
+        ]
+    )
+
 
-# Ensure log directory exists before configuring logging
-Path('/var/log/vdi').mkdir(parents=True, exist_ok=True)
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('/var/log/vdi/agent.log'),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
 logger = logging.getLogger('vdi-agent')
 
+
+class TelemetryRecord:
+    """Fixed-field snapshot record that is much smaller than the equivalent dict.
+
+    Records compare by value, so snapshot diffs treat them as single leaves, and
+    are turned into JSON objects by ``json_default`` only while serializing.
+    """
+    
+    __slots__ = ()
+    
+    # Fields left out of the serialized form while they are None
+    optional = ()
+    
+    def __init__(self, *args, **kwargs):
+        for name, value in zip(self.__slots__, args):
+            setattr(self, name, value)
+        for name in self.__slots__[len(args):]:
+            setattr(self, name, kwargs.get(name))
+    
+    def __eq__(self, other):
+        return type(self) is type(other) and all(
+            getattr(self, name) == getattr(other, name) for name in self.__slots__
+        )
+    
+    def __getitem__(self, name: str):
+        return getattr(self, name)
+    
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            name: getattr(self, name) for name in self.__slots__
+            if not (name in self.optional and getattr(self, name) is None)
+        }
+
+
+class MemoryRecord(TelemetryRecord):
+    __slots__ = ("total", "used", "free", "percent", "available")
+
+
+class DiskRecord(TelemetryRecord):
+    __slots__ = ("device", "mountpoint", "fstype", "total", "used", "free", "percent")
+
+
+class InterfaceCounters(TelemetryRecord):
+    __slots__ = ("bytes_sent", "bytes_recv", "packets_sent", "packets_recv",
+                 "errin", "errout", "dropin", "dropout")
+
+
+class AddressRecord(TelemetryRecord):
+    __slots__ = ("family", "address", "netmask")
+    optional = ("netmask",)
+
+
+class InterfaceRecord(TelemetryRecord):
+    __slots__ = ("addresses", "statistics")
+
+
+class InterfaceRates(TelemetryRecord):
+    __slots__ = ("rx_bps", "tx_bps", "rx_pps", "tx_pps", "errors_ps", "drops_ps")
+
+
+class DiskRates(TelemetryRecord):
+    __slots__ = ("read_iops", "write_iops", "read_bps", "write_bps", "util_percent")
+
+
+def json_default(obj: Any) -> Any:
+    """json.dumps hook that serializes telemetry records and stringifies anything else"""
+    if isinstance(obj, TelemetryRecord):
+        return obj.as_dict()
+    return str(obj)
+
+
+class CompactEncoder:
+    """CBOR heartbeat encoder with integer field ids, tagged records and epoch timestamps.
+
+    Known keys are replaced by the ids in FIELD_IDS, telemetry records become
+    tagged positional arrays and timestamp fields use CBOR tag 1. The schema
+    version travels as map key 0 of the top-level payload.
+    """
+    
+    SCHEMA_VERSION = 3
+    CAPABILITY = f"compact_heartbeat_v{SCHEMA_VERSION}"
+    CONTENT_TYPE = f"application/cbor; schema=vdi-heartbeat-{SCHEMA_VERSION}"
+    
+    # Append only, and bump SCHEMA_VERSION whenever fields or records are added
+    FIELDS = (
+        "device_id", "hostname", "timestamp", "uptime_seconds", "system", "os",
+        "architecture", "kernel_version", "agent_version", "cpu", "usage_percent", "count",
+        "count_logical", "freq", "current", "min", "max", "memory", "disk", "network",
+        "interfaces", "default_gateway", "processes", "total_count", "rdp_sessions", "hardware",
+        "cpu_model", "memory_total_kb", "pci_devices", "usb_devices", "heartbeat_mode", "seq",
+        "base_seq", "changed", "removed", "command_results", "command_id", "result", "success",
+        "error", "agent_transport", "agent_memory", "agent_metrics", "rdp_events", "rdp_perf",
+        "interval", "cores", "mean", "p95", "pid", "name", "cmdline", "started_at", "event",
+        "requests", "new_connections", "bytes_sent", "bytes_uncompressed", "errors",
+        "rss_bytes", "peak_rss_bytes", "budget_bytes", "shedding", "counters", "latency",
+        "startup", "rates", "disk_io", "agent_qos", "profile", "since_s", "transitions",
+        "download_limit_bps"
+    )
+    FIELD_IDS = {name: index + 1 for index, name in enumerate(FIELDS)}
+    
+    RECORD_TAG_BASE = 40000
+    RECORDS = (MemoryRecord, DiskRecord, InterfaceCounters, AddressRecord, InterfaceRecord,
+               InterfaceRates, DiskRates)
+    RECORD_TAGS = dict(zip(RECORDS, range(RECORD_TAG_BASE + 1, RECORD_TAG_BASE + 1 + len(RECORDS))))
+    
+    TIMESTAMP_FIELDS = frozenset(("timestamp", "started_at"))
+    
+    @staticmethod
+    def head(major: int, value: int, out: bytearray):
+        """Write a CBOR initial byte and its variable-length argument"""
+        if value < 24:
+            out.append(major << 5 | value)
+        elif value < 0x100:
+            out += bytes((major << 5 | 24, value))
+        elif value < 0x10000:
+            out += struct.pack(">BH", major << 5 | 25, value)
+        elif value < 0x100000000:
+            out += struct.pack(">BI", major << 5 | 26, value)
+        else:
+            out += struct.pack(">BQ", major << 5 | 27, value)
+    
+    @classmethod
+    def schema(cls) -> Dict[str, Any]:
+        """Describe the field ids and record layouts for the server side"""
+        return {
+            "version": cls.SCHEMA_VERSION,
+            "fields": {str(field_id): name for name, field_id in cls.FIELD_IDS.items()},
+            "records": {str(tag): {"name": record.__name__, "fields": list(record.__slots__)}
+                        for record, tag in cls.RECORD_TAGS.items()},
+            "timestamps": "CBOR tag 1, seconds since the epoch"
+        }
+    
+    def encode(self, payload: Dict[str, Any]) -> bytes:
+        """Encode a heartbeat payload, prefixed with the schema version"""
+        out = bytearray()
+        self.head(5, len(payload) + 1, out)
+        out.append(0)
+        self.head(0, self.SCHEMA_VERSION, out)
+        for key, value in payload.items():
+            self.encode_item(self.FIELD_IDS.get(key, key), out)
+            self.encode_item(value, out, key)
+        return bytes(out)
+    
+    def encode_item(self, value: Any, out: bytearray, key: Optional[str] = None):
+        kind = type(value)
+        if kind is str:
+            if key in self.TIMESTAMP_FIELDS:
+                try:
+                    timestamp = datetime.fromisoformat(value).timestamp()
+                except ValueError:
+                    pass
+                else:
+                    out.append(0xc1)
+                    self.encode_item(timestamp, out)
+                    return
+            data = value.encode('utf-8')
+            self.head(3, len(data), out)
+            out += data
+        elif kind is bool:
+            out.append(0xf5 if value else 0xf4)
+        elif kind is int:
+            if 0 <= value < 1 << 64:
+                self.head(0, value, out)
+            elif -(1 << 64) <= value < 0:
+                self.head(1, -1 - value, out)
+            else:
+                self.encode_item(str(value), out)
+        elif kind is float:
+            # Single precision whenever it round-trips exactly
+            packed = struct.pack(">f", value)
+            if struct.unpack(">f", packed)[0] == value:
+                out.append(0xfa)
+                out += packed
+            else:
+                out.append(0xfb)
+                out += struct.pack(">d", value)
+        elif value is None:
+            out.append(0xf6)
+        elif kind is dict:
+            self.head(5, len(value), out)
+            for item_key, item in value.items():
+                self.encode_item(self.FIELD_IDS.get(item_key, item_key), out)
+                self.encode_item(item, out, item_key)
+        elif kind is list or kind is tuple:
+            self.head(4, len(value), out)
+            for item in value:
+                self.encode_item(item, out)
+        elif isinstance(value, TelemetryRecord):
+            self.head(6, self.RECORD_TAGS[type(value)], out)
+            self.head(4, len(value.__slots__), out)
+            for name in value.__slots__:
+                self.encode_item(getattr(value, name), out)
+        elif isinstance(value, datetime):
+            out.append(0xc1)
+            self.encode_item(value.timestamp(), out)
+        elif isinstance(value, (bytes, bytearray)):
+            self.head(2, len(value), out)
+            out += value
+        else:
+            self.encode_item(str(value), out)
+
+
+class CounterRates:
+    """Turns cumulative kernel counters into per-second rates across collections.
+
+    Counters are as wide as the kernel's unsigned long, so on 32-bit systems a
+    decrease is a wrap; on 64-bit systems it can only mean the counter was reset,
+    and that interval is skipped while the new value becomes the baseline.
+    """
+    
+    COUNTER_MODULUS = 1 << (64 if sys.maxsize > 1 << 32 else 32)
+    
+    def __init__(self):
+        self.previous = {}
+        self.lock = threading.Lock()
+    
+    def update(self, key: Any, values: tuple, now: Optional[float] = None) -> Optional[tuple]:
+        """Store a new sample and return the rates since the previous one, if any"""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            previous = self.previous.get(key)
+            self.previous[key] = (now, values)
+        if previous is None:
+            return None
+        
+        elapsed = now - previous[0]
+        if elapsed <= 0:
+            return None
+        
+        rates = []
+        for old, new in zip(previous[1], values):
+            delta = new - old
+            if delta < 0:
+                if self.COUNTER_MODULUS == 1 << 64:
+                    return None
+                delta += self.COUNTER_MODULUS
+            rates.append(delta / elapsed)
+        return tuple(rates)
+    
+    def retain(self, keys):
+        """Forget devices that have disappeared"""
+        keys = set(keys)
+        with self.lock:
+            for key in list(self.previous):
+                if key not in keys:
+                    del self.previous[key]
+
+
+def snapshot_object(value: Any) -> Optional[Dict[str, Any]]:
+    """Return the fields of a value that serializes as a JSON object, or None for other values"""
+    if isinstance(value, dict):
+        return value
+    if isinstance(value, TelemetryRecord):
+        return value.as_dict()
+    return None
+
+
+def diff_snapshots(old: Dict[str, Any], new: Dict[str, Any], path: tuple = ()) -> tuple:
+    """Return (changed, removed) between two snapshot dicts.
+
+    ``changed`` mirrors the nesting of ``new`` but only holds leaves that differ;
+    telemetry records are compared field by field like dicts, lists as whole
+    values. ``removed`` lists key paths that are no longer present.
+    """
+    changed = {}
+    removed = []
+    
+    for key, value in new.items():
+        if key not in old:
+            changed[key] = value
+            continue
+        
+        old_fields = snapshot_object(old[key])
+        new_fields = snapshot_object(value)
+        if old_fields is not None and new_fields is not None:
+            if isinstance(value, TelemetryRecord) and old[key] == value:
+                continue
+            sub_changed, sub_removed = diff_snapshots(old_fields, new_fields, path + (key,))
+            if sub_changed:
+                changed[key] = sub_changed
+            removed.extend(sub_removed)
+        elif old[key] != value:
+            changed[key] = value
+    
+    for key in old:
+        if key not in new:
+            removed.append(list(path + (key,)))
+    
+    return changed, removed
+
+
+class HeartbeatDeltaEncoder:
+    """Encodes heartbeats as deltas against the last snapshot the server acknowledged"""
+    
+    def __init__(self, full_every: int = 60):
+        self.full_every = full_every
+        self.seq = 0
+        self.acked_seq = None
+        self.acked_snapshot = None
+        self.deltas_since_full = 0
+    
+    def encode(self, snapshot: Dict[str, Any], delta_allowed: bool) -> Dict[str, Any]:
+        """Build the heartbeat payload for a snapshot and advance the sequence number"""
+        self.seq += 1
+        
+        if (delta_allowed and self.acked_snapshot is not None
+                and self.deltas_since_full < self.full_every):
+            changed, removed = diff_snapshots(self.acked_snapshot, snapshot)
+            return {
+                "device_id": snapshot.get("device_id"),
+                "heartbeat_mode": "delta",
+                "seq": self.seq,
+                "base_seq": self.acked_seq,
+                "changed": changed,
+                "removed": removed
+            }
+        
+        payload = dict(snapshot)
+        payload["heartbeat_mode"] = "full"
+        payload["seq"] = self.seq
+        return payload
+    
+    def acknowledge(self, payload: Dict[str, Any], snapshot: Dict[str, Any],
+                    response_data: Dict[str, Any]):
+        """Record the server's answer to a heartbeat payload"""
+        if response_data.get("resync"):
+            logger.info("Server requested full heartbeat resync")
+            self.reset()
+            return
+        
+        ack_seq = response_data.get("ack_seq")
+        if ack_seq is None:
+            # Server does not track snapshots; keep sending full heartbeats
+            self.reset()
+        elif ack_seq != payload["seq"]:
+            logger.warning(f"Heartbeat sequence break (sent {payload['seq']}, acked {ack_seq})")
+            self.reset()
+        else:
+            self.acked_seq = payload["seq"]
+            self.acked_snapshot = snapshot
+            if payload["heartbeat_mode"] == "full":
+                self.deltas_since_full = 0
+            else:
+                self.deltas_since_full += 1
+    
+    def reset(self):
+        """Forget the acknowledged snapshot so the next heartbeat is a full one"""
+        self.acked_seq = None
+        self.acked_snapshot = None
+        self.deltas_since_full = 0
+
+
+class HeartbeatScheduler:
+    """Spaces heartbeats with jitter, backs off on failure and follows server pacing hints"""
+    
+    def __init__(self, interval: float, jitter: float = 0.1, backoff_max: float = 600,
+                 busy_interval: float = 10, initial_spread: Optional[float] = None,
+                 hint_max: float = 3600):
+        self.interval = interval
+        self.jitter = jitter
+        self.backoff_max = backoff_max
+        self.busy_interval = busy_interval
+        self.initial_spread = interval if initial_spread is None else initial_spread
+        self.hint_max = hint_max
+        self.failures = 0
+        self.server_interval = None
+        self.retry_after = None
+        self.resend = False
+    
+    def request_resend(self):
+        """Send the next heartbeat immediately without counting the last one as a failure"""
+        self.resend = True
+    
+    def initial_delay(self) -> float:
+        """Random phase offset so clients that booted together do not stay in lockstep"""
+        return random.uniform(0, self.initial_spread)
+    
+    def observe(self, response, response_data: Optional[Dict[str, Any]] = None):
+        """Pick up Retry-After and next_interval hints from a heartbeat response"""
+        self.retry_after = self.parse_retry_after(response.headers.get("Retry-After"))
+        if response_data is not None:
+            next_interval = response_data.get("next_interval")
+            if isinstance(next_interval, (int, float)) and next_interval > 0:
+                self.server_interval = min(float(next_interval), self.hint_max)
+            else:
+                self.server_interval = None
+    
+    def parse_retry_after(self, value: Optional[str]) -> Optional[float]:
+        """Parse a Retry-After header given in seconds or as an HTTP date"""
+        if not value:
+            return None
+        try:
+            seconds = float(value)
+        except ValueError:
+            try:
+                seconds = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                return None
+        return min(max(seconds, 0.0), self.hint_max)
+    
+    def next_delay(self, success: bool, busy: bool = False) -> float:
+        """Return the number of seconds until the next heartbeat"""
+        if self.resend:
+            self.resend = False
+            delay, self.retry_after = self.retry_after or 0.0, None
+            return delay
+        
+        self.failures = 0 if success else self.failures + 1
+        
+        if self.retry_after is not None:
+            # Only spread upwards so no client comes back before it was told to
+            delay, self.retry_after = self.retry_after, None
+            return delay + random.uniform(0, delay * self.jitter)
+        
+        if success:
+            delay = self.server_interval or self.interval
+            if busy:
+                delay = min(delay, self.busy_interval)
+        else:
+            delay = min(self.backoff_max, self.interval * 2 ** min(self.failures - 1, 16))
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+class AgentMetrics:
+    """Counters, gauges and fixed-bucket latency histograms about the agent itself"""
+    
+    LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (name, labels) -> value, labels being a sorted tuple of (key, value) pairs
+        self.counters = {}
+        # (name, labels) -> [bucket counts..., count, sum, max]
+        self.histograms = {}
+        self.gauges = {}
+        self.server = None
+    
+    @staticmethod
+    def label_key(labels: Dict[str, Any]) -> tuple:
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+    
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, self.label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+    
+    def observe(self, name: str, seconds: float, **labels):
+        """Record one latency sample in seconds"""
+        key = (name, self.label_key(labels))
+        buckets = len(self.LATENCY_BUCKETS)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * buckets + [0, 0.0, 0.0]
+            for index, bound in enumerate(self.LATENCY_BUCKETS):
+                if seconds <= bound:
+                    histogram[index] += 1
+                    break
+            histogram[buckets] += 1
+            histogram[buckets + 1] += seconds
+            histogram[buckets + 2] = max(histogram[buckets + 2], seconds)
+    
+    def gauge(self, name: str, func):
+        """Register a callable that is read whenever metrics are exported"""
+        self.gauges[name] = func
+    
+    @staticmethod
+    def format_labels(labels: tuple, extra: Optional[tuple] = None) -> str:
+        pairs = list(labels) + ([extra] if extra else [])
+        if not pairs:
+            return ""
+        escaped = (
+            (key, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for key, value in pairs
+        )
+        return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+    
+    def render_openmetrics(self) -> str:
+        """Render every metric in the OpenMetrics text format"""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: list(value) for key, value in self.histograms.items()}
+        
+        lines = []
+        for name, func in sorted(self.gauges.items()):
+            try:
+                value = func()
+            except Exception as e:
+                logger.debug(f"Gauge {name} failed: {e}")
+                continue
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        
+        by_name = {}
+        for (name, labels), value in counters.items():
+            by_name.setdefault(name, []).append((labels, value))
+        for name in sorted(by_name):
+            family = name[:-len("_total")] if name.endswith("_total") else name
+            lines.append(f"# TYPE {family} counter")
+            for labels, value in sorted(by_name[name]):
+                lines.append(f"{family}_total{self.format_labels(labels)} {value}")
+        
+        buckets = len(self.LATENCY_BUCKETS)
+        by_name = {}
+        for (name, labels), value in histograms.items():
+            by_name.setdefault(name, []).append((labels, value))
+        for name in sorted(by_name):
+            lines.append(f"# TYPE {name} histogram")
+            lines.append(f"# UNIT {name} seconds")
+            for labels, histogram in sorted(by_name[name]):
+                cumulative = 0
+                for bound, count in zip(self.LATENCY_BUCKETS, histogram):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self.format_labels(labels, ('le', str(bound)))} {cumulative}")
+                lines.append(f"{name}_bucket{self.format_labels(labels, ('le', '+Inf'))} {histogram[buckets]}")
+                lines.append(f"{name}_count{self.format_labels(labels)} {histogram[buckets]}")
+                lines.append(f"{name}_sum{self.format_labels(labels)} {histogram[buckets + 1]:.6f}")
+        
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+    
+    def summary(self) -> Dict[str, Any]:
+        """Compact view for the heartbeat: counters plus [count, avg_ms, max_ms] per histogram"""
+        def short(name, labels):
+            name = name[len("vdi_agent_"):] if name.startswith("vdi_agent_") else name
+            return ":".join([name] + [value for _, value in labels])
+        
+        buckets = len(self.LATENCY_BUCKETS)
+        with self.lock:
+            counters = {short(name, labels): value for (name, labels), value in self.counters.items()}
+            latency = {
+                short(name, labels): [
+                    histogram[buckets],
+                    round(histogram[buckets + 1] / histogram[buckets] * 1000, 1),
+                    round(histogram[buckets + 2] * 1000, 1)
+                ]
+                for (name, labels), histogram in self.histograms.items() if histogram[buckets]
+            }
+        return {"counters": counters, "latency": latency}
+    
+    def start_server(self, bind_address: str, port: int):
+        """Serve /metrics over HTTP, normally on localhost only"""
+        handler = type("MetricsRequestHandler", (MetricsHandler, http_server.BaseHTTPRequestHandler), {})
+        self.server = http_server.ThreadingHTTPServer((bind_address, port), handler)
+        self.server.daemon_threads = True
+        self.server.metrics = self
+        threading.Thread(target=self.server.serve_forever, name="metrics-http", daemon=True).start()
+        logger.info(f"Serving agent metrics on {bind_address}:{self.server.server_address[1]}")
+    
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class MetricsHandler:
+    """Serves AgentMetrics in the OpenMetrics text format.
+
+    Mixed into http.server.BaseHTTPRequestHandler when the metrics endpoint starts.
+    """
+    
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.render_openmetrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "application/openmetrics-text; version=1.0.0; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        logger.debug(f"Metrics {self.address_string()}: {format % args}")
+
+
+class CollectorRegistry:
+    """Registry of snapshot collectors whose results are cached per refresh cadence"""
+    
+    CADENCES = ("static", "slow", "fast")
+    
+    def __init__(self, ttls: Dict[str, Optional[float]], metrics: Optional[AgentMetrics] = None):
+        # A TTL of None means the result is kept until explicitly invalidated
+        self.ttls = ttls
+        self.metrics = metrics
+        self.collectors = {}
+        self.cache = {}
+        self.lock = threading.Lock()
+    
+    def register(self, name: str, func, cadence: str):
+        """Register a collector function under a cadence tier"""
+        if cadence not in self.CADENCES:
+            raise ValueError(f"Unknown collector cadence: {cadence}")
+        self.collectors[name] = (func, cadence)
+    
+    def get(self, name: str) -> Any:
+        """Return a collector result, re-running the collector once its TTL expired"""
+        func, cadence = self.collectors[name]
+        ttl = self.ttls.get(cadence, 0)
+        now = time.monotonic()
+        
+        with self.lock:
+            cached = self.cache.get(name)
+        if cached is not None and (ttl is None or now - cached[0] < ttl):
+            return cached[1]
+        
+        try:
+            value = func()
+        except Exception:
+            if self.metrics is not None:
+                self.metrics.inc("vdi_agent_collector_errors_total", collector=name)
+            raise
+        failed = isinstance(value, dict) and "error" in value
+        if self.metrics is not None:
+            self.metrics.observe("vdi_agent_collector_seconds", time.monotonic() - now, collector=name)
+            if failed:
+                self.metrics.inc("vdi_agent_collector_errors_total", collector=name)
+        
+        # Failed collections are retried on the next heartbeat instead of cached
+        if not failed:
+            with self.lock:
+                self.cache[name] = (now, value)
+        return value
+    
+    def peek(self, name: str) -> Any:
+        """Return the last cached result of a collector without running it"""
+        with self.lock:
+            cached = self.cache.get(name)
+        return cached[1] if cached is not None else None
+    
+    def refresh_expired(self):
+        """Re-run expired cached collectors so heartbeats find fresh results"""
+        now = time.monotonic()
+        for name, (_, cadence) in list(self.collectors.items()):
+            ttl = self.ttls.get(cadence, 0)
+            if not ttl:
+                # Fast collectors run with the heartbeat, static ones on invalidation
+                continue
+            with self.lock:
+                cached = self.cache.get(name)
+            if cached is None or now - cached[0] >= ttl:
+                self.get(name)
+    
+    def invalidate(self, name: Optional[str] = None, cadence: Optional[str] = None):
+        """Drop cached results for one collector, one cadence tier, or everything"""
+        with self.lock:
+            for collector_name, (_, collector_cadence) in self.collectors.items():
+                if name is not None and collector_name != name:
+                    continue
+                if cadence is not None and collector_cadence != cadence:
+                    continue
+                self.cache.pop(collector_name, None)
+
+
+class HotplugWatcher:
+    """Detects PCI/USB hotplug events by watching the sysfs device lists"""
+    
+    WATCHED_PATHS = ("/sys/bus/pci/devices", "/sys/bus/usb/devices")
+    
+    def __init__(self):
+        self.signature = self.read_signature()
+    
+    def read_signature(self) -> tuple:
+        """Return the current set of bus devices"""
+        signature = []
+        for path in self.WATCHED_PATHS:
+            try:
+                signature.append(tuple(sorted(os.listdir(path))))
+            except OSError:
+                signature.append(())
+        return tuple(signature)
+    
+    def changed(self) -> bool:
+        """Return True once for every change in the attached devices"""
+        signature = self.read_signature()
+        if signature == self.signature:
+            return False
+        self.signature = signature
+        return True
+
+
+class NativeCollectors:
+    """Fork-free collectors reading /proc and /sys through pre-opened file descriptors"""
+    
+    RTF_GATEWAY = 0x2
+    PCI_IDS_PATHS = ("/usr/share/hwdata/pci.ids", "/usr/share/misc/pci.ids")
+    
+    def __init__(self):
+        self.fds = {}
+        for path in ('/proc/meminfo', '/proc/stat', '/proc/net/dev', '/proc/diskstats'):
+            self.fds[path] = os.open(path, os.O_RDONLY)
+    
+    def read(self, path: str) -> str:
+        """Re-read a pre-opened procfs file from offset 0"""
+        fd = self.fds[path]
+        chunks = []
+        offset = 0
+        while True:
+            chunk = os.pread(fd, 65536, offset)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            offset += len(chunk)
+        return b"".join(chunks).decode('utf-8', errors='replace')
+    
+    def close(self):
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds = {}
+    
+    def meminfo(self) -> Dict[str, int]:
+        """Return /proc/meminfo values in bytes"""
+        values = {}
+        for line in self.read('/proc/meminfo').splitlines():
+            key, _, rest = line.partition(':')
+            parts = rest.split()
+            if parts:
+                values[key] = int(parts[0]) * 1024
+        return values
+    
+    def virtual_memory(self) -> MemoryRecord:
+        """Memory usage with the same field semantics as psutil.virtual_memory"""
+        mem = self.meminfo()
+        total = mem["MemTotal"]
+        free = mem["MemFree"]
+        cached = mem.get("Cached", 0) + mem.get("SReclaimable", 0)
+        available = mem.get("MemAvailable", free + cached)
+        return MemoryRecord(
+            total,
+            total - available,
+            free,
+            round((total - available) / total * 100, 1) if total else 0.0,
+            available
+        )
+    
+    def cpu_times(self) -> Dict[str, tuple]:
+        """Return (busy, total) jiffies for the aggregate and every core"""
+        times = {}
+        for line in self.read('/proc/stat').splitlines():
+            if not line.startswith('cpu'):
+                break
+            parts = line.split()
+            values = [int(value) for value in parts[1:9]]
+            total = sum(values)
+            times[parts[0]] = (total - values[3] - values[4], total)
+        return times
+    
+    def net_io_counters(self) -> Dict[str, InterfaceCounters]:
+        """Return per-interface counters from /proc/net/dev"""
+        counters = {}
+        for line in self.read('/proc/net/dev').splitlines()[2:]:
+            name, _, data = line.partition(':')
+            fields = data.split()
+            if len(fields) < 16:
+                continue
+            counters[name.strip()] = InterfaceCounters(
+                int(fields[8]), int(fields[0]), int(fields[9]), int(fields[1]),
+                int(fields[2]), int(fields[10]), int(fields[3]), int(fields[11])
+            )
+        return counters
+    
+    def disk_io_counters(self) -> Dict[str, tuple]:
+        """Return (reads, writes, read bytes, written bytes, busy ms) per device from /proc/diskstats"""
+        counters = {}
+        for line in self.read('/proc/diskstats').splitlines():
+            fields = line.split()
+            if len(fields) < 14:
+                continue
+            counters[fields[2]] = (
+                int(fields[3]), int(fields[7]),
+                int(fields[5]) * 512, int(fields[9]) * 512,
+                int(fields[12])
+            )
+        return counters
+    
+    def default_gateway(self) -> Optional[str]:
+        """Return the default IPv4 gateway from /proc/net/route"""
+        with open('/proc/net/route', 'r') as f:
+            f.readline()
+            for line in f:
+                fields = line.split()
+                if len(fields) > 3 and fields[1] == '00000000' and int(fields[3], 16) & self.RTF_GATEWAY:
+                    return socket.inet_ntoa(struct.pack("<I", int(fields[2], 16)))
+        return None
+    
+    @staticmethod
+    def read_attr(path: Path) -> Optional[str]:
+        try:
+            return path.read_text().strip()
+        except OSError:
+            return None
+    
+    def pci_names(self, wanted: set) -> Dict[tuple, str]:
+        """Look up names in pci.ids for keys like ("vendor", "8086") or ("device", "8086", "5916").
+
+        Only the wanted keys are kept, so one pass over the file costs little memory.
+        """
+        names = {}
+        path = next((path for path in self.PCI_IDS_PATHS if os.path.exists(path)), None)
+        if path is None:
+            return names
+        
+        vendor = device = pci_class = None
+        in_classes = False
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                if not line.strip() or line.startswith('#'):
+                    continue
+                ids, _, name = line.strip().partition('  ')
+                if line.startswith('C '):
+                    in_classes = True
+                    pci_class = ids[2:].lower()
+                    key = ("class", pci_class)
+                elif in_classes:
+                    if line.startswith('\t\t'):
+                        # Programming interfaces are not part of lspci -mm output
+                        continue
+                    key = ("subclass", pci_class, ids.lower())
+                elif line.startswith('\t\t'):
+                    key = ("subsystem", vendor, device) + tuple(ids.lower().split())
+                elif line.startswith('\t'):
+                    device = ids.lower()
+                    key = ("device", vendor, device)
+                else:
+                    vendor = ids.lower()
+                    key = ("vendor", vendor)
+                if key in wanted:
+                    names[key] = name
+        return names
+    
+    def pci_devices(self) -> List[str]:
+        """List PCI devices from sysfs in 'lspci -mm' form, with names from pci.ids"""
+        entries = []
+        for device in sorted(Path('/sys/bus/pci/devices').iterdir()):
+            pci_class = (self.read_attr(device / 'class') or '0x000000')[2:].lower()
+            entries.append((
+                device.name,
+                pci_class,
+                (self.read_attr(device / 'vendor') or '0x0000')[2:].lower(),
+                (self.read_attr(device / 'device') or '0x0000')[2:].lower(),
+                (self.read_attr(device / 'revision') or '0x00')[2:],
+                (self.read_attr(device / 'subsystem_vendor') or '0x0000')[2:].lower(),
+                (self.read_attr(device / 'subsystem_device') or '0x0000')[2:].lower()
+            ))
+        
+        wanted = set()
+        for _, pci_class, vendor, product, _, subsystem_vendor, subsystem_device in entries:
+            wanted.update({("class", pci_class[:2]), ("subclass", pci_class[:2], pci_class[2:4]),
+                           ("vendor", vendor), ("device", vendor, product), ("vendor", subsystem_vendor),
+                           ("subsystem", vendor, product, subsystem_vendor, subsystem_device)})
+        names = self.pci_names(wanted)
+        
+        devices = []
+        for slot, pci_class, vendor, product, revision, subsystem_vendor, subsystem_device in entries:
+            device_name = names.get(("device", vendor, product), f"Device {product}")
+            # Unknown IDs are shown the way lspci shows them
+            class_name = (names.get(("subclass", pci_class[:2], pci_class[2:4]))
+                          or names.get(("class", pci_class[:2])) or f"Class {pci_class[:4]}")
+            # lspci leaves out domain 0000
+            slot = slot[5:] if slot.startswith('0000:') else slot
+            line = (f'{slot} "{class_name}" "{names.get(("vendor", vendor), f"Vendor {vendor}")}" '
+                    f'"{device_name}"')
+            if revision != '00':
+                line += f" -r{revision}"
+            if pci_class[4:6] not in ('', '00'):
+                line += f" -p{pci_class[4:6]}"
+            if subsystem_vendor != '0000':
+                if (subsystem_vendor, subsystem_device) == (vendor, product):
+                    # lspci names a subsystem that repeats the device IDs after the device
+                    subsystem_name = device_name
+                else:
+                    subsystem_name = names.get(("subsystem", vendor, product, subsystem_vendor, subsystem_device),
+                                               f"Device {subsystem_device}")
+                line += f' "{names.get(("vendor", subsystem_vendor), f"Vendor {subsystem_vendor}")}" "{subsystem_name}"'
+            else:
+                line += ' "" ""'
+            devices.append(line)
+        return devices
+    
+    def usb_devices(self) -> List[str]:
+        """List USB devices from sysfs in lsusb form, without root hubs"""
+        devices = []
+        for device in sorted(Path('/sys/bus/usb/devices').iterdir()):
+            vendor = self.read_attr(device / 'idVendor')
+            if vendor is None or device.name.startswith('usb'):
+                # Interfaces have no idVendor; usbN entries are root hubs
+                continue
+            product_id = self.read_attr(device / 'idProduct') or '0000'
+            busnum = int(self.read_attr(device / 'busnum') or 0)
+            devnum = int(self.read_attr(device / 'devnum') or 0)
+            name = ' '.join(filter(None, (self.read_attr(device / 'manufacturer'),
+                                          self.read_attr(device / 'product'))))
+            devices.append(f"Bus {busnum:03d} Device {devnum:03d}: ID {vendor}:{product_id} {name}".rstrip())
+        return devices
+
+
+class CPUSampler(threading.Thread):
+    """Background sampler of per-core CPU utilisation read from /proc/stat"""
+    
+    def __init__(self, interval: float = 1.0, buffer_size: int = 240,
+                 native: Optional[NativeCollectors] = None):
+        super().__init__(name="cpu-sampler", daemon=True)
+        self.interval = interval
+        self.native = native
+        self.samples = deque(maxlen=buffer_size)
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.previous = None
+        self.last_report = 0.0
+    
+    def read_cpu_times(self) -> Dict[str, tuple]:
+        """Return (busy, total) jiffies for the aggregate and every core"""
+        if self.native is not None:
+            return self.native.cpu_times()
+        
+        times = {}
+        with open('/proc/stat', 'r') as f:
+            for line in f:
+                if not line.startswith('cpu'):
+                    break
+                parts = line.split()
+                values = [int(value) for value in parts[1:9]]
+                total = sum(values)
+                idle = values[3] + values[4]  # idle + iowait
+                times[parts[0]] = (total - idle, total)
+        return times
+    
+    def sample(self):
+        """Take one utilisation sample relative to the previous reading"""
+        current = self.read_cpu_times()
+        previous = self.previous
+        self.previous = current
+        if previous is None:
+            return
+        
+        usage = {}
+        for name, (busy, total) in current.items():
+            if name not in previous:
+                continue
+            delta_total = total - previous[name][1]
+            delta_busy = busy - previous[name][0]
+            usage[name] = 100.0 * delta_busy / delta_total if delta_total > 0 else 0.0
+        
+        with self.lock:
+            self.samples.append((time.monotonic(), usage))
+    
+    def run(self):
+        """Sample until stopped"""
+        while True:
+            try:
+                self.sample()
+            except Exception as e:
+                logger.debug(f"CPU sample failed: {e}")
+            if self.stop_event.wait(self.interval):
+                break
+    
+    def stop(self):
+        """Stop the sampler thread"""
+        self.stop_event.set()
+    
+    def report(self) -> Optional[Dict[str, Any]]:
+        """Summarise the samples taken since the previous report"""
+        now = time.monotonic()
+        with self.lock:
+            window = [usage for ts, usage in self.samples if ts > self.last_report]
+            self.last_report = now
+        if not window:
+            return None
+        
+        series = {}
+        for usage in window:
+            for name, value in usage.items():
+                series.setdefault(name, []).append(value)
+        
+        stats = {name: self.summarize(values) for name, values in series.items()}
+        cores = sorted((name for name in stats if name != 'cpu'), key=lambda name: int(name[3:]))
+        return {
+            "samples": len(window),
+            "total": stats.get('cpu'),
+            "per_core": [stats[name] for name in cores]
+        }
+    
+    @staticmethod
+    def summarize(values: List[float]) -> Dict[str, float]:
+        """Return min/mean/max/p95 of a sample series"""
+        ordered = sorted(values)
+        p95_index = max(0, int(round(0.95 * len(ordered))) - 1)
+        return {
+            "min": round(ordered[0], 1),
+            "mean": round(sum(ordered) / len(ordered), 1),
+            "max": round(ordered[-1], 1),
+            "p95": round(ordered[p95_index], 1)
+        }
+
+
+_counting_adapter_class = None
+
+
+def counting_http_adapter(on_new_connection, **kwargs):
+    """Build an HTTPAdapter that reports every connection it has to open.
+
+    The class is defined on first use because it subclasses a requests type.
+    """
+    global _counting_adapter_class
+    if _counting_adapter_class is None:
+        class CountingHTTPAdapter(requests.adapters.HTTPAdapter):
+            def __init__(self, on_new_connection, **kwargs):
+                self.on_new_connection = on_new_connection
+                super().__init__(**kwargs)
+            
+            def init_poolmanager(self, *args, **kwargs):
+                super().init_poolmanager(*args, **kwargs)
+                self.poolmanager.pool_classes_by_scheme = {
+                    scheme: self.counting_pool_class(pool_class)
+                    for scheme, pool_class in self.poolmanager.pool_classes_by_scheme.items()
+                }
+            
+            def counting_pool_class(self, pool_class):
+                """Wrap a urllib3 pool class so new connections are counted"""
+                on_new_connection = self.on_new_connection
+                
+                class CountingConnectionPool(pool_class):
+                    def _new_conn(self):
+                        on_new_connection()
+                        return super()._new_conn()
+                
+                return CountingConnectionPool
+        
+        _counting_adapter_class = CountingHTTPAdapter
+    return _counting_adapter_class(on_new_connection, **kwargs)
+
+
+class AgentTransport:
+    """Pooled keep-alive HTTP transport shared by every agent request"""
+    
+    DEFAULT_TIMEOUTS = {
+        "default": 30,
+        "heartbeat": 30,
+        "command_result": 30,
+        "download": 60,
+        "peer": 5,
+        "logs": 60,
+        "command_poll": 10
+    }
+    
+    def __init__(self, server_url: str, config: Dict[str, Any], metrics: Optional[AgentMetrics] = None):
+        self.server_url = server_url
+        self.metrics = metrics
+        self.compact_encoder = CompactEncoder()
+        self.timeouts = dict(self.DEFAULT_TIMEOUTS, **config.get("http_timeouts", {}))
+        self.compression = config.get("http_compression", "gzip")
+        self.compression_min_bytes = config.get("http_compression_min_bytes", 1024)
+        
+        if self.compression == "zstd" and zstandard is None:
+            logger.warning("zstandard module not available, compressing with gzip")
+            self.compression = "gzip"
+        
+        self.stats_lock = threading.Lock()
+        self.stats = {
+            "requests": 0,
+            "new_connections": 0,
+            "bytes_sent": 0,
+            "bytes_uncompressed": 0,
+            "errors": 0
+        }
+        # Called with the size of every body sent or received, e.g. for QoS accounting
+        self.on_transfer = None
+        
+        self.session = requests.Session()
+        self.session.verify = config.get("verify_tls", False)
+        # Image payloads are always checked against the CA store unless explicitly disabled
+        self.download_verify = config.get("verify_tls_downloads", True)
+        self.session.headers["User-Agent"] = "vdi-agent/1.0.0"
+        pool_size = config.get("http_pool_size", 4)
+        adapter = counting_http_adapter(
+            self.count_new_connection,
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=0
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+    
+    def count_new_connection(self):
+        with self.stats_lock:
+            self.stats["new_connections"] += 1
+    
+    def timeout_for(self, kind: str):
+        """Return the configured timeout for a request type"""
+        timeout = self.timeouts.get(kind, self.timeouts["default"])
+        # [connect, read] pairs are passed to requests as a tuple
+        return tuple(timeout) if isinstance(timeout, list) else timeout
+    
+    def encode_body(self, payload: Any) -> tuple:
+        """Serialize a JSON payload and compress it when worthwhile"""
+        body = json.dumps(payload, separators=(',', ':'), default=json_default).encode('utf-8')
+        return self.compress_body(body, "application/json")
+    
+    def compress_body(self, body: bytes, content_type: str) -> tuple:
+        """Compress an encoded body when worthwhile and return it with its headers"""
+        headers = {"Content-Type": content_type}
+        raw_size = len(body)
+        
+        if len(body) >= self.compression_min_bytes:
+            if self.compression == "zstd":
+                body = zstandard.ZstdCompressor().compress(body)
+                headers["Content-Encoding"] = "zstd"
+            elif self.compression == "gzip":
+                body = gzip.compress(body, compresslevel=6)
+                headers["Content-Encoding"] = "gzip"
+        
+        with self.stats_lock:
+            self.stats["bytes_uncompressed"] += raw_size
+            self.stats["bytes_sent"] += len(body)
+        return body, headers
+    
+    def request(self, method: str, kind: str, url: str, **kwargs):
+        """Issue a request through the pooled session"""
+        kwargs.setdefault("timeout", self.timeout_for(kind))
+        if kind == "download":
+            kwargs.setdefault("verify", self.download_verify)
+        with self.stats_lock:
+            self.stats["requests"] += 1
+        started = time.monotonic()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            with self.stats_lock:
+                self.stats["errors"] += 1
+            if self.metrics is not None:
+                self.metrics.inc("vdi_agent_http_requests_total", kind=kind, status="error")
+            raise
+        if self.metrics is not None:
+            self.metrics.observe("vdi_agent_http_request_seconds", time.monotonic() - started, kind=kind)
+            self.metrics.inc("vdi_agent_http_requests_total", kind=kind, status=response.status_code)
+        
+        body = kwargs.get("data")
+        transferred = len(body) if isinstance(body, (bytes, bytearray)) else 0
+        # Streamed bodies are counted as they are read, see iter_content
+        if not kwargs.get("stream"):
+            transferred += self.wire_bytes(response, len(response.content))
+        self.count_transfer(transferred)
+        return response
+    
+    def iter_content(self, response, chunk_size: int):
+        """Iterate over a streamed response body, counting the bytes received"""
+        counted = 0
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            received = self.wire_bytes(response, counted + len(chunk))
+            self.count_transfer(received - counted)
+            counted = received
+            yield chunk
+    
+    @staticmethod
+    def wire_bytes(response, default: int) -> int:
+        """Body bytes read from the connection so far, before content decoding"""
+        tell = getattr(response.raw, "tell", None)
+        return tell() if tell is not None else default
+    
+    def count_transfer(self, amount: int):
+        if self.on_transfer is not None and amount:
+            self.on_transfer(amount)
+    
+    def post_json(self, kind: str, path: str, payload: Any, **kwargs):
+        """POST a JSON payload to a management server endpoint"""
+        body, headers = self.encode_body(payload)
+        headers.update(kwargs.pop("headers", {}))
+        return self.request("POST", kind, f"{self.server_url}{path}",
+                            data=body, headers=headers, **kwargs)
+    
+    def post_compact(self, kind: str, path: str, payload: Dict[str, Any], **kwargs):
+        """POST a heartbeat payload in the compact CBOR encoding"""
+        body, headers = self.compress_body(self.compact_encoder.encode(payload), CompactEncoder.CONTENT_TYPE)
+        headers.update(kwargs.pop("headers", {}))
+        return self.request("POST", kind, f"{self.server_url}{path}",
+                            data=body, headers=headers, **kwargs)
+    
+    def get(self, kind: str, url: str, **kwargs):
+        """GET an absolute URL"""
+        return self.request("GET", kind, url, **kwargs)
+    
+    def connection_stats(self) -> Dict[str, int]:
+        """Return request and connection reuse counters"""
+        with self.stats_lock:
+            stats = dict(self.stats)
+        stats["reused_connections"] = max(0, stats["requests"] - stats["new_connections"])
+        return stats
+    
+    def close(self):
+        self.session.close()
+
+
+class TelemetrySpool:
+    """Size-bounded, append-only on-disk spool of heartbeats that failed to send"""
+    
+    def __init__(self, directory: str, max_bytes: int = 16 * 1024 * 1024,
+                 segment_bytes: int = 1024 * 1024):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.segment_bytes = min(segment_bytes, max_bytes)
+        self.offset_file = self.directory / "offset.json"
+        self.lock = threading.Lock()
+        self.directory.mkdir(parents=True, exist_ok=True)
+    
+    def segment_path(self, segment: int) -> Path:
+        return self.directory / f"spool-{segment:08d}.log"
+    
+    def segments(self) -> List[int]:
+        """Return the existing segment numbers, oldest first"""
+        segments = []
+        for path in self.directory.glob("spool-*.log"):
+            try:
+                segments.append(int(path.stem[6:]))
+            except ValueError:
+                continue
+        return sorted(segments)
+    
+    def append(self, record: Dict[str, Any]):
+        """Durably append one record, dropping the oldest segments beyond the size limit"""
+        line = json.dumps(record, separators=(',', ':'), default=json_default).encode('utf-8') + b"\n"
+        
+        with self.lock:
+            segments = self.segments()
+            segment = segments[-1] if segments else 1
+            path = self.segment_path(segment)
+            if path.exists() and path.stat().st_size + len(line) > self.segment_bytes:
+                segment += 1
+                path = self.segment_path(segment)
+            
+            with open(path, 'ab+') as f:
+                # Terminate a record torn by a crash so this one stays readable
+                if f.tell() > 0:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        line = b"\n" + line
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            
+            self.enforce_limit()
+    
+    def enforce_limit(self):
+        """Delete the oldest segments until the spool fits in max_bytes"""
+        segments = self.segments()
+        sizes = {segment: self.segment_path(segment).stat().st_size for segment in segments}
+        total = sum(sizes.values())
+        
+        while total > self.max_bytes and len(segments) > 1:
+            oldest = segments.pop(0)
+            self.segment_path(oldest).unlink()
+            total -= sizes[oldest]
+            logger.warning(f"Telemetry spool full, dropped segment {oldest}")
+    
+    def read_offset(self) -> tuple:
+        """Return the (segment, byte offset) of the next unsent record"""
+        try:
+            offset = json.loads(self.offset_file.read_text())
+            return offset["segment"], offset["offset"]
+        except (OSError, ValueError, KeyError):
+            return 0, 0
+    
+    def write_offset(self, segment: int, offset: int):
+        """Atomically persist the read position"""
+        tmp_path = self.offset_file.with_suffix(".tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump({"segment": segment, "offset": offset}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.offset_file)
+    
+    def read_batch(self, max_records: int) -> tuple:
+        """Read up to max_records oldest records and the position just after them"""
+        with self.lock:
+            segments = self.segments()
+            segment, offset = self.read_offset()
+            records = []
+            
+            for current in segments:
+                if current < segment:
+                    continue
+                if current > segment:
+                    # The segment we stopped in was consumed or dropped
+                    segment, offset = current, 0
+                
+                with open(self.segment_path(current), 'rb') as f:
+                    f.seek(offset)
+                    for line in f:
+                        if not line.endswith(b"\n"):
+                            # Torn write from a crash; skipped once appends resume after it
+                            break
+                        offset += len(line)
+                        try:
+                            records.append(json.loads(line))
+                        except ValueError:
+                            logger.warning("Skipping corrupt telemetry spool record")
+                            continue
+                        if len(records) >= max_records:
+                            return records, (segment, offset)
+            
+            return records, (segment, offset)
+    
+    def commit(self, position: tuple):
+        """Mark everything before position as delivered and drop consumed segments"""
+        segment, offset = position
+        with self.lock:
+            self.write_offset(segment, offset)
+            for older in self.segments():
+                if older < segment:
+                    self.segment_path(older).unlink()
+    
+    def has_pending(self) -> bool:
+        """Return True if the spool holds undelivered records"""
+        with self.lock:
+            segments = self.segments()
+            if not segments:
+                return False
+            segment, offset = self.read_offset()
+            if segments[-1] > segment:
+                return True
+            return self.segment_path(segments[-1]).stat().st_size > offset
+
+
+class CommandCancelled(Exception):
+    """Raised inside a command handler once its command was cancelled"""
+
+
+class CommandExecutor:
+    """Bounded worker pool for server commands with priorities, dedupe and result batching"""
+    
+    # Lower numbers run first
+    DEFAULT_PRIORITIES = {
+        "restart_system": 0,
+        "update_config": 1,
+        "restart_service": 2,
+        "collect_logs": 3,
+        "memory_report": 3,
+        "profile_agent": 3,
+        "execute_script": 4,
+        "install_package": 5,
+        "update_image": 6
+    }
+    
+    DEFAULT_CONCURRENCY = {
+        "restart_system": 1,
+        "update_config": 1,
+        "install_package": 1,
+        "update_image": 1,
+        "collect_logs": 3,
+        "profile_agent": 1
+    }
+    
+    def __init__(self, agent, config: Dict[str, Any]):
+        self.agent = agent
+        self.workers = config.get("command_workers", 2)
+        self.default_timeout = config.get("max_command_timeout", 300) + 30
+        self.cancel_grace = config.get("command_cancel_grace", 10)
+        self.timeouts = config.get("command_timeouts", {})
+        self.priorities = dict(self.DEFAULT_PRIORITIES, **config.get("command_priorities", {}))
+        self.type_limits = dict(self.DEFAULT_CONCURRENCY, **config.get("command_concurrency", {}))
+        self.dedupe_size = config.get("command_dedupe_size", 256)
+        
+        self.queue = []
+        self.sequence = 0
+        self.running = {}
+        self.condition = None
+        # Thread future -> cancel event of every command handler still running
+        self.in_flight = {}
+        
+        # command id -> cached result, None while the command is still queued or running
+        self.seen = OrderedDict()
+        
+        self.results_lock = threading.Lock()
+        self.pending_results = []
+        
+        # Commands parked until the agent is idle, and when each was first deferred
+        self.defer_max = config.get("qos_defer_max", 900)
+        self.deferred_lock = threading.Lock()
+        self.deferred = []
+        self.deferred_since = OrderedDict()
+    
+    def start(self) -> List[asyncio.Task]:
+        """Create the worker tasks on the running event loop"""
+        self.condition = asyncio.Condition()
+        return [asyncio.create_task(self.worker(), name=f"commands-{worker}")
+                for worker in range(self.workers)]
+    
+    async def submit(self, command: Dict[str, Any]):
+        """Queue a command unless it was already received"""
+        command_id = command.get('id')
+        
+        if command_id is not None and command_id in self.seen:
+            cached = self.seen[command_id]
+            if cached is None:
+                logger.info(f"Ignoring redelivered command {command_id}, already in progress")
+            else:
+                # The server did not see our result; send it again instead of re-running
+                logger.info(f"Command {command_id} already executed, resending result")
+                self.add_result(command_id, cached)
+            return
+        
+        if command_id is not None:
+            self.seen[command_id] = None
+            while len(self.seen) > self.dedupe_size:
+                self.seen.popitem(last=False)
+        
+        priority = command.get('priority', self.priorities.get(command.get('type'), 10))
+        async with self.condition:
+            self.queue.append((priority, self.sequence, command))
+            self.sequence += 1
+            self.condition.notify_all()
+    
+    def next_runnable(self) -> Optional[Dict[str, Any]]:
+        """Pop the highest priority command whose type still has a free slot"""
+        for entry in sorted(self.queue, key=lambda entry: entry[:2]):
+            command_type = entry[2].get('type')
+            if self.running.get(command_type, 0) < self.type_limits.get(command_type, self.workers):
+                self.queue.remove(entry)
+                self.running[command_type] = self.running.get(command_type, 0) + 1
+                return entry[2]
+        return None
+    
+    async def worker(self):
+        """Run commands until cancelled"""
+        while True:
+            async with self.condition:
+                command = self.next_runnable()
+                while command is None:
+                    await self.condition.wait()
+                    command = self.next_runnable()
+            
+            command_type = command.get('type')
+            try:
+                result = await self.run(command)
+            finally:
+                async with self.condition:
+                    self.running[command_type] -= 1
+                    self.condition.notify_all()
+            
+            command_id = command.get('id')
+            if result.get("deferred"):
+                # Not a result yet: the id stays in progress until the rerun reports
+                continue
+            if command_id in self.seen:
+                self.seen[command_id] = result
+            self.add_result(command_id, result)
+    
+    async def run(self, command: Dict[str, Any]) -> Dict[str, Any]:
+        """Execute one command in the command thread pool, cancelling it when it times out"""
+        command_type = command.get('type')
+        timeout = self.timeouts.get(command_type, self.default_timeout)
+        cancel = threading.Event()
+        thread_future = self.agent.command_pool.submit(self.agent.execute_command, command, cancel)
+        self.in_flight[thread_future] = cancel
+        thread_future.add_done_callback(lambda done: self.in_flight.pop(done, None))
+        future = asyncio.wrap_future(thread_future)
+        
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Command {command.get('id')} ({command_type}) timed out after {timeout}s")
+            # Keep the worker slot until the handler has killed its processes and returned
+            cancel.set()
+            try:
+                await asyncio.wait_for(future, self.cancel_grace)
+            except asyncio.TimeoutError:
+                logger.warning(f"Command {command.get('id')} ignored cancellation, its thread is still busy")
+            except Exception:
+                pass
+            return {"success": False, "error": f"Command timed out after {timeout}s"}
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+    
+    def cancel_all(self):
+        """Ask every running command handler to stop (thread-safe)"""
+        for cancel in list(self.in_flight.values()):
+            cancel.set()
+    
+    def wait_cancelled(self, timeout: float) -> bool:
+        """Wait for running command handlers to return; False if some are still busy"""
+        _, busy = wait_futures(list(self.in_flight), timeout)
+        return not busy
+    
+    def defer(self, command: Dict[str, Any]) -> bool:
+        """Park a command until resume_deferred runs; False once it has waited defer_max"""
+        command_id = command.get('id')
+        now = time.monotonic()
+        with self.deferred_lock:
+            since = self.deferred_since.setdefault(command_id, now)
+            if now - since >= self.defer_max:
+                del self.deferred_since[command_id]
+                return False
+            self.deferred.append(command)
+            while len(self.deferred_since) > self.dedupe_size:
+                self.deferred_since.popitem(last=False)
+        
+        # Run it even if the user never goes idle
+        loop = self.agent.loop
+        loop.call_soon_threadsafe(loop.call_later, self.defer_max - (now - since) + 1,
+                                  self.resume_deferred, True)
+        return True
+    
+    def resume_deferred(self, overdue_only: bool = False):
+        """Queue the deferred commands again, or only those past defer_max (thread-safe)"""
+        loop = self.agent.loop
+        if loop is None or not loop.is_running():
+            return
+        now = time.monotonic()
+        with self.deferred_lock:
+            commands = [command for command in self.deferred if not overdue_only
+                        or now - self.deferred_since.get(command.get('id'), now) >= self.defer_max]
+            self.deferred = [command for command in self.deferred if command not in commands]
+        if commands:
+            asyncio.run_coroutine_threadsafe(self.resubmit(commands), loop)
+    
+    async def resubmit(self, commands: List[Dict[str, Any]]):
+        for command in commands:
+            # The id is still marked in progress, which would make submit drop the rerun
+            self.seen.pop(command.get('id'), None)
+            await self.submit(command)
+    
+    def add_result(self, command_id: str, result: Dict[str, Any]):
+        """Queue a finished result for delivery"""
+        with self.results_lock:
+            self.pending_results.append({
+                "command_id": command_id,
+                "result": result,
+                "timestamp": datetime.now().isoformat(),
+                "queued_at": time.monotonic()
+            })
+    
+    def take_results(self, max_age: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Remove and return pending results, or none unless the oldest is max_age old"""
+        with self.results_lock:
+            if not self.pending_results:
+                return []
+            if max_age is not None and time.monotonic() - self.pending_results[0]["queued_at"] < max_age:
+                return []
+            results = self.pending_results
+            self.pending_results = []
+        return results
+    
+    def restore_results(self, results: List[Dict[str, Any]]):
+        """Put back results whose delivery failed"""
+        with self.results_lock:
+            self.pending_results = results + self.pending_results
+    
+    def has_work(self) -> bool:
+        """Return True while commands are queued, running or awaiting result delivery"""
+        with self.results_lock:
+            if self.pending_results:
+                return True
+        return bool(self.queue) or any(self.running.values())
+
+
+class ImageDownloader:
+    """Streaming, resumable downloader that hashes image data while writing it"""
+    
+    def __init__(self, transport: AgentTransport, download_dir: str,
+                 chunk_size: int = 1024 * 1024, sync_bytes: int = 32 * 1024 * 1024,
+                 retries: int = 3, throttle=None):
+        self.transport = transport
+        self.download_dir = Path(download_dir)
+        self.chunk_size = chunk_size
+        self.sync_bytes = sync_bytes
+        self.retries = retries
+        # Called with the size of every received block; may sleep to cap bandwidth
+        self.throttle = throttle
+        self.download_dir.mkdir(parents=True, exist_ok=True)
+    
+    def download(self, url: str, expected_sha256: str, progress=None) -> Path:
+        """Download url into the download directory and return the verified file path"""
+        target = self.download_dir / f"{expected_sha256}.img"
+        if target.exists():
+            return target
+        
+        part_path = target.with_suffix(".part")
+        state_path = target.with_suffix(".state")
+        
+        for attempt in range(self.retries + 1):
+            try:
+                digest = self.fetch(url, part_path, state_path, progress)
+                break
+            except requests.exceptions.RequestException as e:
+                if attempt == self.retries:
+                    raise
+                logger.warning(f"Download interrupted ({e}), resuming (attempt {attempt + 1})")
+                time.sleep(min(30, 2 ** attempt))
+        
+        if digest != expected_sha256:
+            part_path.unlink()
+            state_path.unlink(missing_ok=True)
+            raise ValueError("Image hash mismatch")
+        
+        os.replace(part_path, target)
+        state_path.unlink(missing_ok=True)
+        return target
+    
+    def load_state(self, url: str, part_path: Path, state_path: Path) -> Dict[str, Any]:
+        """Return the resume state of a previous partial download of url"""
+        try:
+            state = json.loads(state_path.read_text())
+            if state.get("url") == url and part_path.exists():
+                return state
+        except (OSError, ValueError):
+            pass
+        return {"url": url, "etag": None, "size": None, "written": 0}
+    
+    def save_state(self, state: Dict[str, Any], state_path: Path):
+        tmp_path = state_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(state))
+        os.replace(tmp_path, state_path)
+    
+    def fetch(self, url: str, part_path: Path, state_path: Path, progress=None) -> str:
+        """Stream url into part_path, resuming where the last attempt stopped"""
+        state = self.load_state(url, part_path, state_path)
+        hasher = hashlib.sha256()
+        written = state["written"]
+        
+        headers = {}
+        if written:
+            headers["Range"] = f"bytes={written}-"
+            if state["etag"]:
+                headers["If-Range"] = state["etag"]
+        
+        with self.transport.get("download", url, stream=True, headers=headers) as response:
+            # 416 on a resume means everything was already on disk
+            complete = bool(written) and response.status_code == 416 and written == state["size"]
+            if written and response.status_code == 416 and not complete:
+                # The partial file does not match the image; drop it so the retry starts over
+                part_path.unlink(missing_ok=True)
+                state_path.unlink(missing_ok=True)
+                raise requests.exceptions.HTTPError(
+                    "Range not satisfiable for partial download, discarded it", response=response)
+            if not complete and not (written and response.status_code == 206):
+                response.raise_for_status()
+                # The server ignored the range or the image changed; start over
+                written = 0
+            
+            if written:
+                self.hash_existing(part_path, written, hasher)
+            else:
+                content_length = response.headers.get("Content-Length")
+                state = {
+                    "url": url,
+                    "etag": response.headers.get("ETag"),
+                    "size": int(content_length) if content_length else None,
+                    "written": 0
+                }
+            
+            size = state["size"]
+            mode = 'r+b' if written and part_path.exists() else 'w+b'
+            with open(part_path, mode) as f:
+                if not written and size:
+                    try:
+                        os.posix_fallocate(f.fileno(), 0, size)
+                    except OSError as e:
+                        if e.errno == errno.ENOSPC:
+                            raise
+                        logger.debug(f"Could not preallocate download: {e}")
+                
+                f.seek(written)
+                synced = written
+                
+                if not complete:
+                    for chunk in self.transport.iter_content(response, self.chunk_size):
+                        f.write(chunk)
+                        hasher.update(chunk)
+                        written += len(chunk)
+                        if self.throttle:
+                            self.throttle(len(chunk))
+                        
+                        if written - synced >= self.sync_bytes:
+                            f.flush()
+                            os.fsync(f.fileno())
+                            synced = written
+                            state["written"] = written
+                            self.save_state(state, state_path)
+                        
+                        if progress:
+                            progress(written, size)
+                
+                f.truncate(written)
+                f.flush()
+                os.fsync(f.fileno())
+        
+        state["written"] = written
+        self.save_state(state, state_path)
+        return hasher.hexdigest()
+    
+    def hash_existing(self, path: Path, length: int, hasher):
+        """Feed the first length bytes of an existing partial file into hasher"""
+        with open(path, 'rb') as f:
+            remaining = length
+            while remaining > 0:
+                chunk = f.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                remaining -= len(chunk)
+
+
+class ContentChunker:
+    """Content-defined chunking with a gear rolling hash (FastCDC-style)"""
+    
+    def __init__(self, min_size: int = 16 * 1024, avg_size: int = 64 * 1024,
+                 max_size: int = 256 * 1024, seed: int = 0x56444931):
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        self.seed = seed
+        
+        rng = random.Random(seed)
+        self.gear = [rng.getrandbits(64) for _ in range(256)]
+        # Test the high bits, which depend on the whole 64-byte window
+        bits = avg_size.bit_length() - 1
+        self.mask = ((1 << bits) - 1) << (64 - bits)
+    
+    @classmethod
+    def from_params(cls, params: Dict[str, int]) -> 'ContentChunker':
+        return cls(params["min_size"], params["avg_size"], params["max_size"], params["seed"])
+    
+    def params(self) -> Dict[str, int]:
+        return {
+            "min_size": self.min_size,
+            "avg_size": self.avg_size,
+            "max_size": self.max_size,
+            "seed": self.seed
+        }
+    
+    def cut_point(self, data, start: int, available: int) -> int:
+        """Return the length of the chunk beginning at data[start]"""
+        if available <= self.min_size:
+            return available
+        
+        end = start + min(available, self.max_size)
+        gear = self.gear
+        mask = self.mask
+        h = 0
+        for i in range(start + self.min_size, end):
+            h = ((h << 1) + gear[data[i]]) & 0xFFFFFFFFFFFFFFFF
+            if not h & mask:
+                return i + 1 - start
+        return end - start
+    
+    def build_index(self, path: str, read_size: int = 4 * 1024 * 1024) -> Dict[str, Any]:
+        """Chunk a file and return its chunk index.
+
+        The gear hash runs per byte in Python, roughly 5-10 MB/s of CPU on a small
+        client core, so a full image takes minutes. It is only a fallback: the agent
+        keeps the index published with each installed image, and update_image runs
+        at background priority.
+        """
+        chunks = []
+        file_hash = hashlib.sha256()
+        buffer = bytearray()
+        start = 0
+        offset = 0
+        eof = False
+        
+        with open(path, 'rb') as f:
+            while True:
+                if not eof and len(buffer) - start < self.max_size:
+                    del buffer[:start]
+                    start = 0
+                    block = f.read(read_size)
+                    if block:
+                        buffer += block
+                        file_hash.update(block)
+                    else:
+                        eof = True
+                    continue
+                
+                available = len(buffer) - start
+                if available == 0:
+                    break
+                
+                length = self.cut_point(buffer, start, available)
+                digest = hashlib.sha256(memoryview(buffer)[start:start + length]).hexdigest()
+                chunks.append([offset, length, digest])
+                offset += length
+                start += length
+        
+        return {
+            "version": 1,
+            "chunker": self.params(),
+            "size": offset,
+            "sha256": file_hash.hexdigest(),
+            "chunks": chunks
+        }
+
+
+def chunk_index_url(image_url: str) -> str:
+    """Return the URL of the chunk index published next to an image, keeping its query"""
+    parts = urlsplit(image_url)
+    return urlunsplit(parts._replace(path=parts.path + ".chunks.json", fragment=""))
+
+
+def file_sha256(path: str, read_size: int = 1024 * 1024) -> str:
+    """Return the SHA-256 of a file without loading it into memory"""
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(read_size), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+class DeltaImageUpdater:
+    """Rebuilds a new image from the installed one, fetching only missing chunks"""
+    
+    def __init__(self, transport: AgentTransport, current_image: str, index_cache: str,
+                 coalesce_gap: int = 64 * 1024, max_range_bytes: int = 8 * 1024 * 1024,
+                 peer_cache: Optional['PeerCache'] = None, throttle=None):
+        self.transport = transport
+        self.peer_cache = peer_cache
+        self.throttle = throttle
+        self.current_image = Path(current_image)
+        self.index_cache = Path(index_cache)
+        self.coalesce_gap = coalesce_gap
+        self.max_range_bytes = max_range_bytes
+        self.stats = {}
+    
+    def fetch_index(self, index_url: str) -> Dict[str, Any]:
+        """Download the chunk index published next to the new image"""
+        with self.transport.get("download", index_url) as response:
+            response.raise_for_status()
+            return response.json()
+    
+    def local_index(self, chunker: ContentChunker) -> Dict[str, Any]:
+        """Return the chunk index of the installed image, chunking it only when needed"""
+        if not self.current_image.exists():
+            return {"chunks": []}
+        
+        try:
+            cached = json.loads(self.index_cache.read_text())
+            if (cached.get("chunker") == chunker.params()
+                    and cached.get("size") == self.current_image.stat().st_size
+                    and cached.get("sha256") == file_sha256(str(self.current_image))):
+                return cached
+        except (OSError, ValueError):
+            pass
+        
+        logger.info(f"No published index for installed image {self.current_image}, chunking it locally")
+        started = time.monotonic()
+        index = chunker.build_index(str(self.current_image))
+        logger.info(f"Chunked {index['size']} bytes in {time.monotonic() - started:.1f}s")
+        self.save_index(index, self.index_cache)
+        return index
+    
+    @staticmethod
+    def save_index(index: Dict[str, Any], path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(index, separators=(',', ':')))
+        os.replace(tmp_path, path)
+    
+    def plan_ranges(self, chunks: List[list], local: Dict[str, tuple]) -> List[tuple]:
+        """Group missing chunks into coalesced (start, end, [chunk indexes]) byte ranges"""
+        ranges = []
+        for position, (offset, length, digest) in enumerate(chunks):
+            if digest in local:
+                continue
+            if ranges:
+                start, end, members = ranges[-1]
+                if offset - end <= self.coalesce_gap and offset + length - start <= self.max_range_bytes:
+                    ranges[-1] = (start, offset + length, members + [position])
+                    continue
+            ranges.append((offset, offset + length, [position]))
+        return ranges
+    
+    def fetch_range(self, image_url: str, start: int, end: int) -> bytes:
+        """Fetch bytes [start, end) of the new image"""
+        headers = {"Range": f"bytes={start}-{end - 1}"}
+        with self.transport.get("download", image_url, headers=headers, stream=True) as response:
+            if response.status_code != 206:
+                raise ValueError(f"Server did not honour range request (status {response.status_code})")
+            data = bytearray()
+            for block in self.transport.iter_content(response, 1024 * 1024):
+                data += block
+                if self.throttle:
+                    self.throttle(len(block))
+            data = bytes(data)
+        if len(data) != end - start:
+            raise ValueError("Short range response")
+        return data
+    
+    def fetch_missing(self, image_url: str, chunks: List[list], byte_range: tuple,
+                      image_sha256: str) -> Dict[int, bytes]:
+        """Fetch one coalesced range and split it into verified chunks"""
+        _, _, members = byte_range
+        fetched = {}
+        
+        # Neighbours first; the origin only serves what no peer had
+        if self.peer_cache is not None:
+            for position in members:
+                chunk = self.peer_cache.fetch_chunk(chunks[position][2], chunks[position][1], image_sha256)
+                if chunk is not None:
+                    fetched[position] = chunk
+                    self.stats["bytes_from_peers"] += len(chunk)
+                    if self.throttle:
+                        self.throttle(len(chunk))
+            members = [position for position in members if position not in fetched]
+            if not members:
+                return fetched
+        
+        start = chunks[members[0]][0]
+        end = chunks[members[-1]][0] + chunks[members[-1]][1]
+        data = self.fetch_range(image_url, start, end)
+        self.stats["bytes_downloaded"] += len(data)
+        
+        for position in members:
+            offset, length, digest = chunks[position]
+            chunk = data[offset - start:offset - start + length]
+            if hashlib.sha256(chunk).hexdigest() != digest:
+                raise ValueError(f"Chunk {position} failed verification")
+            fetched[position] = chunk
+        return fetched
+    
+    def update(self, image_url: str, index_url: str, expected_sha256: str,
+               output_path: Path, progress=None) -> Dict[str, Any]:
+        """Assemble the new image at output_path and return transfer statistics"""
+        index = self.fetch_index(index_url)
+        if index.get("sha256") != expected_sha256:
+            raise ValueError("Chunk index does not describe the requested image")
+        
+        chunker = ContentChunker.from_params(index["chunker"])
+        local = {digest: (offset, length)
+                 for offset, length, digest in self.local_index(chunker)["chunks"]}
+        
+        chunks = index["chunks"]
+        ranges = self.plan_ranges(chunks, local)
+        range_for = {members[0]: (start, end, members) for start, end, members in ranges}
+        self.stats = {
+            "chunks_total": len(chunks),
+            "chunks_reused": sum(1 for chunk in chunks if chunk[2] in local),
+            "ranges": len(ranges),
+            "bytes_downloaded": 0,
+            "bytes_from_peers": 0,
+            "bytes_reused": 0
+        }
+        
+        hasher = hashlib.sha256()
+        fetched = {}
+        written = 0
+        tmp_path = output_path.with_suffix(".delta")
+        
+        current = open(self.current_image, 'rb') if local else None
+        try:
+            # The preallocated file must not outlive a failed attempt on a small disk
+            with open(tmp_path, 'wb') as out:
+                os.posix_fallocate(out.fileno(), 0, index["size"])
+                for position, (offset, length, digest) in enumerate(chunks):
+                    if position in range_for:
+                        fetched.update(self.fetch_missing(
+                            image_url, chunks, range_for[position], expected_sha256))
+                    
+                    chunk = fetched.pop(position, None)
+                    if chunk is None:
+                        local_offset, local_length = local[digest]
+                        current.seek(local_offset)
+                        chunk = current.read(local_length)
+                        if hashlib.sha256(chunk).hexdigest() != digest:
+                            raise ValueError("Installed image changed during delta update")
+                        self.stats["bytes_reused"] += length
+                    
+                    out.write(chunk)
+                    hasher.update(chunk)
+                    written += length
+                    if progress:
+                        progress(written, index["size"])
+                
+                out.flush()
+                os.fsync(out.fileno())
+            
+            if hasher.hexdigest() != expected_sha256:
+                raise ValueError("Image hash mismatch")
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+        finally:
+            if current is not None:
+                current.close()
+        
+        os.replace(tmp_path, output_path)
+        self.save_index(index, output_path.with_suffix(".chunks.json"))
+        return self.stats
+
+
+class PeerChunkHandler:
+    """Serves verified image chunks to agents on the same subnet.
+
+    Mixed into http.server.BaseHTTPRequestHandler when the peer cache starts.
+    """
+    
+    def do_GET(self):
+        peer_cache = self.server.peer_cache
+        
+        if self.path.startswith('/chunks/'):
+            if peer_cache.busy is not None and peer_cache.busy():
+                # Leave the bandwidth to the local user; the peer tries another source
+                self.send_error(503)
+                return
+            chunk = peer_cache.read_chunk(self.path[len('/chunks/'):])
+            if chunk is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(chunk)))
+            self.end_headers()
+            self.wfile.write(chunk)
+            peer_cache.count_transfer(len(chunk))
+        elif self.path == '/images':
+            body = json.dumps(sorted(peer_cache.images)).encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            peer_cache.count_transfer(len(body))
+        else:
+            self.send_error(404)
+    
+    def log_message(self, format, *args):
+        logger.debug(f"Peer cache {self.address_string()}: {format % args}")
+
+
+class PeerCache:
+    """Opt-in LAN cache that shares verified image chunks between agents"""
+    
+    def __init__(self, device_id: str, transport: AgentTransport, config: Dict[str, Any]):
+        self.device_id = device_id
+        self.transport = transport
+        self.bind_address = config.get("peer_cache_bind", "0.0.0.0")
+        self.port = config.get("peer_cache_port", 8765)
+        self.discovery_port = config.get("peer_cache_discovery_port", 8766)
+        self.broadcast_address = config.get("peer_cache_broadcast", "255.255.255.255")
+        self.beacon_interval = config.get("peer_cache_beacon_interval", 30)
+        self.static_peers = list(config.get("peer_cache_peers", []))
+        self.peer_ttl = self.beacon_interval * 3
+        
+        self.lock = threading.Lock()
+        self.chunks = {}
+        self.images = set()
+        self.peers = {}
+        self.stop_event = threading.Event()
+        self.server = None
+        self.threads = []
+        # Called with the size of every chunk served to a peer
+        self.on_transfer = None
+        # Returns True while chunks must not be served, e.g. during an active RDP session
+        self.busy = None
+    
+    def start(self):
+        """Start serving chunks and exchanging discovery beacons"""
+        handler = type("PeerChunkRequestHandler", (PeerChunkHandler, http_server.BaseHTTPRequestHandler), {})
+        self.server = http_server.ThreadingHTTPServer((self.bind_address, self.port), handler)
+        self.server.daemon_threads = True
+        self.server.peer_cache = self
+        self.port = self.server.server_address[1]
+        
+        self.threads = [
+            threading.Thread(target=self.server.serve_forever, name="peer-cache-http", daemon=True),
+            threading.Thread(target=self.beacon_loop, name="peer-cache-beacon", daemon=True),
+            threading.Thread(target=self.listen_loop, name="peer-cache-discovery", daemon=True)
+        ]
+        for thread in self.threads:
+            thread.start()
+        logger.info(f"Peer cache serving on port {self.port}")
+    
+    def stop(self):
+        self.stop_event.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+    
+    def count_transfer(self, amount: int):
+        if self.on_transfer is not None:
+            self.on_transfer(amount)
+    
+    def register_image(self, index: Dict[str, Any], image_path: Path):
+        """Make the chunks of a verified image available to peers"""
+        with self.lock:
+            for offset, length, digest in index["chunks"]:
+                self.chunks[digest] = (str(image_path), offset, length)
+            self.images.add(index["sha256"])
+    
+    def read_chunk(self, digest: str) -> Optional[bytes]:
+        """Return a local chunk, re-verified so a changed file is never served"""
+        with self.lock:
+            location = self.chunks.get(digest)
+        if location is None:
+            return None
+        
+        path, offset, length = location
+        try:
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                chunk = f.read(length)
+        except OSError:
+            chunk = b""
+        
+        if hashlib.sha256(chunk).hexdigest() != digest:
+            with self.lock:
+                self.chunks.pop(digest, None)
+            return None
+        return chunk
+    
+    def peers_for(self, image_sha256: str) -> List[str]:
+        """Return peers that advertise the image, plus statically configured ones"""
+        now = time.monotonic()
+        with self.lock:
+            discovered = [address for address, (images, seen) in self.peers.items()
+                          if now - seen < self.peer_ttl and image_sha256 in images]
+        candidates = discovered + [peer for peer in self.static_peers if peer not in discovered]
+        random.shuffle(candidates)
+        return candidates
+    
+    def fetch_chunk(self, digest: str, length: int, image_sha256: str) -> Optional[bytes]:
+        """Fetch and verify a chunk of the given length from the first peer that has it"""
+        for peer in self.peers_for(image_sha256):
+            try:
+                with self.transport.get("peer", f"http://{peer}/chunks/{digest}", stream=True) as response:
+                    if response.status_code != 200:
+                        continue
+                    # Any LAN host can pose as a peer, so never read more than the index allows
+                    chunk = bytearray()
+                    for block in self.transport.iter_content(response, 64 * 1024):
+                        chunk += block
+                        if len(chunk) > length:
+                            break
+            except requests.exceptions.RequestException as e:
+                logger.debug(f"Peer {peer} unavailable: {e}")
+                continue
+            
+            if len(chunk) != length:
+                logger.warning(f"Peer {peer} served a chunk of the wrong size")
+                continue
+            chunk = bytes(chunk)
+            if hashlib.sha256(chunk).hexdigest() == digest:
+                return chunk
+            logger.warning(f"Peer {peer} served a corrupt chunk")
+        return None
+    
+    def discovery_socket(self) -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, "SO_REUSEPORT"):
+            # Several agents on one host (loopback testing) share the discovery port
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        return sock
+    
+    def beacon_loop(self):
+        """Periodically advertise the images this agent can serve"""
+        sock = self.discovery_socket()
+        try:
+            while not self.stop_event.is_set():
+                with self.lock:
+                    images = sorted(self.images)
+                if images:
+                    beacon = json.dumps({
+                        "device_id": self.device_id,
+                        "port": self.port,
+                        "images": images
+                    }).encode('utf-8')
+                    try:
+                        sock.sendto(beacon, (self.broadcast_address, self.discovery_port))
+                    except OSError as e:
+                        logger.debug(f"Peer cache beacon failed: {e}")
+                self.stop_event.wait(self.beacon_interval)
+        finally:
+            sock.close()
+    
+    def listen_loop(self):
+        """Record beacons from other agents"""
+        sock = self.discovery_socket()
+        try:
+            sock.bind(("", self.discovery_port))
+            sock.settimeout(1.0)
+            while not self.stop_event.is_set():
+                try:
+                    data, (host, _) = sock.recvfrom(65535)
+                    beacon = json.loads(data)
+                    # Anything on the LAN can send to this port; ignore malformed beacons
+                    if not isinstance(beacon, dict) or beacon.get("device_id") == self.device_id:
+                        continue
+                    port = int(beacon["port"])
+                    images = set(str(image) for image in beacon.get("images", []))
+                    if not 0 < port < 65536:
+                        continue
+                except socket.timeout:
+                    continue
+                except (OSError, ValueError, TypeError, KeyError):
+                    continue
+                
+                with self.lock:
+                    self.peers[f"{host}:{port}"] = (images, time.monotonic())
+        except OSError as e:
+            logger.warning(f"Peer cache discovery disabled: {e}")
+        finally:
+            sock.close()
+
+
+class OutputRingBuffer:
+    """Keeps the most recent bytes of a command output stream up to a fixed cap"""
+    
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.buffer = bytearray()
+        self.total_bytes = 0
+    
+    def append(self, data: bytes):
+        self.total_bytes += len(data)
+        self.buffer += data
+        overflow = len(self.buffer) - self.max_bytes
+        if overflow > 0:
+            del self.buffer[:overflow]
+    
+    @property
+    def truncated(self) -> bool:
+        return self.total_bytes > len(self.buffer)
+    
+    def text(self) -> str:
+        return self.buffer.decode('utf-8', errors='replace')
+
+
+class OutputForwarder:
+    """Forwards command output to the server in chunks while the command runs"""
+    
+    def __init__(self, agent, command_id: Optional[str], flush_interval: float, chunk_bytes: int):
+        self.agent = agent
+        self.command_id = command_id
+        self.enabled = command_id is not None and "command_output" in agent.server_capabilities
+        self.flush_interval = flush_interval
+        self.chunk_bytes = chunk_bytes
+        self.pending = {}
+        self.pending_bytes = 0
+        self.decoders = {}
+        self.offsets = {}
+        self.seq = 0
+        self.last_flush = time.monotonic()
+    
+    def add(self, stream: str, data: bytes):
+        if not self.enabled:
+            return
+        decoder = self.decoders.setdefault(stream, codecs.getincrementaldecoder('utf-8')(errors='replace'))
+        self.pending[stream] = self.pending.get(stream, "") + decoder.decode(data)
+        self.pending_bytes += len(data)
+        self.offsets[stream] = self.offsets.get(stream, 0) + len(data)
+    
+    def maybe_flush(self):
+        if self.pending_bytes >= self.chunk_bytes or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+    
+    def flush(self, final: bool = False):
+        """Send buffered output; the final flush also closes the stream on the server"""
+        self.last_flush = time.monotonic()
+        if not self.enabled or not (self.pending or final):
+            return
+        
+        for stream, decoder in self.decoders.items():
+            if final:
+                self.pending[stream] = self.pending.get(stream, "") + decoder.decode(b"", final=True)
+        
+        chunk = {
+            "command_id": self.command_id,
+            "seq": self.seq,
+            "output": self.pending,
+            "offsets": dict(self.offsets),
+            "final": final
+        }
+        self.seq += 1
+        self.pending = {}
+        self.pending_bytes = 0
+        
+        try:
+            self.agent.transport.post_json(
+                "command_result",
+                f"/api/devices/{self.agent.device_id}/command-output",
+                chunk
+            )
+        except Exception as e:
+            logger.debug(f"Failed to forward output of {self.command_id}: {e}")
+
+
+class LogShipper:
+    """Incremental log reader with persistent per-file cursors that survive rotation.
+
+    Reads return the cursor they would advance to; cursors only move once the
+    caller commits them after the lines were delivered.
+    """
+    
+    BOOT_ID_PATH = '/proc/sys/kernel/random/boot_id'
+    
+    def __init__(self, cursor_path: str, block_size: int = 64 * 1024, max_pending: int = 16):
+        self.cursor_path = Path(cursor_path)
+        self.block_size = block_size
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        # key (command id) -> cursors waiting for the result carrying their lines to be acknowledged
+        self.pending = OrderedDict()
+        try:
+            self.cursors = json.loads(self.cursor_path.read_text())
+        except (OSError, ValueError):
+            self.cursors = {}
+    
+    def save(self):
+        """Atomically persist the cursors"""
+        self.cursor_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.cursor_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(self.cursors))
+        os.replace(tmp_path, self.cursor_path)
+    
+    def commit(self, cursors: Dict[str, Dict[str, Any]]):
+        """Advance and persist cursors whose lines were delivered"""
+        with self.lock:
+            self.cursors.update(cursors)
+            self.save()
+    
+    def stage(self, key: Any, cursors: Dict[str, Dict[str, Any]]):
+        """Hold cursors until acknowledge(key) confirms their lines were delivered"""
+        with self.lock:
+            self.pending[key] = cursors
+            while len(self.pending) > self.max_pending:
+                self.pending.popitem(last=False)
+    
+    def acknowledge(self, key: Any):
+        """Commit the cursors staged under key; older staged reads are superseded"""
+        with self.lock:
+            if key not in self.pending:
+                return
+            while True:
+                staged_key, cursors = self.pending.popitem(last=False)
+                if staged_key == key:
+                    break
+        self.commit(cursors)
+    
+    @classmethod
+    def boot_id(cls) -> Optional[str]:
+        try:
+            with open(cls.BOOT_ID_PATH, 'r') as f:
+                return f.read().strip()
+        except OSError:
+            return None
+    
+    def tail(self, path: str, lines: int, end: int) -> List[str]:
+        """Return the last lines before byte offset end, reading backwards in blocks"""
+        data = b""
+        position = end
+        with open(path, 'rb') as f:
+            while position > 0 and data.count(b"\n") <= lines:
+                read_size = min(self.block_size, position)
+                position -= read_size
+                f.seek(position)
+                data = f.read(read_size) + data
+        return [line.decode('utf-8', errors='replace') for line in data.splitlines()[-lines:]]
+    
+    def read_range(self, path: str, start: int, max_bytes: int, split_long: bool = True) -> tuple:
+        """Read complete lines from start, returning (lines, new offset, hit max_bytes).
+
+        A line longer than max_bytes is split unless split_long is False, in which
+        case nothing is read and the line is left for a call with a larger budget.
+        """
+        with open(path, 'rb') as f:
+            f.seek(start)
+            data = f.read(max_bytes)
+        
+        # Leave a partially written last line for the next read
+        capped = len(data) == max_bytes
+        end = data.rfind(b"\n") + 1
+        if end == 0 and not (capped and split_long):
+            return [], start, capped
+        if end == 0:
+            end = len(data)
+        lines = data[:end].decode('utf-8', errors='replace').splitlines()
+        return lines, start + end, capped
+    
+    def find_rotated(self, path: str, inode: int) -> Optional[str]:
+        """Find the rotated copy of path that still has the old inode"""
+        for candidate in sorted(Path(path).parent.glob(Path(path).name + ".*")):
+            try:
+                if candidate.stat().st_ino == inode:
+                    return str(candidate)
+            except OSError:
+                continue
+        return None
+    
+    def read_new(self, path: str, initial_lines: int, max_bytes: int) -> Dict[str, Any]:
+        """Return lines appended to path since the committed cursor, and the cursor after them"""
+        with self.lock:
+            cursor = self.cursors.get(path)
+        st = os.stat(path)
+        lines = []
+        
+        if cursor is None:
+            # First pull: start from the tail instead of the whole file
+            lines = self.tail(path, initial_lines, st.st_size)
+            return {"lines": lines, "more": False, "cursor": {"inode": st.st_ino, "offset": st.st_size}}
+        
+        offset = cursor["offset"]
+        if cursor["inode"] != st.st_ino:
+            rotated = self.find_rotated(path, cursor["inode"])
+            if rotated is not None:
+                lines, rotated_offset, capped = self.read_range(rotated, offset, max_bytes)
+                if capped:
+                    # Finish the rotated file on the next call before moving to the new one
+                    return {"lines": lines, "more": True,
+                            "cursor": {"inode": cursor["inode"], "offset": rotated_offset}}
+            offset = 0
+        elif st.st_size < offset:
+            # Truncated in place (copytruncate)
+            offset = 0
+        
+        new_lines, offset, capped = self.read_range(
+            path, offset, max(0, max_bytes - sum(map(len, lines))), split_long=not lines)
+        lines.extend(new_lines)
+        return {"lines": lines, "more": capped, "cursor": {"inode": st.st_ino, "offset": offset}}
+    
+    def read_kmsg(self, initial_lines: int, max_records: int) -> Optional[Dict[str, Any]]:
+        """Return kernel messages newer than the committed sequence number, or None without /dev/kmsg"""
+        try:
+            fd = os.open('/dev/kmsg', os.O_RDONLY | os.O_NONBLOCK)
+        except OSError:
+            return None
+        
+        # Sequence numbers restart at every boot, so the cursor only applies to its own boot
+        boot_id = self.boot_id()
+        with self.lock:
+            cursor = self.cursors.get('/dev/kmsg')
+        if cursor is None:
+            last_seq = None
+        elif cursor.get("boot_id") != boot_id:
+            last_seq = -1
+        else:
+            last_seq = cursor["seq"]
+        
+        # First pull keeps the newest records; later pulls stop at the cap and resume from there
+        records = deque(maxlen=initial_lines) if last_seq is None else []
+        more = False
+        try:
+            while True:
+                try:
+                    record = os.read(fd, 8192)
+                except OSError as e:
+                    if e.errno == errno.EPIPE:
+                        # Records were overwritten while reading; continue with the next
+                        continue
+                    if e.errno == errno.EAGAIN:
+                        break
+                    raise
+                
+                header, _, message = record.decode('utf-8', errors='replace').partition(';')
+                fields = header.split(',')
+                seq = int(fields[1])
+                if last_seq is not None:
+                    if seq <= last_seq:
+                        continue
+                    if len(records) >= max_records:
+                        more = True
+                        break
+                records.append((seq, f"[{int(fields[2]) / 1e6:.6f}] {(message.splitlines() or [''])[0]}"))
+        finally:
+            os.close(fd)
+        
+        seq = records[-1][0] if records else (last_seq if last_seq is not None else -1)
+        return {
+            "lines": [line for _, line in records],
+            "more": more,
+            "cursor": {"boot_id": boot_id, "seq": seq}
+        }
+
+
+class CommandChannel(threading.Thread):
+    """Long-poll push channel that delivers commands as soon as the server queues them.
+
+    Heartbeat piggybacking keeps working alongside it, and commands that arrive
+    on both paths are deduplicated by the command executor.
+    """
+    
+    # Servers without the endpoint answer with one of these
+    UNSUPPORTED_STATUSES = (404, 405, 501)
+    
+    def __init__(self, transport: AgentTransport, device_id: str, on_command, config: Dict[str, Any]):
+        super().__init__(name="command-channel", daemon=True)
+        self.transport = transport
+        self.url = f"{transport.server_url}/api/devices/{device_id}/commands/poll"
+        self.on_command = on_command
+        self.wait = config.get("command_channel_wait", 55)
+        self.backoff_max = config.get("command_channel_backoff_max", 60)
+        self.unsupported_retry = config.get("command_channel_unsupported_retry", 3600)
+        self.cursor = None
+        self.connected = False
+        self.failures = 0
+        self.stop_event = threading.Event()
+    
+    def run(self):
+        while not self.stop_event.is_set():
+            delay = self.poll()
+            if delay:
+                self.stop_event.wait(delay)
+    
+    def stop(self):
+        self.stop_event.set()
+    
+    def poll(self) -> float:
+        """Hold one long-poll request open and return the delay before the next one"""
+        params = {"wait": self.wait}
+        if self.cursor is not None:
+            params["cursor"] = self.cursor
+        # The read timeout must outlast the server's hold time
+        connect_timeout = self.transport.timeout_for("command_poll")
+        if isinstance(connect_timeout, tuple):
+            connect_timeout = connect_timeout[0]
+        
+        try:
+            response = self.transport.get("command_poll", self.url, params=params,
+                                          timeout=(connect_timeout, self.wait + 15))
+        except requests.exceptions.RequestException as e:
+            logger.debug(f"Command channel request failed: {e}")
+            return self.backoff()
+        
+        if response.status_code in self.UNSUPPORTED_STATUSES:
+            if self.connected or self.failures == 0:
+                logger.info("Server has no command channel, relying on heartbeat delivery")
+            self.connected = False
+            self.failures = 0
+            return self.unsupported_retry
+        if response.status_code == 204:
+            self.mark_connected()
+            return 0
+        if response.status_code != 200:
+            logger.warning(f"Command channel poll failed with status {response.status_code}")
+            return self.backoff()
+        
+        try:
+            data = response.json()
+        except ValueError as e:
+            logger.warning(f"Invalid command channel response: {e}")
+            return self.backoff()
+        
+        self.mark_connected()
+        self.cursor = data.get("cursor", self.cursor)
+        commands = data.get("commands", [])
+        if commands:
+            logger.info(f"Received {len(commands)} commands over the command channel")
+        for command in commands:
+            self.on_command(command)
+        return 0
+    
+    def mark_connected(self):
+        if not self.connected:
+            logger.info("Command channel connected")
+        self.connected = True
+        self.failures = 0
+    
+    def backoff(self) -> float:
+        """Jittered exponential reconnect delay"""
+        if self.connected:
+            logger.warning("Command channel lost, falling back to heartbeat delivery until it reconnects")
+        self.connected = False
+        self.failures += 1
+        delay = min(self.backoff_max, 2 ** min(self.failures - 1, 10))
+        return random.uniform(delay / 2, delay)
+
+
+class RDPSessionTracker:
+    """Tracks xfreerdp processes from proc connector events, or /proc PID diffs as a fallback"""
+    
+    NETLINK_CONNECTOR = 11
+    CN_IDX_PROC = 1
+    CN_VAL_PROC = 1
+    PROC_CN_MCAST_LISTEN = 1
+    PROC_EVENT_EXEC = 0x00000002
+    PROC_EVENT_EXIT = 0x80000000
+    NLMSG_DONE = 3
+    
+    def __init__(self, on_change=None, poll_interval: float = 2.0, process_name: str = "xfreerdp",
+                 max_events: int = 256):
+        self.on_change = on_change
+        self.poll_interval = poll_interval
+        self.process_name = process_name
+        self.sessions = {}
+        self.known_pids = set()
+        # Oldest events are dropped if heartbeats fail for a long time
+        self.events = deque(maxlen=max_events)
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.mode = None
+        self.clock_ticks = os.sysconf('SC_CLK_TCK')
+        self.boot_time = None
+    
+    def start(self):
+        """Scan once, then follow process events in a background thread"""
+        self.boot_time = psutil.boot_time()
+        sock = self.open_proc_connector()
+        self.mode = "proc_connector" if sock is not None else "pid_diff"
+        self.rescan()
+        target = (lambda: self.run_proc_connector(sock)) if sock is not None else self.run_pid_diff
+        threading.Thread(target=target, name="rdp-session-tracker", daemon=True).start()
+        logger.info(f"RDP session tracker started ({self.mode})")
+    
+    def stop(self):
+        self.stop_event.set()
+    
+    def open_proc_connector(self) -> Optional[socket.socket]:
+        """Subscribe to kernel exec/exit events; needs CAP_NET_ADMIN"""
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, self.NETLINK_CONNECTOR)
+            sock.bind((os.getpid(), self.CN_IDX_PROC))
+            op = struct.pack("=I", self.PROC_CN_MCAST_LISTEN)
+            cn_msg = struct.pack("=IIIIHH", self.CN_IDX_PROC, self.CN_VAL_PROC, 0, 0, len(op), 0) + op
+            nlmsg = struct.pack("=IHHII", 16 + len(cn_msg), self.NLMSG_DONE, 0, 0, os.getpid()) + cn_msg
+            sock.send(nlmsg)
+            sock.settimeout(1.0)
+            return sock
+        except (OSError, AttributeError) as e:
+            logger.debug(f"Proc connector unavailable: {e}")
+            return None
+    
+    def is_rdp_client(self, pid: int) -> bool:
+        try:
+            with open(f'/proc/{pid}/comm', 'r') as f:
+                return self.process_name in f.read()
+        except OSError:
+            return False
+    
+    def inspect(self, pid: int) -> Optional[Dict[str, Any]]:
+        """Parse a process if it is an RDP client"""
+        if not self.is_rdp_client(pid):
+            return None
+        try:
+            with open(f'/proc/{pid}/cmdline', 'rb') as f:
+                cmdline = [arg.decode('utf-8', errors='replace') for arg in f.read().split(b'\0') if arg]
+            with open(f'/proc/{pid}/stat', 'r') as f:
+                # Fields after the parenthesised comm; starttime is field 22
+                start_ticks = int(f.read().rpartition(')')[2].split()[19])
+        except (OSError, ValueError, IndexError):
+            return None
+        
+        session_info = {
+            "pid": pid,
+            "command": ' '.join(cmdline),
+            "started_at": datetime.fromtimestamp(self.boot_time + start_ticks / self.clock_ticks).isoformat(),
+            "status": "active"
+        }
+        for arg in cmdline:
+            if arg.startswith('/v:'):
+                session_info["server"] = arg[3:]
+            elif arg.startswith('/u:'):
+                session_info["username"] = arg[3:]
+            elif arg.startswith('/d:'):
+                session_info["domain"] = arg[3:]
+        return session_info
+    
+    def list_pids(self) -> set:
+        return {int(name) for name in os.listdir('/proc') if name.isdigit()}
+    
+    def rescan(self):
+        """Full /proc scan; used at start and after lost events"""
+        pids = self.list_pids()
+        for pid in pids - self.known_pids:
+            self.process_started(pid)
+        # A launcher can exec the client later under the same PID; its comm changes when it does
+        with self.lock:
+            untracked = (pids & self.known_pids) - set(self.sessions)
+        for pid in untracked:
+            if self.is_rdp_client(pid):
+                self.process_started(pid)
+        for pid in self.known_pids - pids:
+            self.process_exited(pid)
+        self.known_pids = pids
+    
+    def process_started(self, pid: int):
+        session_info = self.inspect(pid)
+        if session_info is None:
+            return
+        with self.lock:
+            known = pid in self.sessions
+            self.sessions[pid] = session_info
+            if known:
+                return
+            self.events.append({"event": "session_start", "timestamp": datetime.now().isoformat(),
+                                "pid": pid, "server": session_info.get("server")})
+        self.notify()
+    
+    def process_exited(self, pid: int):
+        with self.lock:
+            session_info = self.sessions.pop(pid, None)
+            if session_info is None:
+                return
+            self.events.append({"event": "session_end", "timestamp": datetime.now().isoformat(),
+                                "pid": pid, "server": session_info.get("server")})
+        self.notify()
+    
+    def notify(self):
+        if self.on_change is not None:
+            try:
+                self.on_change()
+            except Exception as e:
+                logger.debug(f"RDP session change callback failed: {e}")
+    
+    def run_pid_diff(self):
+        """Inspect new PIDs, and re-check the comm of the others, on each poll"""
+        while not self.stop_event.wait(self.poll_interval):
+            try:
+                self.rescan()
+            except Exception as e:
+                logger.error(f"RDP session scan failed: {e}")
+    
+    def run_proc_connector(self, sock: socket.socket):
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    data = sock.recv(4096)
+                except socket.timeout:
+                    continue
+                except OSError as e:
+                    if e.errno == errno.ENOBUFS:
+                        # Events were dropped; resynchronise from /proc
+                        self.known_pids = set(self.sessions)
+                        self.rescan()
+                        continue
+                    raise
+                
+                offset = 0
+                while offset + 16 <= len(data):
+                    msg_len = struct.unpack_from("=I", data, offset)[0]
+                    if msg_len < 16:
+                        break
+                    # nlmsghdr (16) + cn_msg (20) precede the proc_event
+                    event = offset + 36
+                    if event + 24 <= offset + msg_len:
+                        what = struct.unpack_from("=I", data, event)[0]
+                        pid, tgid = struct.unpack_from("=II", data, event + 16)
+                        if pid == tgid:
+                            if what == self.PROC_EVENT_EXEC:
+                                self.process_started(pid)
+                            elif what == self.PROC_EVENT_EXIT:
+                                self.process_exited(pid)
+                    offset += (msg_len + 3) & ~3
+        except Exception as e:
+            logger.warning(f"Proc connector failed ({e}), falling back to /proc polling")
+            self.mode = "pid_diff"
+            self.known_pids = set()
+            self.rescan()
+            self.run_pid_diff()
+        finally:
+            sock.close()
+    
+    def current_sessions(self) -> List[Dict[str, Any]]:
+        with self.lock:
+            return [dict(session_info) for session_info in self.sessions.values()]
+    
+    def drain_events(self) -> List[Dict[str, Any]]:
+        with self.lock:
+            events = list(self.events)
+            self.events.clear()
+        return events
+
+
+class RDPPerformanceSampler(threading.Thread):
+    """Samples per-session RDP client load and network quality into per-interval histograms"""
+    
+    NETLINK_SOCK_DIAG = 4
+    SOCK_DIAG_BY_FAMILY = 20
+    INET_DIAG_INFO = 2
+    TCP_ESTABLISHED = 1
+    
+    # Upper bucket edges; every histogram has one extra overflow bucket
+    BUCKETS = {
+        "cpu_percent": [5, 10, 25, 50, 75, 100],
+        "rss_mb": [50, 100, 200, 400, 800],
+        "ctx_switches_per_s": [100, 500, 1000, 5000, 10000],
+        "rx_kbps": [64, 256, 1024, 4096, 16384],
+        "tx_kbps": [16, 64, 256, 1024, 4096],
+        "rtt_ms": [5, 10, 25, 50, 100, 250]
+    }
+    
+    def __init__(self, tracker: RDPSessionTracker, interval: float = 5.0):
+        super().__init__(name="rdp-perf-sampler", daemon=True)
+        self.tracker = tracker
+        self.interval = interval
+        self.clock_ticks = os.sysconf('SC_CLK_TCK')
+        self.page_size = os.sysconf('SC_PAGE_SIZE')
+        self.previous = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+    
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.sample()
+            except Exception as e:
+                logger.debug(f"RDP performance sample failed: {e}")
+    
+    def stop(self):
+        self.stop_event.set()
+    
+    def read_process(self, pid: int) -> Optional[Dict[str, Any]]:
+        """Read CPU time, RSS, context switches and socket inodes of a process"""
+        try:
+            with open(f'/proc/{pid}/stat', 'r') as f:
+                fields = f.read().rpartition(')')[2].split()
+            with open(f'/proc/{pid}/status', 'r') as f:
+                status = {}
+                for line in f:
+                    key, _, value = line.partition(':')
+                    if key in ('voluntary_ctxt_switches', 'nonvoluntary_ctxt_switches'):
+                        status[key] = int(value)
+            
+            sockets = set()
+            for fd in os.listdir(f'/proc/{pid}/fd'):
+                try:
+                    target = os.readlink(f'/proc/{pid}/fd/{fd}')
+                except OSError:
+                    continue
+                if target.startswith('socket:['):
+                    sockets.add(int(target[8:-1]))
+        except (OSError, ValueError):
+            return None
+        
+        return {
+            "cpu_ticks": int(fields[11]) + int(fields[12]),  # utime + stime
+            "rss_bytes": int(fields[21]) * self.page_size,
+            "ctx_switches": sum(status.values()),
+            "sockets": sockets
+        }
+    
+    def tcp_info_by_inode(self) -> Dict[int, Dict[str, int]]:
+        """Return RTT and byte counters of established TCP sockets via sock_diag"""
+        info = {}
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, self.NETLINK_SOCK_DIAG)
+        except OSError:
+            return info
+        
+        try:
+            sock.settimeout(1.0)
+            for family in (socket.AF_INET, socket.AF_INET6):
+                request = struct.pack("=BBBBI", family, socket.IPPROTO_TCP,
+                                      1 << (self.INET_DIAG_INFO - 1), 0, 1 << self.TCP_ESTABLISHED)
+                request += b"\0" * 48  # wildcard inet_diag_sockid
+                header = struct.pack("=IHHII", 16 + len(request), self.SOCK_DIAG_BY_FAMILY,
+                                     0x301, 0, 0)  # NLM_F_REQUEST | NLM_F_DUMP
+                sock.send(header + request)
+                
+                done = False
+                while not done:
+                    data = sock.recv(65536)
+                    offset = 0
+                    while offset + 16 <= len(data):
+                        msg_len, msg_type = struct.unpack_from("=IH", data, offset)
+                        if msg_type in (2, 3) or msg_len < 16:  # NLMSG_ERROR, NLMSG_DONE
+                            done = True
+                            break
+                        self.parse_diag_message(data[offset + 16:offset + msg_len], info)
+                        offset += (msg_len + 3) & ~3
+        except OSError as e:
+            logger.debug(f"sock_diag query failed: {e}")
+        finally:
+            sock.close()
+        return info
+    
+    def parse_diag_message(self, message: bytes, info: Dict[int, Dict[str, int]]):
+        """Extract tcp_info from one inet_diag_msg"""
+        inode = struct.unpack_from("=I", message, 68)[0]
+        offset = 72
+        while offset + 4 <= len(message):
+            attr_len, attr_type = struct.unpack_from("=HH", message, offset)
+            if attr_len < 4:
+                break
+            if attr_type == self.INET_DIAG_INFO and attr_len >= 4 + 136:
+                tcp_info = offset + 4
+                info[inode] = {
+                    "rtt_us": struct.unpack_from("=I", message, tcp_info + 68)[0],
+                    "bytes_acked": struct.unpack_from("=Q", message, tcp_info + 120)[0],
+                    "bytes_received": struct.unpack_from("=Q", message, tcp_info + 128)[0]
+                }
+            offset += (attr_len + 3) & ~3
+    
+    def sample(self):
+        """Take one sample of every tracked session"""
+        sessions = self.tracker.current_sessions()
+        if not sessions:
+            self.previous = {}
+            return
+        
+        now = time.monotonic()
+        tcp_info = self.tcp_info_by_inode()
+        current = {}
+        
+        for session_info in sessions:
+            pid = session_info["pid"]
+            process = self.read_process(pid)
+            if process is None:
+                continue
+            
+            socket_info = [tcp_info[inode] for inode in process["sockets"] if inode in tcp_info]
+            process["bytes_sent"] = sum(entry["bytes_acked"] for entry in socket_info)
+            process["bytes_recv"] = sum(entry["bytes_received"] for entry in socket_info)
+            process["rtt_us"] = max((entry["rtt_us"] for entry in socket_info), default=None)
+            process["time"] = now
+            current[pid] = process
+            
+            previous = self.previous.get(pid)
+            if previous is None:
+                continue
+            
+            elapsed = now - previous["time"]
+            values = {
+                "cpu_percent": 100.0 * (process["cpu_ticks"] - previous["cpu_ticks"]) / self.clock_ticks / elapsed,
+                "rss_mb": process["rss_bytes"] / (1024 * 1024),
+                "ctx_switches_per_s": (process["ctx_switches"] - previous["ctx_switches"]) / elapsed
+            }
+            if socket_info:
+                values["rx_kbps"] = max(0, process["bytes_recv"] - previous["bytes_recv"]) * 8 / 1000 / elapsed
+                values["tx_kbps"] = max(0, process["bytes_sent"] - previous["bytes_sent"]) * 8 / 1000 / elapsed
+                values["rtt_ms"] = process["rtt_us"] / 1000
+            self.record(pid, values)
+        
+        self.previous = current
+    
+    def record(self, pid: int, values: Dict[str, float]):
+        with self.lock:
+            histograms = self.histograms.setdefault(pid, {})
+            for metric, value in values.items():
+                edges = self.BUCKETS[metric]
+                histogram = histograms.setdefault(metric, {
+                    "counts": [0] * (len(edges) + 1),
+                    "min": value,
+                    "max": value,
+                    "sum": 0.0
+                })
+                bucket = next((i for i, edge in enumerate(edges) if value <= edge), len(edges))
+                histogram["counts"][bucket] += 1
+                histogram["min"] = min(histogram["min"], value)
+                histogram["max"] = max(histogram["max"], value)
+                histogram["sum"] += value
+    
+    def report(self) -> Optional[Dict[str, Any]]:
+        """Return and reset the histograms collected since the last report"""
+        with self.lock:
+            histograms, self.histograms = self.histograms, {}
+        if not histograms:
+            return None
+        
+        sessions = {}
+        for pid, metrics in histograms.items():
+            sessions[str(pid)] = {
+                metric: {
+                    "counts": histogram["counts"],
+                    "min": round(histogram["min"], 1),
+                    "max": round(histogram["max"], 1),
+                    "mean": round(histogram["sum"] / sum(histogram["counts"]), 1)
+                }
+                for metric, histogram in metrics.items()
+            }
+        return {"interval_s": self.interval, "buckets": self.BUCKETS, "sessions": sessions}
+
+
+class MemoryGovernor:
+    """Tracks the agent's own RSS and decides when optional collectors must be shed"""
+    
+    def __init__(self, budget_bytes: int = 0, resume_ratio: float = 0.85):
+        # A budget of 0 only reports RSS and never sheds
+        self.budget = budget_bytes
+        self.resume_below = int(budget_bytes * resume_ratio)
+        self.page_size = os.sysconf('SC_PAGE_SIZE')
+        self.shedding = False
+        self.peak = 0
+    
+    def rss(self) -> int:
+        """Return the resident set size of this process in bytes"""
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * self.page_size
+    
+    def check(self) -> bool:
+        """Update the shedding state from the current RSS, with hysteresis"""
+        rss = self.rss()
+        self.peak = max(self.peak, rss)
+        if not self.budget:
+            return False
+        
+        if not self.shedding and rss > self.budget:
+            logger.warning(f"Agent RSS {rss // 1024} KiB over budget, shedding optional collectors")
+            self.shedding = True
+            gc.collect()
+        elif self.shedding and rss < self.resume_below:
+            logger.info(f"Agent RSS {rss // 1024} KiB back under budget, restoring collectors")
+            self.shedding = False
+        return self.shedding
+    
+    def report(self) -> Dict[str, Any]:
+        return {
+            "rss_bytes": self.rss(),
+            "peak_rss_bytes": self.peak,
+            "budget_bytes": self.budget,
+            "shedding": self.shedding
+        }
+
+
+class TokenBucket:
+    """Blocking byte-rate limiter; a rate of None lets everything through"""
+    
+    def __init__(self, rate: Optional[float] = None):
+        self.lock = threading.Lock()
+        self.unlimited = threading.Event()
+        self.rate = None
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.set_rate(rate)
+    
+    def set_rate(self, rate: Optional[float]):
+        """Change the limit in bytes per second; lifting it releases waiting consumers"""
+        with self.lock:
+            self.rate = rate
+            self.tokens = 0.0 if rate is None else min(self.tokens, rate)
+            self.updated = time.monotonic()
+        if rate is None:
+            self.unlimited.set()
+        else:
+            self.unlimited.clear()
+    
+    def consume(self, amount: int):
+        """Take amount bytes from the bucket, sleeping while it is in debt"""
+        with self.lock:
+            if self.rate is None:
+                return
+            now = time.monotonic()
+            # One second of burst; larger reads go into debt and are paid off by sleeping
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate) - amount
+            self.updated = now
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            self.unlimited.wait(wait)
+
+
+class QoSController(threading.Thread):
+    """Switches the agent between "active" and "idle" profiles from RDP session and user activity.
+
+    A session counts as active while input interrupts or network traffic not caused
+    by the agent itself were seen within the last ``qos_idle_after`` seconds.
+    """
+    
+    def __init__(self, sessions, config: Dict[str, Any], native: Optional[NativeCollectors] = None,
+                 on_change=None):
+        super().__init__(name="qos-controller", daemon=True)
+        self.sessions = sessions
+        self.native = native
+        self.on_change = on_change
+        self.interval = config.get("qos_poll_interval", 2)
+        self.idle_after = config.get("qos_idle_after", 60)
+        self.input_patterns = [pattern.lower() for pattern in config.get(
+            "qos_input_irq_patterns", ["i8042", "hid", "xhci", "ehci", "ohci", "uhci"])]
+        self.input_threshold = config.get("qos_input_threshold", 5)
+        self.network_threshold = config.get("qos_network_active_kb", 32) * 1024
+        self.download_rate = config.get("qos_download_rate_kb", 1024) * 1024
+        self.bucket = TokenBucket()
+        self.profile = "idle"
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        self.own_bytes = 0
+        self.previous = None
+        self.last_activity = None
+        self.changed_at = time.monotonic()
+        self.transitions = 0
+    
+    @property
+    def active(self) -> bool:
+        return self.profile == "active"
+    
+    def read_input_interrupts(self) -> int:
+        """Sum the interrupts of input-capable controllers listed in /proc/interrupts"""
+        total = 0
+        with open('/proc/interrupts', 'r') as f:
+            cpus = len(f.readline().split())
+            for line in f:
+                parts = line.split()
+                description = " ".join(parts[cpus + 1:]).lower()
+                if any(pattern in description for pattern in self.input_patterns):
+                    total += sum(int(value) for value in parts[1:cpus + 1] if value.isdigit())
+        return total
+    
+    def read_network_bytes(self) -> int:
+        """Total bytes moved on non-loopback interfaces"""
+        if self.native is not None:
+            counters = self.native.net_io_counters()
+        else:
+            counters = psutil.net_io_counters(pernic=True)
+        return sum(stat.bytes_sent + stat.bytes_recv for name, stat in counters.items() if name != "lo")
+    
+    def note_transfer(self, amount: int):
+        """Record agent traffic so it is not mistaken for user activity"""
+        with self.lock:
+            self.own_bytes += amount
+    
+    def throttle(self, amount: int):
+        """Apply the current profile's bandwidth cap to a downloaded block"""
+        self.bucket.consume(amount)
+    
+    def sample(self):
+        """Read the activity signals and switch profile when needed"""
+        now = time.monotonic()
+        with self.lock:
+            own_bytes = self.own_bytes
+        current = (now, self.read_input_interrupts(), self.read_network_bytes() - own_bytes)
+        previous = self.previous
+        self.previous = current
+        
+        if previous is not None:
+            elapsed = max(now - previous[0], 1e-3)
+            if (current[1] - previous[1] >= self.input_threshold
+                    or (current[2] - previous[2]) / elapsed >= self.network_threshold):
+                self.last_activity = now
+        
+        recent = self.last_activity is not None and now - self.last_activity < self.idle_after
+        self.set_profile("active" if recent and self.sessions() else "idle")
+    
+    def set_profile(self, profile: str):
+        if profile == self.profile:
+            return
+        logger.info(f"QoS profile {self.profile} -> {profile}")
+        self.profile = profile
+        self.changed_at = time.monotonic()
+        self.transitions += 1
+        self.bucket.set_rate((self.download_rate or None) if profile == "active" else None)
+        if self.on_change:
+            self.on_change(profile)
+    
+    def run(self):
+        while True:
+            try:
+                self.sample()
+            except Exception as e:
+                logger.debug(f"QoS sample failed: {e}")
+            if self.stop_event.wait(self.interval):
+                break
+    
+    def stop(self):
+        self.stop_event.set()
+        self.set_profile("idle")
+    
+    def report(self) -> Dict[str, Any]:
+        return {
+            "profile": self.profile,
+            "since_s": round(time.monotonic() - self.changed_at, 1),
+            "transitions": self.transitions,
+            "download_limit_bps": self.bucket.rate
+        }
+
+
+class CommandSandbox:
+    """Confines command workloads to a cgroup v2 slice, or lowers their priority without cgroups"""
+    
+    CONTROLLERS = ("cpu", "io", "memory")
+    CGROUP_MOUNT = Path("/sys/fs/cgroup")
+    # Joins the cgroup passed as $1 and execs the rest, so the command and every descendant start inside
+    JOIN_SCRIPT = 'echo $$ > "$1"/cgroup.procs && shift && exec "$@"'
+    
+    def __init__(self, config: Dict[str, Any]):
+        root = config.get("command_cgroup_root")
+        self.root = Path(root) if root else None
+        self.slice_name = config.get("command_cgroup_name", "vdi-commands.slice")
+        self.slice = None
+        memory_max = config.get("command_memory_max_mb")
+        self.limits = {
+            "cpu.weight": str(config.get("command_cpu_weight", 20)),
+            "io.weight": str(config.get("command_io_weight", 20)),
+            "memory.max": str(int(memory_max * 1024 * 1024)) if memory_max else "max"
+        }
+        self.nice = config.get("command_nice", 10)
+        self.ionice_class = config.get("command_ionice_class", 2)
+        self.ionice_level = config.get("command_ionice_level", 7)
+        self.ionice = shutil.which("ionice")
+        self.nice_path = shutil.which("nice")
+        self.isolation = config.get("command_isolation", True)
+        
+        # Set up on first use rather than while the agent is constructed
+        self.mode = None
+        self.lock = threading.Lock()
+    
+    @staticmethod
+    def write(path: Path, value: str):
+        with open(path, 'w') as f:
+            f.write(value)
+    
+    def active_mode(self) -> str:
+        """Return "cgroup", "nice" or "none", setting the slice up the first time"""
+        with self.lock:
+            if self.mode is None:
+                self.mode = "none"
+                if self.isolation:
+                    self.mode = "cgroup" if self.setup_cgroup() else "nice"
+            return self.mode
+    
+    @classmethod
+    def own_cgroup(cls) -> Optional[Path]:
+        """The agent's cgroup v2 directory, normally the subtree delegated to its unit"""
+        try:
+            for line in Path("/proc/self/cgroup").read_text().splitlines():
+                if line.startswith("0::"):
+                    return cls.CGROUP_MOUNT / line[3:].lstrip("/")
+        except OSError:
+            pass
+        return None
+    
+    def setup_cgroup(self) -> bool:
+        """Create the command slice under the agent's own cgroup and apply its limits"""
+        own = self.root is None
+        root = self.own_cgroup() if own else self.root
+        try:
+            if root is None:
+                raise OSError("agent is not in a cgroup v2 hierarchy")
+            available = (root / "cgroup.controllers").read_text().split()
+            controllers = [name for name in self.CONTROLLERS if name in available]
+            self.slice = root / self.slice_name
+            # Controllers must be enabled on the way down before the slice can use them
+            self.enable_controllers(root, controllers, vacate=own and root != self.CGROUP_MOUNT)
+            self.slice.mkdir(exist_ok=True)
+            self.enable_controllers(self.slice, controllers)
+        except OSError as e:
+            logger.info(f"cgroup v2 unavailable for commands, using nice/ionice: {e}")
+            return False
+        
+        for name, value in self.limits.items():
+            try:
+                self.write(self.slice / name, value)
+            except OSError as e:
+                # io.weight only exists with an I/O controller that supports it
+                logger.debug(f"Could not set {name} on command slice: {e}")
+        logger.info(f"Running commands in cgroup {self.slice}")
+        return True
+    
+    def enable_controllers(self, cgroup: Path, controllers, vacate: bool = False):
+        """Enable the controllers missing from a cgroup's subtree_control"""
+        enabled = (cgroup / "cgroup.subtree_control").read_text().split()
+        missing = [name for name in controllers if name not in enabled]
+        if not missing:
+            return
+        if vacate:
+            self.vacate(cgroup)
+        self.write(cgroup / "cgroup.subtree_control", " ".join(f"+{name}" for name in missing))
+        logger.info(f"Enabled cgroup controllers {' '.join(missing)} on {cgroup}")
+    
+    def vacate(self, cgroup: Path):
+        """Move the processes of a cgroup into a leaf, since a cgroup holding processes cannot enable controllers"""
+        pids = (cgroup / "cgroup.procs").read_text().split()
+        if not pids:
+            return
+        leaf = cgroup / "agent"
+        leaf.mkdir(exist_ok=True)
+        for pid in pids:
+            try:
+                self.write(leaf / "cgroup.procs", pid)
+            except OSError as e:
+                # The process may have exited in the meantime
+                logger.debug(f"Could not move {pid} to {leaf}: {e}")
+        logger.info(f"Moved agent processes to {leaf}")
+    
+    def prepare(self, args, shell: bool) -> tuple:
+        """Return (args, shell, cgroup) to launch a command with"""
+        mode = self.active_mode()
+        if mode == "none":
+            return args, shell, None
+        
+        # Shell strings stay a single argument to sh, never part of a wrapper's command line
+        if shell:
+            args, shell = ["/bin/sh", "-c", args], False
+        elif isinstance(args, str):
+            args = [args]
+        args = list(args)
+        
+        if mode == "cgroup":
+            cgroup = self.slice / f"cmd-{uuid.uuid4().hex[:12]}"
+            try:
+                cgroup.mkdir()
+            except OSError as e:
+                logger.warning(f"Could not create command cgroup, using nice/ionice: {e}")
+            else:
+                return ["/bin/sh", "-c", self.JOIN_SCRIPT, "vdi-command", str(cgroup)] + args, False, cgroup
+        
+        if self.nice_path is not None:
+            args = [self.nice_path, "-n", str(self.nice)] + args
+        if self.ionice is not None:
+            args = [self.ionice, "-c", str(self.ionice_class), "-n", str(self.ionice_level)] + args
+        return args, False, None
+    
+    def usage(self, cgroup: Optional[Path], rusage) -> Dict[str, Any]:
+        """Resource usage of a finished command, from its cgroup when it had one"""
+        usage = {
+            "isolation": "cgroup" if cgroup is not None else self.active_mode(),
+            "cpu_user_ms": round(rusage.ru_utime * 1000) if rusage else None,
+            "cpu_system_ms": round(rusage.ru_stime * 1000) if rusage else None,
+            "max_rss_kb": rusage.ru_maxrss if rusage else None,
+            "io_read_bytes": rusage.ru_inblock * 512 if rusage else None,
+            "io_write_bytes": rusage.ru_oublock * 512 if rusage else None
+        }
+        if cgroup is None:
+            return usage
+        
+        # The cgroup also covers descendants that were never waited for
+        try:
+            for line in (cgroup / "cpu.stat").read_text().splitlines():
+                key, _, value = line.partition(' ')
+                if key == "user_usec":
+                    usage["cpu_user_ms"] = int(value) // 1000
+                elif key == "system_usec":
+                    usage["cpu_system_ms"] = int(value) // 1000
+        except (OSError, ValueError):
+            pass
+        try:
+            usage["memory_peak_bytes"] = int((cgroup / "memory.peak").read_text())
+        except (OSError, ValueError):
+            pass
+        try:
+            read_bytes = write_bytes = 0
+            for line in (cgroup / "io.stat").read_text().splitlines():
+                for field in line.split()[1:]:
+                    key, _, value = field.partition('=')
+                    if key == "rbytes":
+                        read_bytes += int(value)
+                    elif key == "wbytes":
+                        write_bytes += int(value)
+            usage["io_read_bytes"] = read_bytes
+            usage["io_write_bytes"] = write_bytes
+        except (OSError, ValueError):
+            pass
+        return usage
+    
+    def release(self, cgroup: Optional[Path]):
+        if cgroup is None:
+            return
+        # Killed group members can take a moment to leave the cgroup
+        for _ in range(20):
+            try:
+                cgroup.rmdir()
+                return
+            except OSError as e:
+                error = e
+                time.sleep(0.05)
+        logger.debug(f"Command cgroup {cgroup} not removed: {error}")
+    
+    @contextlib.contextmanager
+    def background_priority(self):
+        """Run the calling thread at command priority, e.g. for image downloads"""
+        if self.active_mode() == "none":
+            yield
+            return
+        
+        tid = threading.get_native_id()
+        previous = os.getpriority(os.PRIO_PROCESS, tid)
+        try:
+            # On Linux both calls act on the single thread
+            os.setpriority(os.PRIO_PROCESS, tid, max(previous, self.nice))
+            if self.ionice is not None:
+                subprocess.run([self.ionice, "-c", str(self.ionice_class), "-n", str(self.ionice_level),
+                                "-p", str(tid)], capture_output=True)
+        except OSError as e:
+            logger.debug(f"Could not lower thread priority: {e}")
+        try:
+            yield
+        finally:
+            try:
+                os.setpriority(os.PRIO_PROCESS, tid, previous)
+                if self.ionice is not None:
+                    subprocess.run([self.ionice, "-c", "0", "-p", str(tid)], capture_output=True)
+            except OSError as e:
+                logger.debug(f"Could not restore thread priority: {e}")
+
+
+class StackSampler:
+    """Time-bounded sampling profiler over the agent's own threads"""
+    
+    MAX_DEPTH = 64
+    
+    def __init__(self, interval: float = 0.01, max_overhead: float = 0.05):
+        self.interval = interval
+        self.max_overhead = max_overhead
+        self.stacks = {}
+        self.self_samples = {}
+        self.total_samples = {}
+        self.samples = 0
+        self.sampling_time = 0.0
+    
+    @staticmethod
+    def frame_label(frame) -> str:
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    
+    @staticmethod
+    def thread_cpu_ticks() -> Dict[int, int]:
+        """Return utime + stime per native thread id of this process"""
+        ticks = {}
+        for tid in os.listdir('/proc/self/task'):
+            try:
+                with open(f'/proc/self/task/{tid}/stat', 'r') as f:
+                    fields = f.read().rpartition(')')[2].split()
+                ticks[int(tid)] = int(fields[11]) + int(fields[12])
+            except (OSError, IndexError, ValueError):
+                continue
+        return ticks
+    
+    def sample(self, own_ident: int):
+        """Record the current stack of every other thread"""
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            labels = []
+            while frame is not None and len(labels) < self.MAX_DEPTH:
+                labels.append(self.frame_label(frame))
+                frame = frame.f_back
+            if not labels:
+                continue
+            
+            labels.reverse()
+            stack = (names.get(ident, f"thread-{ident}"),) + tuple(labels)
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            self.self_samples[labels[-1]] = self.self_samples.get(labels[-1], 0) + 1
+            for label in set(labels):
+                self.total_samples[label] = self.total_samples.get(label, 0) + 1
+        self.samples += 1
+    
+    def run(self, duration: float) -> Dict[int, int]:
+        """Sample until the duration has passed and return per-thread CPU ticks used meanwhile"""
+        own_ident = threading.get_ident()
+        ticks_before = self.thread_cpu_ticks()
+        deadline = time.monotonic() + duration
+        
+        while time.monotonic() < deadline:
+            started = time.monotonic()
+            self.sample(own_ident)
+            cost = time.monotonic() - started
+            self.sampling_time += cost
+            # Stretch the interval whenever sampling itself gets expensive
+            time.sleep(max(self.interval, cost / self.max_overhead - cost))
+        
+        ticks_after = self.thread_cpu_ticks()
+        return {tid: ticks - ticks_before.get(tid, 0) for tid, ticks in ticks_after.items()}
+    
+    def collapsed(self, max_bytes: int) -> tuple:
+        """Return flamegraph-ready collapsed stacks, hottest first, and whether they were truncated"""
+        lines = []
+        size = 0
+        for stack, count in sorted(self.stacks.items(), key=lambda item: -item[1]):
+            line = f"{';'.join(stack)} {count}"
+            size += len(line) + 1
+            if size > max_bytes:
+                return "\n".join(lines), True
+            lines.append(line)
+        return "\n".join(lines), False
+    
+    def functions(self, top: int) -> List[Dict[str, Any]]:
+        """Per-function self and inclusive sample counts, as estimated milliseconds"""
+        interval_ms = (self.interval + self.sampling_time / max(self.samples, 1)) * 1000
+        ranked = sorted(self.total_samples.items(), key=lambda item: (-self.self_samples.get(item[0], 0), -item[1]))
+        return [
+            {
+                "function": label,
+                "self_samples": self.self_samples.get(label, 0),
+                "total_samples": total,
+                "self_ms": round(self.self_samples.get(label, 0) * interval_ms, 1),
+                "total_ms": round(total * interval_ms, 1)
+            }
+            for label, total in ranked[:top]
+        ]
+
+
 class VDIClientAgent:
     """Main VDI client management agent"""
     
@@ -41,14 +3572,126 @@ class VDIClientAgent:
         self.server_url = self.config.get("server_url", "https://vdi-management.company.com")
         self.heartbeat_interval = self.config.get("heartbeat_interval", 60)
         self.running = True
+        self.loop = None
+        self.metrics = AgentMetrics()
+        self.transport = AgentTransport(self.server_url, self.config, self.metrics)
+        self.server_capabilities = set()
+        self.last_spool_replay = 0.0
+        self.progress_reported = {}
+        self.heartbeat_encoder = HeartbeatDeltaEncoder(
+            self.config.get("delta_full_snapshot_every", 60)
+        )
+        self.heartbeat_scheduler = HeartbeatScheduler(
+            self.heartbeat_interval,
+            self.config.get("heartbeat_jitter", 0.1),
+            self.config.get("heartbeat_backoff_max", 600),
+            self.config.get("heartbeat_busy_interval", 10),
+            self.config.get("heartbeat_initial_spread"),
+            self.config.get("heartbeat_hint_max", 3600)
+        )
+        
+        # Direct /proc and /sys readers; psutil and subprocesses remain the fallback
+        self.native = None
+        if self.config.get("native_collectors", True):
+            try:
+                self.native = NativeCollectors()
+            except OSError as e:
+                logger.warning(f"Native collectors unavailable, using psutil: {e}")
+        
+        # Static inventory is collected once per boot and again on hotplug
+        self.collectors = CollectorRegistry({
+            "static": None,
+            "slow": self.config.get("collector_slow_ttl", 300),
+            "fast": 0
+        }, self.metrics)
+        self.hotplug_watcher = HotplugWatcher()
+        self.network_rates = CounterRates()
+        self.disk_rates = CounterRates()
+        self.register_collectors()
+        
+        self.memory_governor = MemoryGovernor(
+            int(self.config.get("memory_budget_mb", 0) * 1024 * 1024),
+            self.config.get("memory_resume_ratio", 0.85)
+        )
+        if self.config.get("memory_tracemalloc", False):
+            tracemalloc.start(self.config.get("memory_tracemalloc_frames", 1))
+        
+        self.cpu_sampler = CPUSampler(
+            self.config.get("cpu_sample_interval", 1.0),
+            self.config.get("cpu_sample_buffer", 240),
+            self.native
+        )
+        
+        # Heartbeats get a dedicated thread so a stuck command cannot starve them, and
+        # commands get their own pool so they cannot starve result delivery or collectors
+        self.heartbeat_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="heartbeat")
+        self.command_pool = ThreadPoolExecutor(
+            max_workers=self.config.get("command_workers", 2),
+            thread_name_prefix="command"
+        )
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="agent-worker")
+        
+        self.command_executor = CommandExecutor(self, self.config)
+        self.sandbox = CommandSandbox(self.config)
+        
+        self.metrics.gauge("vdi_agent_command_queue_depth", lambda: len(self.command_executor.queue))
+        self.metrics.gauge("vdi_agent_commands_running", lambda: sum(self.command_executor.running.values()))
+        self.metrics.gauge("vdi_agent_pending_results", lambda: len(self.command_executor.pending_results))
+        self.metrics.gauge("vdi_agent_rss_bytes", self.memory_governor.rss)
+        
+        self.session_tracker = RDPSessionTracker(
+            self.request_heartbeat,
+            self.config.get("rdp_poll_interval", 2.0),
+            max_events=self.config.get("rdp_event_buffer", 256)
+        )
+        self.rdp_sampler = None
+        if self.config.get("rdp_performance_monitoring", True):
+            self.rdp_sampler = RDPPerformanceSampler(
+                self.session_tracker,
+                self.config.get("rdp_sample_interval", 5.0)
+            )
+        self.log_shipper = LogShipper(self.config.get("log_cursor_file", "/var/lib/vdi/log-cursors.json"))
+        
+        # Background work backs off while a user is working in an RDP session
+        self.cadence_factor = 1
+        self.qos = None
+        if self.config.get("qos", True):
+            self.qos = QoSController(self.has_rdp_session, self.config,
+                                     self.native, self.apply_qos_profile)
+            self.metrics.gauge("vdi_agent_qos_active", lambda: int(self.qos.active))
+        
+        self.command_channel = None
+        if self.config.get("command_channel", False):
+            self.command_channel = CommandChannel(self.transport, self.device_id, self.dispatch_command, self.config)
+        
+        self.peer_cache = None
+        if self.config.get("peer_cache", False):
+            self.peer_cache = PeerCache(self.device_id, self.transport, self.config)
+        
+        # Everything the agent sends or receives is its own traffic, not the user's
+        if self.qos is not None:
+            self.transport.on_transfer = self.qos.note_transfer
+            if self.peer_cache is not None:
+                self.peer_cache.on_transfer = self.qos.note_transfer
+                self.peer_cache.busy = lambda: self.qos.active
+        
+        self.spool = None
+        if self.config.get("telemetry_spool", True):
+            self.spool = TelemetrySpool(
+                self.config.get("spool_dir", "/var/lib/vdi/spool"),
+                self.config.get("spool_max_bytes", 16 * 1024 * 1024),
+                self.config.get("spool_segment_bytes", 1024 * 1024)
+            )
         
         # Create required directories
-        Path("/var/log/vdi").mkdir(parents=True, exist_ok=True)
-        Path("/var/lib/vdi").mkdir(parents=True, exist_ok=True)
+        Path(self.config.get("logging", {}).get("log_file", "/var/log/vdi/agent.log")).parent.mkdir(
+            parents=True, exist_ok=True)
+        Path(self.config.get("state_dir", "/var/lib/vdi")).mkdir(parents=True, exist_ok=True)
         
         logger.info(f"VDI Agent initialized - Device ID: {self.device_id}")
     
-    def load_config(self, config_path: str) -> Dict[str, Any]:
+    @staticmethod
+    def load_config(config_path: str) -> Dict[str, Any]:
         """Load agent configuration"""
         default_config = {
             "server_url": "https://vdi-management.company.com",
@@ -58,9 +3701,123 @@ class VDIClientAgent:
             "log_level": "INFO",
             "hardware_monitoring": True,
             "network_monitoring": True,
-            "process_monitoring": True
+            "process_monitoring": True,
+            "delta_heartbeats": True,
+            "delta_full_snapshot_every": 60,
+            "collector_slow_ttl": 300,
+            "cpu_sample_interval": 1.0,
+            "cpu_sample_buffer": 240,
+            "verify_tls": False,
+            "verify_tls_downloads": True,
+            "http_compression": "gzip",
+            "http_compression_min_bytes": 1024,
+            "http_pool_size": 4,
+            "http_timeouts": {
+                "heartbeat": 30,
+                "command_result": 30,
+                "download": 60,
+                "telemetry_batch": 60
+            },
+            "state_dir": "/var/lib/vdi",
+            "telemetry_spool": True,
+            "spool_dir": "/var/lib/vdi/spool",
+            "spool_max_bytes": 16777216,
+            "spool_segment_bytes": 1048576,
+            "spool_batch_records": 50,
+            "spool_replay_batches": 2,
+            "spool_replay_interval": 10,
+            "heartbeat_timeout": 60,
+            "command_workers": 2,
+            "command_timeouts": {
+                "update_image": 3600
+            },
+            "command_priorities": {},
+            "command_concurrency": {
+                "update_image": 1,
+                "install_package": 1,
+                "collect_logs": 3
+            },
+            "command_dedupe_size": 256,
+            "command_cancel_grace": 10,
+            "command_result_max_delay": 15,
+            "collector_refresh_interval": 30,
+            "download_dir": "/var/lib/vdi/downloads",
+            "download_chunk_size": 1048576,
+            "download_sync_bytes": 33554432,
+            "download_retries": 3,
+            "progress_report_interval": 5,
+            "current_image_path": "/boot/vdi-update.img",
+            "image_index_cache": "/var/lib/vdi/image-index.json",
+            "delta_image_updates": True,
+            "delta_coalesce_gap": 65536,
+            "delta_max_range_bytes": 8388608,
+            "peer_cache": False,
+            "peer_cache_bind": "0.0.0.0",
+            "peer_cache_port": 8765,
+            "peer_cache_discovery_port": 8766,
+            "peer_cache_broadcast": "255.255.255.255",
+            "peer_cache_beacon_interval": 30,
+            "peer_cache_peers": [],
+            "command_output_max_bytes": 65536,
+            "command_output_flush_interval": 2,
+            "command_output_chunk_bytes": 32768,
+            "log_cursor_file": "/var/lib/vdi/log-cursors.json",
+            "log_ship_max_bytes": 262144,
+            "log_ship_max_records": 2000,
+            "log_batch_bytes": 65536,
+            "rdp_poll_interval": 2.0,
+            "rdp_performance_monitoring": True,
+            "rdp_sample_interval": 5.0,
+            "native_collectors": True,
+            "startup_heartbeat": True,
+            "startup_import_budget_ms": 250,
+            "startup_init_budget_ms": 500,
+            "low_memory_mode": False,
+            "memory_budget_mb": 0,
+            "memory_resume_ratio": 0.85,
+            "memory_shed_collectors": ["hardware", "processes", "disk"],
+            "memory_tracemalloc": False,
+            "memory_report_max_seconds": 120,
+            "rdp_event_buffer": 256,
+            "heartbeat_jitter": 0.1,
+            "heartbeat_backoff_max": 600,
+            "heartbeat_busy_interval": 10,
+            "heartbeat_hint_max": 3600,
+            "command_channel": False,
+            "command_channel_wait": 55,
+            "command_channel_backoff_max": 60,
+            "command_channel_unsupported_retry": 3600,
+            "metrics_endpoint": False,
+            "metrics_bind": "127.0.0.1",
+            "metrics_port": 9101,
+            "metrics_in_heartbeat": True,
+            "profile_max_seconds": 60,
+            "profile_min_interval_ms": 5,
+            "profile_max_overhead": 0.05,
+            "profile_max_output_bytes": 65536,
+            "compact_heartbeats": True,
+            "counter_rates": True,
+            "command_isolation": True,
+            "command_cgroup_root": None,
+            "command_cgroup_name": "vdi-commands.slice",
+            "command_cpu_weight": 20,
+            "command_io_weight": 20,
+            "command_memory_max_mb": 512,
+            "command_nice": 10,
+            "command_ionice_class": 2,
+            "command_ionice_level": 7,
+            "qos": True,
+            "qos_poll_interval": 2,
+            "qos_idle_after": 60,
+            "qos_input_irq_patterns": ["i8042", "hid", "xhci", "ehci", "ohci", "uhci"],
+            "qos_input_threshold": 5,
+            "qos_network_active_kb": 32,
+            "qos_download_rate_kb": 1024,
+            "qos_active_cadence_factor": 4,
+            "qos_defer_max": 900
         }
         
+        user_config = {}
         try:
             if os.path.exists(config_path):
                 with open(config_path, 'r') as f:
@@ -69,9 +3826,32 @@ class VDIClientAgent:
         except Exception as e:
             logger.warning(f"Could not load config from {config_path}: {e}")
         
+        if default_config.get("low_memory_mode"):
+            for key, value in LOW_MEMORY_DEFAULTS.items():
+                if key not in user_config:
+                    default_config[key] = value
+        
         return default_config
     
     def get_device_id(self) -> str:
+        """Return the cached device ID, deriving it from the MAC address on first start"""
+        device_id_file = Path(self.config.get("state_dir", "/var/lib/vdi")) / "device-id"
+        try:
+            device_id = device_id_file.read_text().strip()
+            if device_id:
+                return device_id
+        except OSError:
+            pass
+        
+        device_id = self.derive_device_id()
+        try:
+            device_id_file.parent.mkdir(parents=True, exist_ok=True)
+            device_id_file.write_text(device_id)
+        except OSError as e:
+            logger.warning(f"Could not cache device ID: {e}")
+        return device_id
+    
+    def derive_device_id(self) -> str:
         """Generate unique device ID from MAC address"""
         try:
             # Try to get primary network interface MAC
@@ -90,90 +3870,52 @@ class VDIClientAgent:
         except Exception as e:
             logger.warning(f"Could not get MAC address: {e}")
         
-        # Last resort: generate UUID and save it
-        device_id_file = Path("/var/lib/vdi/device-id")
-        if device_id_file.exists():
-            return device_id_file.read_text().strip()
-        else:
-            device_id = str(uuid.uuid4())
-            device_id_file.write_text(device_id)
-            return device_id
+        # Last resort: a random ID, kept stable by the device-id cache
+        return str(uuid.uuid4())
+    
+    def register_collectors(self):
+        """Register snapshot collectors with their refresh cadence"""
+        self.collectors.register("system", self.get_static_system_info, "static")
+        self.collectors.register("hardware", self.get_hardware_info, "static")
+        self.collectors.register("cpu", self.get_cpu_info, "fast")
+        self.collectors.register("memory", self.get_memory_info, "fast")
+        self.collectors.register("disk", self.get_disk_info, "slow")
+        self.collectors.register("network", self.get_network_info, "fast")
+        self.collectors.register("default_gateway", self.get_default_gateway, "slow")
+        self.collectors.register("processes", self.get_process_info, "fast")
+        self.collectors.register("rdp_sessions", self.get_rdp_sessions, "fast")
+        if self.config.get("counter_rates", True):
+            self.collectors.register("disk_io", self.get_disk_io_rates, "fast")
     
     def collect_system_info(self) -> Dict[str, Any]:
         """Collect comprehensive system information"""
         try:
-            # Basic system info
-            uname = os.uname()
-            boot_time = datetime.fromtimestamp(psutil.boot_time())
-            
-            # CPU information
-            cpu_info = {
-                "usage_percent": psutil.cpu_percent(interval=1),
-                "count": psutil.cpu_count(),
-                "count_logical": psutil.cpu_count(logical=True),
-                "freq": psutil.cpu_freq()._asdict() if psutil.cpu_freq() else None
-            }
+            # Re-read static inventory after devices were plugged or removed
+            if self.hotplug_watcher.changed():
+                logger.info("Hardware change detected, refreshing static inventory")
+                self.collectors.invalidate(cadence="static")
             
-            # Memory information
-            memory = psutil.virtual_memory()
-            memory_info = {
-                "total": memory.total,
-                "used": memory.used,
-                "free": memory.free,
-                "percent": memory.percent,
-                "available": memory.available
-            }
-            
-            # Disk information
-            disk_usage = []
-            for partition in psutil.disk_partitions():
-                try:
-                    usage = psutil.disk_usage(partition.mountpoint)
-                    disk_usage.append({
-                        "device": partition.device,
-                        "mountpoint": partition.mountpoint,
-                        "fstype": partition.fstype,
-                        "total": usage.total,
-                        "used": usage.used,
-                        "free": usage.free,
-                        "percent": (usage.used / usage.total) * 100 if usage.total > 0 else 0
-                    })
-                except PermissionError:
-                    continue
+            static_info = self.collectors.get("system")
             
-            # Network information
-            network_info = self.get_network_info()
+            # Over the RSS budget, optional collectors are skipped and their caches freed
+            shed = set()
+            if self.memory_governor.check():
+                shed = set(self.config.get("memory_shed_collectors", []))
+                for name in shed:
+                    self.collectors.invalidate(name=name)
             
-            # Process information
-            process_count = len(psutil.pids())
-            
-            # RDP session information
-            rdp_sessions = self.get_rdp_sessions()
-            
-            # Hardware information
-            hardware_info = self.get_hardware_info()
-            
-            return {
+            info = {
                 "device_id": self.device_id,
-                "hostname": uname.nodename,
+                "hostname": static_info["hostname"],
                 "timestamp": datetime.now().isoformat(),
-                "uptime_seconds": (datetime.now() - boot_time).total_seconds(),
-                "system": {
-                    "os": f"{uname.sysname} {uname.release}",
-                    "architecture": uname.machine,
-                    "kernel_version": uname.version
-                },
-                "cpu": cpu_info,
-                "memory": memory_info,
-                "disk": disk_usage,
-                "network": network_info,
-                "processes": {
-                    "total_count": process_count
-                },
-                "rdp_sessions": rdp_sessions,
-                "hardware": hardware_info,
+                "uptime_seconds": time.time() - static_info["boot_time"],
+                "system": static_info["system"],
                 "agent_version": "1.0.0"
             }
+            for name in ("cpu", "memory", "disk", "disk_io", "network", "processes", "rdp_sessions", "hardware"):
+                if name not in shed and name in self.collectors.collectors:
+                    info[name] = self.collectors.get(name)
+            return info
             
         except Exception as e:
             logger.error(f"Error collecting system info: {e}")
@@ -183,56 +3925,184 @@ class VDIClientAgent:
                 "error": str(e)
             }
     
+    def get_static_system_info(self) -> Dict[str, Any]:
+        """Get host identity that only changes across reboots"""
+        uname = os.uname()
+        return {
+            "hostname": uname.nodename,
+            "boot_time": psutil.boot_time(),
+            "system": {
+                "os": f"{uname.sysname} {uname.release}",
+                "architecture": uname.machine,
+                "kernel_version": uname.version
+            }
+        }
+    
+    def get_cpu_info(self) -> Dict[str, Any]:
+        """Get CPU utilisation and frequency"""
+        cpu_freq = psutil.cpu_freq()
+        cpu_info = {
+            "usage_percent": None,
+            "count": psutil.cpu_count(),
+            "count_logical": psutil.cpu_count(logical=True),
+            "freq": cpu_freq._asdict() if cpu_freq else None
+        }
+        
+        # Interval statistics come from the background sampler, never block here
+        interval_stats = self.cpu_sampler.report()
+        if interval_stats and interval_stats["total"]:
+            cpu_info["usage_percent"] = interval_stats["total"]["mean"]
+            cpu_info["interval"] = interval_stats
+        else:
+            cpu_info["usage_percent"] = psutil.cpu_percent(interval=None)
+        
+        return cpu_info
+    
+    def get_memory_info(self) -> MemoryRecord:
+        """Get memory usage"""
+        if self.native is not None:
+            try:
+                return self.native.virtual_memory()
+            except (OSError, KeyError, ValueError) as e:
+                logger.debug(f"Native memory collector failed: {e}")
+        
+        memory = psutil.virtual_memory()
+        return MemoryRecord(memory.total, memory.used, memory.free, memory.percent, memory.available)
+    
+    def get_disk_info(self) -> List[DiskRecord]:
+        """Get usage of every mounted partition"""
+        disk_usage = []
+        for partition in psutil.disk_partitions():
+            try:
+                usage = psutil.disk_usage(partition.mountpoint)
+                disk_usage.append(DiskRecord(
+                    partition.device,
+                    partition.mountpoint,
+                    partition.fstype,
+                    usage.total,
+                    usage.used,
+                    usage.free,
+                    (usage.used / usage.total) * 100 if usage.total > 0 else 0
+                ))
+            except PermissionError:
+                continue
+        return disk_usage
+    
+    def get_process_info(self) -> Dict[str, Any]:
+        """Get process table summary"""
+        return {
+            "total_count": len(psutil.pids())
+        }
+    
     def get_network_info(self) -> Dict[str, Any]:
         """Collect network interface information"""
         try:
             interfaces = {}
-            stats = psutil.net_io_counters(pernic=True)
+            stats = self.get_interface_counters()
             addrs = psutil.net_if_addrs()
             
             for interface_name in addrs.keys():
-                interface_info = {
-                    "addresses": [],
-                    "statistics": None
-                }
-                
-                # Get addresses
-                for address in addrs[interface_name]:
-                    addr_info = {
-                        "family": str(address.family),
-                        "address": address.address
-                    }
-                    if hasattr(address, 'netmask') and address.netmask:
-                        addr_info["netmask"] = address.netmask
-                    interface_info["addresses"].append(addr_info)
-                
-                # Get statistics
-                if interface_name in stats:
-                    stat = stats[interface_name]
-                    interface_info["statistics"] = {
-                        "bytes_sent": stat.bytes_sent,
-                        "bytes_recv": stat.bytes_recv,
-                        "packets_sent": stat.packets_sent,
-                        "packets_recv": stat.packets_recv,
-                        "errin": stat.errin,
-                        "errout": stat.errout,
-                        "dropin": stat.dropin,
-                        "dropout": stat.dropout
-                    }
-                
-                interfaces[interface_name] = interface_info
+                addresses = [
+                    AddressRecord(str(address.family), address.address, getattr(address, 'netmask', None) or None)
+                    for address in addrs[interface_name]
+                ]
+                interfaces[interface_name] = InterfaceRecord(addresses, stats.get(interface_name))
             
-            return {
+            network = {
                 "interfaces": interfaces,
-                "default_gateway": self.get_default_gateway()
+                "default_gateway": self.collectors.get("default_gateway")
             }
+            if self.config.get("counter_rates", True):
+                network["rates"] = self.get_interface_rates(stats)
+            return network
             
         except Exception as e:
             logger.error(f"Error getting network info: {e}")
             return {"error": str(e)}
     
+    def get_interface_counters(self) -> Dict[str, InterfaceCounters]:
+        """Get per-interface traffic counters"""
+        if self.native is not None:
+            try:
+                return self.native.net_io_counters()
+            except (OSError, ValueError) as e:
+                logger.debug(f"Native network collector failed: {e}")
+        
+        counters = {}
+        for interface_name, stat in psutil.net_io_counters(pernic=True).items():
+            counters[interface_name] = InterfaceCounters(
+                stat.bytes_sent, stat.bytes_recv, stat.packets_sent, stat.packets_recv,
+                stat.errin, stat.errout, stat.dropin, stat.dropout
+            )
+        return counters
+    
+    def get_interface_rates(self, stats: Dict[str, InterfaceCounters]) -> Dict[str, InterfaceRates]:
+        """Per-second traffic rates per interface since the previous collection"""
+        now = time.monotonic()
+        rates = {}
+        keys = []
+        for interface_name, counters in stats.items():
+            # A re-created interface gets a new ifindex and counters starting from zero
+            try:
+                with open(f'/sys/class/net/{interface_name}/ifindex', 'r') as f:
+                    ifindex = int(f.read())
+            except (OSError, ValueError):
+                ifindex = None
+            key = (interface_name, ifindex)
+            keys.append(key)
+            
+            values = (counters.bytes_recv, counters.bytes_sent, counters.packets_recv, counters.packets_sent,
+                      counters.errin + counters.errout, counters.dropin + counters.dropout)
+            interval_rates = self.network_rates.update(key, values, now)
+            if interval_rates is not None:
+                rx_bps, tx_bps, rx_pps, tx_pps, errors_ps, drops_ps = interval_rates
+                rates[interface_name] = InterfaceRates(
+                    round(rx_bps), round(tx_bps), round(rx_pps), round(tx_pps),
+                    round(errors_ps, 2), round(drops_ps, 2)
+                )
+        self.network_rates.retain(keys)
+        return rates
+    
+    def get_disk_io_rates(self) -> Dict[str, DiskRates]:
+        """IOPS, throughput and utilisation per whole disk since the previous collection"""
+        counters = None
+        if self.native is not None:
+            try:
+                counters = self.native.disk_io_counters()
+            except (OSError, ValueError) as e:
+                logger.debug(f"Native diskstats collector failed: {e}")
+        if counters is None:
+            counters = {
+                name: (io.read_count, io.write_count, io.read_bytes, io.write_bytes, getattr(io, 'busy_time', 0))
+                for name, io in psutil.disk_io_counters(perdisk=True).items()
+            }
+        
+        now = time.monotonic()
+        rates = {}
+        devices = []
+        for name, values in counters.items():
+            # Partitions and loop/ram devices would double count or add noise
+            if name.startswith(('loop', 'ram')) or not os.path.exists(f'/sys/block/{name}'):
+                continue
+            devices.append(name)
+            interval_rates = self.disk_rates.update(name, values, now)
+            if interval_rates is not None:
+                read_iops, write_iops, read_bps, write_bps, busy_ms = interval_rates
+                rates[name] = DiskRates(
+                    round(read_iops, 1), round(write_iops, 1), round(read_bps), round(write_bps),
+                    round(min(busy_ms / 10, 100.0), 1)
+                )
+        self.disk_rates.retain(devices)
+        return rates
+    
     def get_default_gateway(self) -> Optional[str]:
         """Get default gateway IP address"""
+        if self.native is not None:
+            try:
+                return self.native.default_gateway()
+            except (OSError, ValueError) as e:
+                logger.debug(f"Native gateway lookup failed: {e}")
+        
         try:
             result = subprocess.run(['ip', 'route', 'show', 'default'], 
                                  capture_output=True, text=True)
@@ -247,8 +4117,17 @@ class VDIClientAgent:
             logger.debug(f"Could not get default gateway: {e}")
         return None
     
+    def has_rdp_session(self) -> bool:
+        """Whether an RDP session exists, from the tracker or the last collected session list"""
+        if self.session_tracker.mode is not None:
+            return bool(self.session_tracker.current_sessions())
+        return bool(self.collectors.peek("rdp_sessions"))
+    
     def get_rdp_sessions(self) -> List[Dict[str, Any]]:
         """Get information about active RDP sessions"""
+        if self.session_tracker.mode is not None:
+            return self.session_tracker.current_sessions()
+        
         sessions = []
         try:
             # Look for FreeRDP processes
@@ -310,27 +4189,40 @@ class VDIClientAgent:
             except:
                 pass
             
+            # Inventory straight from sysfs when possible
+            if self.native is not None:
+                try:
+                    hardware['pci_devices'] = self.native.pci_devices()
+                except OSError as e:
+                    logger.debug(f"Native PCI inventory failed: {e}")
+                try:
+                    hardware['usb_devices'] = self.native.usb_devices()
+                except OSError as e:
+                    logger.debug(f"Native USB inventory failed: {e}")
+            
             # PCI devices (graphics, network, etc.)
             try:
-                result = subprocess.run(['lspci', '-mm'], capture_output=True, text=True)
-                if result.returncode == 0:
-                    devices = []
-                    for line in result.stdout.strip().split('\n'):
-                        if line:
-                            devices.append(line)
-                    hardware['pci_devices'] = devices
+                if 'pci_devices' not in hardware:
+                    result = subprocess.run(['lspci', '-mm'], capture_output=True, text=True)
+                    if result.returncode == 0:
+                        devices = []
+                        for line in result.stdout.strip().split('\n'):
+                            if line:
+                                devices.append(line)
+                        hardware['pci_devices'] = devices
             except:
                 pass
             
             # USB devices
             try:
-                result = subprocess.run(['lsusb'], capture_output=True, text=True)
-                if result.returncode == 0:
-                    devices = []
-                    for line in result.stdout.strip().split('\n'):
-                        if line and 'root hub' not in line.lower():
-                            devices.append(line)
-                    hardware['usb_devices'] = devices
+                if 'usb_devices' not in hardware:
+                    result = subprocess.run(['lsusb'], capture_output=True, text=True)
+                    if result.returncode == 0:
+                        devices = []
+                        for line in result.stdout.strip().split('\n'):
+                            if line and 'root hub' not in line.lower():
+                                devices.append(line)
+                        hardware['usb_devices'] = devices
             except:
                 pass
             
@@ -340,42 +4232,206 @@ class VDIClientAgent:
             logger.error(f"Error getting hardware info: {e}")
             return {"error": str(e)}
     
+    def send_startup_heartbeat(self) -> bool:
+        """Announce the agent with a minimal heartbeat before the first full collection"""
+        try:
+            with open('/proc/uptime', 'r') as f:
+                uptime = float(f.read().split()[0])
+            
+            response = self.transport.post_json(
+                "heartbeat",
+                f"/api/devices/{self.device_id}/heartbeat",
+                {
+                    "device_id": self.device_id,
+                    "hostname": socket.gethostname(),
+                    "timestamp": datetime.now().isoformat(),
+                    "uptime_seconds": uptime,
+                    "agent_version": "1.0.0",
+                    "startup": True
+                }
+            )
+            if response.status_code != 200:
+                logger.warning(f"Startup heartbeat failed with status {response.status_code}")
+                return False
+            
+            response_data = response.json()
+            if 'capabilities' in response_data:
+                self.server_capabilities = set(response_data['capabilities'])
+            for command in response_data.get('commands', []):
+                self.dispatch_command(command)
+            return True
+            
+        except Exception as e:
+            logger.error(f"Error sending startup heartbeat: {e}")
+            return False
+    
     def send_heartbeat(self) -> bool:
         """Send heartbeat to management server"""
+        system_info = None
+        command_results = []
+        delivered = False
         try:
             system_info = self.collect_system_info()
+            system_info["agent_transport"] = self.transport.connection_stats()
+            system_info["agent_memory"] = self.memory_governor.report()
+            if self.config.get("metrics_in_heartbeat", True):
+                system_info["agent_metrics"] = self.metrics.summary()
+            rdp_events = self.session_tracker.drain_events()
+            if rdp_events:
+                system_info["rdp_events"] = rdp_events
+            rdp_perf = self.rdp_sampler.report() if self.rdp_sampler is not None else None
+            if rdp_perf:
+                system_info["rdp_perf"] = rdp_perf
+            if self.qos is not None:
+                system_info["agent_qos"] = self.qos.report()
             
-            response = requests.post(
-                f"{self.server_url}/api/devices/{self.device_id}/heartbeat",
-                json=system_info,
-                timeout=30,
-                verify=False  # For development - should use proper certs in production
+            # Deltas are only sent once the server has advertised support for them
+            delta_allowed = (self.config.get("delta_heartbeats", True)
+                             and "delta_heartbeat" in self.server_capabilities
+                             and "error" not in system_info)
+            payload = self.heartbeat_encoder.encode(system_info, delta_allowed)
+            
+            # Finished command results ride along when the server accepts them
+            if "command_results_batch" in self.server_capabilities:
+                command_results = self.command_executor.take_results()
+                if command_results:
+                    payload["command_results"] = [self.result_entry(entry) for entry in command_results]
+            
+            # The compact encoding is only used once the server has advertised its schema
+            if (self.config.get("compact_heartbeats", True)
+                    and CompactEncoder.CAPABILITY in self.server_capabilities):
+                post = self.transport.post_compact
+            else:
+                post = self.transport.post_json
+            response = post(
+                "heartbeat",
+                f"/api/devices/{self.device_id}/heartbeat",
+                payload
             )
             
+            if response.status_code != 200:
+                self.command_executor.restore_results(command_results)
+                self.heartbeat_scheduler.observe(response)
+            
+            if response.status_code == 409:
+                # Server lost our base snapshot; resend everything right away, without backoff
+                self.heartbeat_encoder.reset()
+                if payload["heartbeat_mode"] == "delta":
+                    logger.info("Server rejected heartbeat delta, resending a full snapshot")
+                    self.heartbeat_scheduler.request_resend()
+                return False
+            
             if response.status_code == 200:
-                # Process any commands from server
+                # The server has the results now, whatever goes wrong below
+                delivered = True
+                self.results_delivered([entry["command_id"] for entry in command_results])
                 response_data = response.json()
+                self.heartbeat_scheduler.observe(response, response_data)
+                
+                if 'capabilities' in response_data:
+                    self.server_capabilities = set(response_data['capabilities'])
+                self.heartbeat_encoder.acknowledge(payload, system_info, response_data)
+                
+                # Process any commands from server
                 commands = response_data.get('commands', [])
                 
                 if commands:
                     logger.info(f"Received {len(commands)} commands from server")
                     for command in commands:
-                        self.handle_command(command)
+                        self.dispatch_command(command)
                 
+                self.replay_spool()
                 return True
             else:
                 logger.warning(f"Heartbeat failed with status {response.status_code}")
+                self.spool_snapshot(system_info)
                 return False
                 
         except requests.exceptions.RequestException as e:
+            # Also raised by response.json() for an unreadable reply to a delivered heartbeat
             logger.error(f"Network error during heartbeat: {e}")
+            if not delivered:
+                self.command_executor.restore_results(command_results)
+                self.spool_snapshot(system_info)
             return False
         except Exception as e:
             logger.error(f"Unexpected error during heartbeat: {e}")
+            if not delivered:
+                self.command_executor.restore_results(command_results)
             return False
     
+    def spool_snapshot(self, system_info: Optional[Dict[str, Any]]):
+        """Keep an undelivered snapshot on disk for later replay"""
+        if self.spool is None or system_info is None:
+            return
+        try:
+            self.spool.append(system_info)
+        except Exception as e:
+            logger.error(f"Failed to spool telemetry: {e}")
+    
+    def replay_spool(self):
+        """Deliver spooled snapshots in rate-limited batches, oldest first"""
+        if self.spool is None or "telemetry_batch" not in self.server_capabilities:
+            return
+        if time.monotonic() - self.last_spool_replay < self.config.get("spool_replay_interval", 10):
+            return
+        # Deferred while the user is active; the idle transition triggers the catch-up
+        if self.qos is not None and self.qos.active:
+            return
+        self.last_spool_replay = time.monotonic()
+        
+        try:
+            for _ in range(self.config.get("spool_replay_batches", 2)):
+                records, position = self.spool.read_batch(self.config.get("spool_batch_records", 50))
+                if not records:
+                    break
+                
+                response = self.transport.post_json(
+                    "telemetry_batch",
+                    f"/api/devices/{self.device_id}/telemetry-batch",
+                    {"device_id": self.device_id, "records": records}
+                )
+                if response.status_code not in (200, 201, 202, 204):
+                    logger.warning(f"Telemetry replay failed with status {response.status_code}")
+                    break
+                
+                self.spool.commit(position)
+                logger.info(f"Replayed {len(records)} spooled heartbeats")
+        except Exception as e:
+            logger.error(f"Telemetry replay failed: {e}")
+    
+    def dispatch_command(self, command: Dict[str, Any]):
+        """Queue a command for the event loop, or run it inline when no loop is running"""
+        if self.loop is not None and self.loop.is_running():
+            asyncio.run_coroutine_threadsafe(self.command_executor.submit(command), self.loop)
+        else:
+            self.handle_command(command)
+    
     def handle_command(self, command: Dict[str, Any]):
         """Handle command from management server"""
+        result = self.execute_command(command)
+        
+        # Send command result back to server
+        self.send_command_result(command.get('id'), result)
+    
+    def execute_command(self, command: Dict[str, Any],
+                        cancel: Optional[threading.Event] = None) -> Dict[str, Any]:
+        """Run a command and record its latency and outcome; setting cancel aborts it"""
+        started = time.monotonic()
+        result = self.run_command(command, cancel)
+        
+        # Unknown types share one label so arbitrary input cannot grow the metric set
+        command_type = command.get('type')
+        if command_type not in CommandExecutor.DEFAULT_PRIORITIES:
+            command_type = "other"
+        self.metrics.observe("vdi_agent_command_seconds", time.monotonic() - started, type=command_type)
+        self.metrics.inc("vdi_agent_commands_total", type=command_type,
+                         outcome="success" if result.get("success") else "failure")
+        return result
+    
+    def run_command(self, command: Dict[str, Any],
+                    cancel: Optional[threading.Event] = None) -> Dict[str, Any]:
+        """Run a command through its handler and return its result"""
         try:
             command_id = command.get('id')
             command_type = command.get('type')
@@ -386,56 +4442,239 @@ class VDIClientAgent:
             result = None
             
             if command_type == 'execute_script':
-                result = self.execute_script(command_data.get('script', ''))
+                result = self.execute_script(command_data.get('script', ''), command_id, cancel)
             elif command_type == 'restart_system':
                 result = self.restart_system(command_data.get('delay', 0))
             elif command_type == 'update_config':
                 result = self.update_config(command_data.get('config', {}))
             elif command_type == 'install_package':
-                result = self.install_package(command_data.get('package', ''))
+                result = self.install_package(command_data.get('package', ''), command_id, cancel)
             elif command_type == 'update_image':
-                result = self.update_image(command_data.get('image_url', ''), 
-                                        command_data.get('image_hash', ''))
+                # Downloading and hashing the image must not compete with the RDP session
+                with self.sandbox.background_priority():
+                    result = self.update_image(command_data.get('image_url', ''), 
+                                            command_data.get('image_hash', ''),
+                                            command_id,
+                                            command_data.get('chunk_index_url'),
+                                            cancel)
             elif command_type == 'collect_logs':
-                result = self.collect_logs(command_data.get('lines', 100))
+                # Bulk uploads wait for the user to go idle; the command is queued again then
+                if (self.qos is not None and self.qos.active and "log_batch" in self.server_capabilities
+                        and self.loop is not None and self.command_executor.defer(command)):
+                    logger.info(f"Deferring log collection {command_id} until the session is idle")
+                    self.report_command_progress(command_id, "deferred", 0, None)
+                    result = {"success": True, "deferred": True}
+                else:
+                    result = self.collect_logs(command_data.get('lines', 100), command_id)
             elif command_type == 'restart_service':
-                result = self.restart_service(command_data.get('service', ''))
+                result = self.restart_service(command_data.get('service', ''), command_id, cancel)
+            elif command_type == 'memory_report':
+                result = self.memory_report(command_data.get('duration', 30), command_data.get('top', 20))
+            elif command_type == 'profile_agent':
+                result = self.profile_agent(command_data.get('duration', 10),
+                                            command_data.get('interval_ms', 10),
+                                            command_data.get('top', 30))
             else:
                 result = {"success": False, "error": f"Unknown command type: {command_type}"}
             
-            # Send command result back to server
-            self.send_command_result(command_id, result)
+            return result
             
         except Exception as e:
             logger.error(f"Error handling command: {e}")
-            self.send_command_result(command.get('id'), {
-                "success": False,
-                "error": str(e)
-            })
+            return {"success": False, "error": str(e)}
     
-    def execute_script(self, script: str) -> Dict[str, Any]:
+    def execute_script(self, script: str, command_id: Optional[str] = None,
+                       cancel: Optional[threading.Event] = None) -> Dict[str, Any]:
         """Execute shell script"""
         try:
             if not self.config.get("enable_remote_commands", False):
                 return {"success": False, "error": "Remote commands are disabled"}
             
-            result = subprocess.run(
-                script,
-                shell=True,
-                capture_output=True,
-                text=True,
-                timeout=self.config.get("max_command_timeout", 300)
+            result = self.run_streaming(script, shell=True, command_id=command_id, cancel=cancel)
+            if result.get("timed_out"):
+                result["error"] = "Script execution timed out"
+            return result
+            
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+    
+    def run_streaming(self, args, shell: bool = False,
+                      command_id: Optional[str] = None, isolate: bool = True,
+                      cancel: Optional[threading.Event] = None) -> Dict[str, Any]:
+        """Run a process, reading its output incrementally into capped buffers"""
+        timeout = self.config.get("max_command_timeout", 300)
+        max_bytes = self.config.get("command_output_max_bytes", 65536)
+        forwarder = OutputForwarder(
+            self, command_id,
+            self.config.get("command_output_flush_interval", 2),
+            self.config.get("command_output_chunk_bytes", 32768)
+        )
+        
+        cgroup = None
+        if isolate:
+            args, shell, cgroup = self.sandbox.prepare(args, shell)
+        
+        # A new session lets a timeout kill the whole process tree
+        try:
+            process = subprocess.Popen(
+                args,
+                shell=shell,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                start_new_session=True
             )
+        except Exception:
+            self.sandbox.release(cgroup)
+            raise
+        
+        buffers = {"stdout": OutputRingBuffer(max_bytes), "stderr": OutputRingBuffer(max_bytes)}
+        selector = selectors.DefaultSelector()
+        selector.register(process.stdout, selectors.EVENT_READ, "stdout")
+        selector.register(process.stderr, selectors.EVENT_READ, "stderr")
+        deadline = time.monotonic() + timeout
+        timed_out = False
+        
+        try:
+            while selector.get_map():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or (cancel is not None and cancel.is_set()):
+                    timed_out = True
+                    break
+                
+                for key, _ in selector.select(timeout=min(remaining, forwarder.flush_interval)):
+                    data = os.read(key.fileobj.fileno(), 65536)
+                    if not data:
+                        selector.unregister(key.fileobj)
+                        continue
+                    buffers[key.data].append(data)
+                    forwarder.add(key.data, data)
+                
+                forwarder.maybe_flush()
+            
+            if timed_out:
+                self.kill_process_group(process)
+            return_code, rusage = self.wait_with_rusage(process, max(1, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            # Output closed but the process lingers past the deadline
+            timed_out = True
+            self.kill_process_group(process)
+            return_code, rusage = self.wait_with_rusage(process)
+        finally:
+            selector.close()
+            process.stdout.close()
+            process.stderr.close()
+        
+        forwarder.flush(final=True)
+        resource_usage = self.sandbox.usage(cgroup, rusage) if isolate else None
+        self.sandbox.release(cgroup)
+        
+        result = {
+            "success": return_code == 0 and not timed_out,
+            "return_code": return_code,
+            "stdout": buffers["stdout"].text(),
+            "stderr": buffers["stderr"].text(),
+            "stdout_bytes": buffers["stdout"].total_bytes,
+            "stderr_bytes": buffers["stderr"].total_bytes,
+            "stdout_truncated": buffers["stdout"].truncated,
+            "stderr_truncated": buffers["stderr"].truncated,
+            "resource_usage": resource_usage
+        }
+        if timed_out:
+            result["timed_out"] = True
+        return result
+    
+    @staticmethod
+    def wait_with_rusage(process: subprocess.Popen, timeout: Optional[float] = None) -> tuple:
+        """Reap a process with wait4 so its resource usage is available; returns (code, rusage)"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                pid, status, rusage = os.wait4(process.pid, 0 if deadline is None else os.WNOHANG)
+            except ChildProcessError:
+                # Already reaped elsewhere
+                return process.wait(), None
+            if pid:
+                process.returncode = os.waitstatus_to_exitcode(status)
+                return process.returncode, rusage
+            if time.monotonic() >= deadline:
+                raise subprocess.TimeoutExpired(process.args, timeout)
+            time.sleep(0.05)
+    
+    @staticmethod
+    def kill_process_group(process: subprocess.Popen):
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    
+    def memory_report(self, duration: float = 30, top: int = 20) -> Dict[str, Any]:
+        """Report the agent's RSS and its top allocation sites from tracemalloc"""
+        try:
+            # Without tracing from startup, only allocations made during the window are seen
+            started_here = not tracemalloc.is_tracing()
+            if started_here:
+                duration = max(0, min(duration, self.config.get("memory_report_max_seconds", 120)))
+                tracemalloc.start(self.config.get("memory_tracemalloc_frames", 1))
+                time.sleep(duration)
+            
+            try:
+                snapshot = tracemalloc.take_snapshot().filter_traces((
+                    tracemalloc.Filter(False, tracemalloc.__file__),
+                ))
+                traced, traced_peak = tracemalloc.get_traced_memory()
+            finally:
+                if started_here:
+                    tracemalloc.stop()
+            
+            allocators = []
+            for stat in snapshot.statistics('lineno')[:min(top, 100)]:
+                frame = stat.traceback[0]
+                allocators.append({
+                    "location": f"{frame.filename}:{frame.lineno}",
+                    "size_bytes": stat.size,
+                    "count": stat.count
+                })
             
             return {
-                "success": result.returncode == 0,
-                "return_code": result.returncode,
-                "stdout": result.stdout,
-                "stderr": result.stderr
+                "success": True,
+                "memory": self.memory_governor.report(),
+                "traced_bytes": traced,
+                "traced_peak_bytes": traced_peak,
+                "window_seconds": duration if started_here else None,
+                "top_allocators": allocators
+            }
+            
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+    
+    def profile_agent(self, duration: float = 10, interval_ms: float = 10, top: int = 30) -> Dict[str, Any]:
+        """Sample the agent's own threads and return collapsed stacks and per-function timings"""
+        try:
+            duration = max(0.1, min(duration, self.config.get("profile_max_seconds", 60)))
+            interval = max(interval_ms, self.config.get("profile_min_interval_ms", 5)) / 1000
+            sampler = StackSampler(interval, self.config.get("profile_max_overhead", 0.05))
+            thread_ticks = sampler.run(duration)
+            
+            clock_ticks = os.sysconf('SC_CLK_TCK')
+            names = {thread.native_id: thread.name for thread in threading.enumerate()}
+            thread_cpu = {
+                names.get(tid, str(tid)): round(ticks / clock_ticks * 1000)
+                for tid, ticks in thread_ticks.items() if ticks > 0
+            }
+            collapsed, truncated = sampler.collapsed(self.config.get("profile_max_output_bytes", 65536))
+            
+            return {
+                "success": True,
+                "duration_seconds": duration,
+                "samples": sampler.samples,
+                "sampling_overhead_ms": round(sampler.sampling_time * 1000, 1),
+                "thread_cpu_ms": thread_cpu,
+                "functions": sampler.functions(min(top, 200)),
+                "collapsed": collapsed,
+                "truncated": truncated
             }
             
-        except subprocess.TimeoutExpired:
-            return {"success": False, "error": "Script execution timed out"}
         except Exception as e:
             return {"success": False, "error": str(e)}
     
@@ -475,103 +4714,238 @@ class VDIClientAgent:
         except Exception as e:
             return {"success": False, "error": str(e)}
     
-    def install_package(self, package: str) -> Dict[str, Any]:
+    def install_package(self, package: str, command_id: Optional[str] = None,
+                        cancel: Optional[threading.Event] = None) -> Dict[str, Any]:
         """Install Alpine package"""
         try:
-            result = subprocess.run([
-                'apk', 'add', package
-            ], capture_output=True, text=True)
-            
-            return {
-                "success": result.returncode == 0,
-                "return_code": result.returncode,
-                "stdout": result.stdout,
-                "stderr": result.stderr
-            }
+            return self.run_streaming(['apk', 'add', package], command_id=command_id, cancel=cancel)
             
         except Exception as e:
             return {"success": False, "error": str(e)}
     
-    def update_image(self, image_url: str, image_hash: str) -> Dict[str, Any]:
+    def update_image(self, image_url: str, image_hash: str,
+                     command_id: Optional[str] = None,
+                     index_url: Optional[str] = None,
+                     cancel: Optional[threading.Event] = None) -> Dict[str, Any]:
         """Download and schedule image update"""
         try:
-            # Download new image
-            response = requests.get(image_url, stream=True)
-            response.raise_for_status()
+            if not image_hash:
+                return {"success": False, "error": "Missing image hash"}
+            
+            download_dir = Path(self.config.get("download_dir", "/var/lib/vdi/downloads"))
+            current_image = self.config.get("current_image_path", "/boot/vdi-update.img")
+            index_cache = self.config.get("image_index_cache", "/var/lib/vdi/image-index.json")
+            
+            def progress(done, total):
+                # Called for every block, so a cancelled command stops downloading promptly
+                if cancel is not None and cancel.is_set():
+                    raise CommandCancelled("Image download cancelled")
+                self.report_command_progress(command_id, "download", done, total)
             
-            temp_image = f"/tmp/update-{int(time.time())}.img"
+            # Capped by the QoS token bucket while a user is active
+            throttle = self.qos.throttle if self.qos is not None else None
             
-            with open(temp_image, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
+            temp_image = None
+            delta_stats = None
             
-            # Verify image integrity
-            import hashlib
-            with open(temp_image, 'rb') as f:
-                calculated_hash = hashlib.sha256(f.read()).hexdigest()
+            # Try to rebuild the image from the installed one before a full download
+            if (self.config.get("delta_image_updates", True)
+                    and (os.path.exists(current_image) or self.peer_cache is not None)):
+                download_dir.mkdir(parents=True, exist_ok=True)
+                updater = DeltaImageUpdater(
+                    self.transport, current_image, index_cache,
+                    self.config.get("delta_coalesce_gap", 64 * 1024),
+                    self.config.get("delta_max_range_bytes", 8 * 1024 * 1024),
+                    self.peer_cache,
+                    throttle
+                )
+                output_path = download_dir / f"{image_hash}.img"
+                try:
+                    delta_stats = updater.update(
+                        image_url, index_url or chunk_index_url(image_url),
+                        image_hash, output_path, progress
+                    )
+                    temp_image = output_path
+                    logger.info(f"Delta image update fetched {delta_stats['bytes_downloaded']} bytes "
+                                f"from origin and {delta_stats['bytes_from_peers']} from peers, "
+                                f"reused {delta_stats['bytes_reused']} bytes")
+                except CommandCancelled:
+                    raise
+                except Exception as e:
+                    logger.warning(f"Delta image update unavailable, downloading full image: {e}")
+            
+            if temp_image is None:
+                downloader = ImageDownloader(
+                    self.transport,
+                    str(download_dir),
+                    self.config.get("download_chunk_size", 1024 * 1024),
+                    self.config.get("download_sync_bytes", 32 * 1024 * 1024),
+                    self.config.get("download_retries", 3),
+                    throttle
+                )
+                
+                # Download new image, verifying it as it streams to disk
+                try:
+                    temp_image = downloader.download(image_url, image_hash, progress=progress)
+                except ValueError as e:
+                    return {"success": False, "error": str(e)}
             
-            if calculated_hash != image_hash:
-                os.remove(temp_image)
-                return {"success": False, "error": "Image hash mismatch"}
+            # A delta update leaves the new image's chunk index for the next update to reuse;
+            # after a full download the published index is fetched so it need not be rebuilt
+            new_index = temp_image.with_suffix(".chunks.json")
+            if not new_index.exists() and self.config.get("delta_image_updates", True):
+                self.save_published_index(index_url or chunk_index_url(image_url), image_hash, new_index)
+            
+            # Neighbours can fetch the verified new image from us before it is installed
+            if self.peer_cache is not None and new_index.exists():
+                try:
+                    self.peer_cache.register_image(json.loads(new_index.read_text()), temp_image)
+                except (OSError, ValueError, KeyError) as e:
+                    logger.debug(f"Could not offer the new image to peers: {e}")
+            index_step = f"mv {new_index} {index_cache}\n" if new_index.exists() else ""
             
             # Schedule update for next reboot
             update_script = f"""#!/bin/sh
 # VDI Image Update Script
-cp {temp_image} /boot/vdi-update.img
+cp {temp_image} {current_image}
 rm {temp_image}
-reboot
+{index_step}reboot
 """
             
             with open('/tmp/vdi-update.sh', 'w') as f:
                 f.write(update_script)
             os.chmod('/tmp/vdi-update.sh', 0o755)
             
-            return {"success": True, "message": "Image update scheduled for next reboot"}
+            result = {"success": True, "message": "Image update scheduled for next reboot"}
+            if delta_stats:
+                result["delta"] = delta_stats
+            return result
             
         except Exception as e:
             return {"success": False, "error": str(e)}
     
-    def collect_logs(self, lines: int = 100) -> Dict[str, Any]:
-        """Collect recent log entries"""
+    def save_published_index(self, index_url: str, image_hash: str, path: Path):
+        """Store the server's chunk index for an image if it describes that image"""
+        try:
+            with self.transport.get("download", index_url) as response:
+                response.raise_for_status()
+                index = response.json()
+            if index.get("sha256") != image_hash:
+                logger.warning("Published chunk index does not match the downloaded image, ignoring it")
+                return
+            DeltaImageUpdater.save_index(index, path)
+        except Exception as e:
+            logger.debug(f"No chunk index published for the new image: {e}")
+    
+    def report_command_progress(self, command_id: Optional[str], stage: str,
+                                done: int, total: Optional[int]):
+        """Tell the server how far a long-running command has got, at most every few seconds"""
+        if command_id is None or "command_progress" not in self.server_capabilities:
+            return
+        
+        now = time.monotonic()
+        interval = self.config.get("progress_report_interval", 5)
+        if done != total and now - self.progress_reported.get(command_id, 0) < interval:
+            return
+        self.progress_reported[command_id] = now
+        
+        try:
+            self.transport.post_json(
+                "command_result",
+                f"/api/devices/{self.device_id}/command-progress",
+                {
+                    "command_id": command_id,
+                    "stage": stage,
+                    "done": done,
+                    "total": total,
+                    "percent": round(100.0 * done / total, 1) if total else None,
+                    "timestamp": datetime.now().isoformat()
+                }
+            )
+        except Exception as e:
+            logger.debug(f"Failed to report progress for {command_id}: {e}")
+        
+        if done == total:
+            self.progress_reported.pop(command_id, None)
+    
+    def collect_logs(self, lines: int = 100, command_id: Optional[str] = None) -> Dict[str, Any]:
+        """Collect log entries written since the previous collection"""
         try:
             logs = {}
+            more = {}
+            cursors = {}
+            max_bytes = self.config.get("log_ship_max_bytes", 262144)
+            log_file = self.config.get("logging", {}).get("log_file", "/var/log/vdi/agent.log")
             
             # VDI agent logs
             try:
-                with open('/var/log/vdi/agent.log', 'r') as f:
-                    log_lines = f.readlines()
-                    logs['vdi_agent'] = log_lines[-lines:]
-            except:
+                entry = self.log_shipper.read_new(log_file, lines, max_bytes)
+                logs['vdi_agent'] = entry["lines"]
+                more['vdi_agent'] = entry["more"]
+                cursors[log_file] = entry["cursor"]
+            except OSError:
                 logs['vdi_agent'] = []
             
-            # System logs
-            try:
-                result = subprocess.run([
-                    'dmesg', '--human', '--time-format=iso'
-                ], capture_output=True, text=True)
-                if result.returncode == 0:
-                    logs['dmesg'] = result.stdout.split('\n')[-lines:]
-            except:
-                logs['dmesg'] = []
+            # Kernel log, read incrementally from /dev/kmsg when possible
+            kernel = self.log_shipper.read_kmsg(lines, self.config.get("log_ship_max_records", 2000))
+            if kernel is not None:
+                logs['dmesg'] = kernel["lines"]
+                more['dmesg'] = kernel["more"]
+                cursors['/dev/kmsg'] = kernel["cursor"]
+            else:
+                try:
+                    result = subprocess.run([
+                        'dmesg', '--human', '--time-format=iso'
+                    ], capture_output=True, text=True)
+                    if result.returncode == 0:
+                        logs['dmesg'] = result.stdout.split('\n')[-lines:]
+                except OSError:
+                    logs['dmesg'] = []
             
-            return {"success": True, "logs": logs}
+            # Cursors only advance once the lines have reached the server
+            if "log_batch" in self.server_capabilities:
+                shipped = self.ship_log_batches(logs, command_id)
+                self.log_shipper.commit(cursors)
+                return {"success": True, "shipped": shipped, "more": more}
+            
+            self.log_shipper.stage(command_id, cursors)
+            return {"success": True, "logs": logs, "more": more}
             
         except Exception as e:
             return {"success": False, "error": str(e)}
     
-    def restart_service(self, service: str) -> Dict[str, Any]:
+    def ship_log_batches(self, logs: Dict[str, List[str]], command_id: Optional[str]) -> Dict[str, int]:
+        """Upload collected log lines in size-bounded batches"""
+        batch_bytes = self.config.get("log_batch_bytes", 65536)
+        shipped = {}
+        
+        for source, source_lines in logs.items():
+            batch = []
+            size = 0
+            for line in source_lines + [None]:
+                if line is not None:
+                    batch.append(line)
+                    size += len(line) + 1
+                if batch and (line is None or size >= batch_bytes):
+                    response = self.transport.post_json(
+                        "logs",
+                        f"/api/devices/{self.device_id}/logs",
+                        {"command_id": command_id, "source": source, "lines": batch}
+                    )
+                    response.raise_for_status()
+                    shipped[source] = shipped.get(source, 0) + len(batch)
+                    batch = []
+                    size = 0
+        
+        return shipped
+    
+    def restart_service(self, service: str, command_id: Optional[str] = None,
+                        cancel: Optional[threading.Event] = None) -> Dict[str, Any]:
         """Restart system service"""
         try:
-            result = subprocess.run([
-                'rc-service', service, 'restart'
-            ], capture_output=True, text=True)
-            
-            return {
-                "success": result.returncode == 0,
-                "return_code": result.returncode,
-                "stdout": result.stdout,
-                "stderr": result.stderr
-            }
+            # Not isolated: the restarted daemon must not end up confined to the command slice
+            return self.run_streaming(['rc-service', service, 'restart'], command_id=command_id,
+                                      isolate=False, cancel=cancel)
             
         except Exception as e:
             return {"success": False, "error": str(e)}
@@ -579,43 +4953,354 @@ reboot
     def send_command_result(self, command_id: str, result: Dict[str, Any]):
         """Send command execution result to server"""
         try:
-            requests.post(
-                f"{self.server_url}/api/devices/{self.device_id}/command-result",
-                json={
+            response = self.transport.post_json(
+                "command_result",
+                f"/api/devices/{self.device_id}/command-result",
+                {
                     "command_id": command_id,
                     "result": result,
                     "timestamp": datetime.now().isoformat()
-                },
-                timeout=30,
-                verify=False
+                }
             )
+            if response.status_code in (200, 201, 202, 204):
+                self.results_delivered([command_id])
         except Exception as e:
             logger.error(f"Failed to send command result: {e}")
     
+    def send_command_results(self, results: List[Dict[str, Any]]) -> bool:
+        """Send several command results in one request"""
+        try:
+            response = self.transport.post_json(
+                "command_result",
+                f"/api/devices/{self.device_id}/command-results",
+                {"results": [self.result_entry(entry) for entry in results]}
+            )
+            if response.status_code in (200, 201, 202, 204):
+                self.results_delivered([entry["command_id"] for entry in results])
+                return True
+            logger.warning(f"Bulk command result upload failed with status {response.status_code}")
+        except Exception as e:
+            logger.error(f"Failed to send command results: {e}")
+        
+        self.command_executor.restore_results(results)
+        return False
+    
+    def results_delivered(self, command_ids: List[Any]):
+        """Finish bookkeeping that waited for the server to receive these results"""
+        for command_id in command_ids:
+            self.log_shipper.acknowledge(command_id)
+    
+    @staticmethod
+    def result_entry(entry: Dict[str, Any]) -> Dict[str, Any]:
+        """Strip delivery bookkeeping from a queued result"""
+        return {key: entry[key] for key in ("command_id", "result", "timestamp")}
+    
+    def start_peer_cache(self):
+        """Start the peer cache and offer the installed image to neighbours"""
+        try:
+            self.peer_cache.start()
+        except OSError as e:
+            logger.error(f"Could not start peer cache: {e}")
+            self.peer_cache = None
+            return
+        
+        # Only advertise the installed image when the cached index really describes it
+        index_cache = self.config.get("image_index_cache", "/var/lib/vdi/image-index.json")
+        current_image = self.config.get("current_image_path", "/boot/vdi-update.img")
+        try:
+            index = json.loads(Path(index_cache).read_text())
+            if not os.path.exists(current_image) or index.get("size") != os.path.getsize(current_image):
+                return
+            with self.sandbox.background_priority():
+                installed_sha256 = file_sha256(current_image)
+            if index.get("sha256") != installed_sha256:
+                logger.info("Cached chunk index is stale, not advertising the installed image")
+                return
+            self.peer_cache.register_image(index, Path(current_image))
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+    
+    def apply_qos_profile(self, profile: str):
+        """Stretch background collection while a user is active and catch up once idle"""
+        self.cadence_factor = self.config.get("qos_active_cadence_factor", 4) if profile == "active" else 1
+        self.collectors.ttls["slow"] = self.config.get("collector_slow_ttl", 300) * self.cadence_factor
+        self.cpu_sampler.interval = self.config.get("cpu_sample_interval", 1.0) * self.cadence_factor
+        self.metrics.inc("vdi_agent_qos_transitions_total", profile=profile)
+        if profile == "idle":
+            # Replay deferred telemetry with the next heartbeat and rerun deferred commands
+            self.last_spool_replay = 0.0
+            self.request_heartbeat()
+            self.command_executor.resume_deferred()
+    
+    def request_heartbeat(self):
+        """Send the next heartbeat now instead of waiting for the interval (thread-safe)"""
+        if self.loop is not None and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.heartbeat_wakeup.set)
+    
     def run_agent_loop(self):
         """Main agent loop"""
         logger.info("Starting VDI agent main loop")
         
+        try:
+            asyncio.run(self.run_async())
+        finally:
+            # Running commands kill their processes when cancelled; give them a moment to do so
+            self.command_executor.cancel_all()
+            finished = self.command_executor.wait_cancelled(self.command_executor.cancel_grace)
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.command_pool.shutdown(wait=False, cancel_futures=True)
+            self.heartbeat_executor.shutdown(wait=False, cancel_futures=True)
+            self.transport.close()
+            if not finished:
+                # The pool threads would otherwise be joined at interpreter exit
+                logger.warning("Commands ignored cancellation, exiting without waiting for them")
+                logging.shutdown()
+                os._exit(0)
+    
+    async def run_async(self):
+        """Run heartbeats, commands, result delivery and collectors as independent tasks"""
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        self.heartbeat_wakeup = asyncio.Event()
+        
+        tasks = [
+            asyncio.create_task(self.heartbeat_task(), name="heartbeat"),
+            asyncio.create_task(self.collector_task(), name="collectors"),
+            asyncio.create_task(self.result_task(), name="results")
+        ]
+        tasks.extend(self.command_executor.start())
+        
+        try:
+            await self.stop_event.wait()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.loop = None
+    
+    def start_background_services(self):
+        """Start samplers, session tracking and the command channel"""
+        self.cpu_sampler.start()
+        self.session_tracker.start()
+        if self.rdp_sampler is not None:
+            self.rdp_sampler.start()
+        if self.qos is not None:
+            self.qos.start()
+        if self.command_channel is not None:
+            self.command_channel.start()
+        if self.config.get("metrics_endpoint", False):
+            try:
+                self.metrics.start_server(self.config.get("metrics_bind", "127.0.0.1"),
+                                          self.config.get("metrics_port", 9101))
+            except OSError as e:
+                logger.error(f"Could not start metrics endpoint: {e}")
+    
+    async def heartbeat_task(self):
+        """Send heartbeats on their own thread so commands can never delay them"""
+        timeout = self.config.get("heartbeat_timeout", 60)
+        pending = None
+        peer_cache_started = False
+        
+        # Report in before anything else competes for the CPU at boot
+        if self.config.get("startup_heartbeat", True):
+            try:
+                await asyncio.wait_for(
+                    self.loop.run_in_executor(self.heartbeat_executor, self.send_startup_heartbeat), timeout
+                )
+            except asyncio.TimeoutError:
+                logger.warning(f"Startup heartbeat did not complete within {timeout}s")
+        await self.loop.run_in_executor(self.executor, self.start_background_services)
+        
+        # Random phase so a site full of clients booted together spreads out
+        try:
+            await asyncio.wait_for(self.heartbeat_wakeup.wait(), self.heartbeat_scheduler.initial_delay())
+        except asyncio.TimeoutError:
+            pass
+        self.heartbeat_wakeup.clear()
+        
         while self.running:
+            success = True
             try:
-                # Send heartbeat
-                success = self.send_heartbeat()
-                
-                if success:
-                    logger.debug("Heartbeat sent successfully")
+                if pending is not None and not pending.done():
+                    logger.warning("Previous heartbeat still in progress, skipping")
                 else:
-                    logger.warning("Heartbeat failed")
-                
+                    pending = self.loop.run_in_executor(self.heartbeat_executor, self.send_heartbeat)
+                    success = await asyncio.wait_for(asyncio.shield(pending), timeout)
+                    
+                    if success:
+                        logger.debug("Heartbeat sent successfully")
+                    else:
+                        logger.warning("Heartbeat failed")
+                    
+            except asyncio.TimeoutError:
+                logger.warning(f"Heartbeat did not complete within {timeout}s")
+                success = False
             except Exception as e:
-                logger.error(f"Error in agent loop: {e}")
+                logger.error(f"Error in heartbeat task: {e}")
+                success = False
+            
+            # Verifying the installed image takes a while, so it waits for the first full heartbeat
+            if self.peer_cache is not None and not peer_cache_started:
+                peer_cache_started = True
+                threading.Thread(target=self.start_peer_cache, name="peer-cache-start", daemon=True).start()
             
-            # Sleep until next heartbeat
-            time.sleep(self.heartbeat_interval)
+            # Sleep until next heartbeat, or until something asks for one early
+            delay = self.heartbeat_scheduler.next_delay(success, self.command_executor.has_work())
+            try:
+                await asyncio.wait_for(self.heartbeat_wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            self.heartbeat_wakeup.clear()
+    
+    async def result_task(self):
+        """Deliver finished command results, batched when the server supports it"""
+        # Pending commands tighten heartbeats to heartbeat_busy_interval, so results normally
+        # ride on the next heartbeat; the bulk POST only covers a heartbeat that is late
+        max_delay = self.config.get("command_result_max_delay",
+                                    self.config.get("heartbeat_busy_interval", 10) * 1.5)
+        while True:
+            await asyncio.sleep(1)
+            
+            if "command_results_batch" in self.server_capabilities:
+                # Give the next heartbeat a chance to carry the results first
+                results = self.command_executor.take_results(max_age=max_delay)
+                if results:
+                    await self.loop.run_in_executor(self.executor, self.send_command_results, results)
+            else:
+                for entry in self.command_executor.take_results():
+                    await self.loop.run_in_executor(
+                        self.executor, self.send_command_result, entry["command_id"], entry["result"]
+                    )
+    
+    async def collector_task(self):
+        """Refresh expired slow and static collectors ahead of the next heartbeat"""
+        interval = self.config.get("collector_refresh_interval", 30)
+        while True:
+            await asyncio.sleep(interval * self.cadence_factor)
+            try:
+                await self.loop.run_in_executor(self.executor, self.collectors.refresh_expired)
+            except Exception as e:
+                logger.error(f"Error refreshing collectors: {e}")
+    
+    def benchmark_collectors(self, rounds: int = 20) -> Dict[str, Dict[str, float]]:
+        """Time each collector with the native readers and with the psutil/subprocess fallback"""
+        collectors = {
+            "memory": self.get_memory_info,
+            "network": self.get_network_info,
+            "default_gateway": self.get_default_gateway,
+            "hardware": self.get_hardware_info,
+            "cpu_times": self.cpu_sampler.read_cpu_times
+        }
+        native = self.native
+        results = {}
+        for name, collect in collectors.items():
+            results[name] = {}
+            for mode, reader in (("native", native), ("fallback", None)):
+                if mode == "native" and reader is None:
+                    continue
+                self.native = reader
+                self.cpu_sampler.native = reader
+                started = time.perf_counter()
+                for _ in range(rounds):
+                    collect()
+                results[name][mode] = (time.perf_counter() - started) / rounds * 1000
+        self.native = native
+        self.cpu_sampler.native = native
+        return results
+    
+    def benchmark_encoding(self, rounds: int = 200) -> Dict[str, Dict[str, float]]:
+        """Compare payload size and encode time of JSON and the compact encoding"""
+        encoder = HeartbeatDeltaEncoder()
+        first = self.collect_system_info()
+        first["agent_transport"] = self.transport.connection_stats()
+        first["agent_memory"] = self.memory_governor.report()
+        full = encoder.encode(first, False)
+        encoder.acknowledge(full, first, {"ack_seq": full["seq"]})
+        
+        self.collectors.invalidate(cadence="fast")
+        second = self.collect_system_info()
+        second["agent_transport"] = self.transport.connection_stats()
+        second["agent_memory"] = self.memory_governor.report()
+        delta = encoder.encode(second, True)
+        
+        serializers = {
+            "json": lambda payload: json.dumps(payload, separators=(',', ':'), default=json_default).encode('utf-8'),
+            "compact": self.transport.compact_encoder.encode
+        }
+        results = {}
+        for payload_name, payload in (("full", full), ("delta", delta)):
+            for serializer_name, serialize in serializers.items():
+                started = time.perf_counter()
+                for _ in range(rounds):
+                    body = serialize(payload)
+                elapsed = time.perf_counter() - started
+                results[f"{payload_name} {serializer_name}"] = {
+                    "bytes": len(body),
+                    "gzip_bytes": len(gzip.compress(body, compresslevel=6)),
+                    "encode_us": elapsed / rounds * 1e6
+                }
+        return results
     
     def stop(self):
         """Stop the agent"""
         logger.info("Stopping VDI agent")
         self.running = False
+        self.command_executor.cancel_all()
+        self.cpu_sampler.stop()
+        self.session_tracker.stop()
+        if self.rdp_sampler is not None:
+            self.rdp_sampler.stop()
+        if self.qos is not None:
+            self.qos.stop()
+        if self.command_channel is not None:
+            self.command_channel.stop()
+        if self.peer_cache is not None:
+            self.peer_cache.stop()
+        self.metrics.stop()
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+
+
+STARTUP_PROBE = """
+import sys, time, json, importlib.util
+from importlib.machinery import SourceFileLoader
+started = time.perf_counter()
+spec = importlib.util.spec_from_file_location("vdi_agent", sys.argv[1], loader=SourceFileLoader("vdi_agent", sys.argv[1]))
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+imported = time.perf_counter()
+heavy = [name for name in module.HEAVY_MODULES if name in sys.modules]
+module.VDIClientAgent(sys.argv[2])
+ready = time.perf_counter()
+print(json.dumps({"import_ms": (imported - started) * 1000, "init_ms": (ready - imported) * 1000, "heavy_modules": heavy}))
+"""
+
+
+def benchmark_startup(config_path: str, runs: int = 5) -> bool:
+    """Time import and agent construction in fresh interpreters and check them against the budgets"""
+    config = VDIClientAgent.load_config(config_path)
+    import_budget = config.get("startup_import_budget_ms", 250)
+    init_budget = config.get("startup_init_budget_ms", 500)
+    
+    samples = []
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, '-c', STARTUP_PROBE, os.path.abspath(__file__), config_path],
+            capture_output=True, text=True
+        )
+        if result.returncode != 0:
+            print(f"Startup probe failed: {result.stderr.strip()}")
+            return False
+        samples.append(json.loads(result.stdout.strip().splitlines()[-1]))
+    
+    import_ms = sorted(sample["import_ms"] for sample in samples)[runs // 2]
+    init_ms = sorted(sample["init_ms"] for sample in samples)[runs // 2]
+    heavy = sorted(set(name for sample in samples for name in sample["heavy_modules"]))
+    
+    print(f"import   {import_ms:8.1f}ms  (budget {import_budget}ms)")
+    print(f"init     {init_ms:8.1f}ms  (budget {init_budget}ms)")
+    print(f"heavy modules at import: {', '.join(heavy) or 'none'}")
+    return import_ms <= import_budget and init_ms <= init_budget and not heavy
 
 
 def signal_handler(signum, frame):
@@ -629,7 +5314,50 @@ def signal_handler(signum, frame):
 
 def main():
     """Main entry point"""
-    import signal
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='VDI Thin Client Management Agent')
+    parser.add_argument('--config', default='/etc/vdi/agent-config.json', help='Agent configuration file')
+    parser.add_argument('--chunk-index', metavar='IMAGE',
+                        help='Write IMAGE.chunks.json for delta image updates and exit')
+    parser.add_argument('--benchmark-collectors', metavar='ROUNDS', type=int, nargs='?', const=20,
+                        help='Compare native and fallback collector latency and exit')
+    parser.add_argument('--benchmark-startup', metavar='RUNS', type=int, nargs='?', const=5,
+                        help='Check import and startup time against the configured budgets and exit')
+    parser.add_argument('--benchmark-encoding', metavar='ROUNDS', type=int, nargs='?', const=200,
+                        help='Compare JSON and compact heartbeat encodings and exit')
+    parser.add_argument('--compact-schema', action='store_true',
+                        help='Print the compact heartbeat schema as JSON and exit')
+    args = parser.parse_args()
+    
+    if args.compact_schema:
+        print(json.dumps(CompactEncoder.schema(), indent=2))
+        return
+    
+    if args.benchmark_encoding:
+        bench_agent = VDIClientAgent(args.config)
+        for name, result in bench_agent.benchmark_encoding(args.benchmark_encoding).items():
+            print(f"{name:14} {result['bytes']:8d} B  {result['gzip_bytes']:7d} B gzip  "
+                  f"{result['encode_us']:9.1f} us")
+        return
+    
+    if args.benchmark_startup:
+        sys.exit(0 if benchmark_startup(args.config, args.benchmark_startup) else 1)
+    
+    if args.benchmark_collectors:
+        bench_agent = VDIClientAgent(args.config)
+        for name, timings in bench_agent.benchmark_collectors(args.benchmark_collectors).items():
+            row = "  ".join(f"{mode}={ms:.3f}ms" for mode, ms in timings.items())
+            print(f"{name:16} {row}")
+        return
+    
+    if args.chunk_index:
+        index = ContentChunker().build_index(args.chunk_index)
+        DeltaImageUpdater.save_index(index, Path(f"{args.chunk_index}.chunks.json"))
+        print(f"Wrote {len(index['chunks'])} chunks for {args.chunk_index}")
+        return
+    
+    setup_logging()
     
     # Set up signal handlers
     signal.signal(signal.SIGTERM, signal_handler)
@@ -637,7 +5365,7 @@ def main():
     
     # Create and start agent
     global agent
-    agent = VDIClientAgent()
+    agent = VDIClientAgent(args.config)
     
     try:
         agent.run_agent_loop()